@@ -0,0 +1,93 @@
+'''Cold start budget of the viewer
+
+Starts the viewer in a new interpreter a few times and measures the time
+from the start of the process until the main window has been shown and
+painted.  Exits with 1 if the median is over the budget or if one of the
+format backends (h5py, fabio, PIL) was imported before the window was
+shown, these are loaded lazily (see ``LazyModule``).
+
+Without a display the offscreen Qt platform is used.
+
+usage: python benchmarks/bench_startup.py [--runs 5] [--budget 1.5]
+'''
+import sys
+import os
+import argparse
+import json
+import subprocess
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+backends = ('h5py', 'fabio', 'PIL.Image')
+
+# seconds until the window is shown
+budget = 1.5
+
+# runs in the new interpreter, prints the import and show times (seconds
+# since the process start) and the backends imported by then as json
+child = '''
+import sys, time, json
+t0 = float(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+import pattern_viewer
+from PyQt5.QtWidgets import QApplication
+t_import = time.time()
+app = QApplication(sys.argv[:1])
+form = pattern_viewer.PatternViewer()
+form.show()
+app.processEvents()
+t_show = time.time()
+print(json.dumps({'import': t_import - t0, 'window': t_show - t0,
+                  'backends': [m for m in %r if m in sys.modules]}))
+''' %(backends,)
+
+
+def start(env):
+    t0 = time.time()
+    out = subprocess.run([sys.executable, '-c', child, repr(t0), root], env=env,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def environment():
+    '''environment of the new interpreters, offscreen Qt without a display'''
+    env = dict(os.environ)
+    if sys.platform.startswith('linux') and not env.get('DISPLAY') and not env.get('WAYLAND_DISPLAY'):
+        env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    return env
+
+
+def measure(runs, env=None):
+    '''results of ``runs`` starts and the median time to the window'''
+    env = env or environment()
+    # the first run fills the OS file cache and is not counted
+    start(env)
+    runs = [start(env) for i in range(runs)]
+    windows = sorted(r['window'] for r in runs)
+    return runs, windows[len(windows) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time to the first window of the viewer.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=budget, help='seconds, default %.1f' %budget)
+    args = parser.parse_args(argv)
+
+    runs, median = measure(args.runs)
+    windows = sorted(r['window'] for r in runs)
+    print('imports %.2f s, first window %.2f s (median of %d, best %.2f s), budget %.2f s'
+          %(sorted(r['import'] for r in runs)[len(runs) // 2], median, len(runs), windows[0], args.budget))
+    failed = False
+    eager = sorted(set(m for r in runs for m in r['backends']))
+    if eager:
+        print('imported before the window was shown: %s' %', '.join(eager))
+        failed = True
+    if median > args.budget:
+        print('over budget by %.2f s' %(median - args.budget))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+'''Synthetic files for the benchmarks (see synthetic.py)
+
+run with ``python -m pytest benchmarks`` (needs pytest-benchmark); save a
+run with ``--benchmark-autosave`` and check a new one against it with
+``--benchmark-compare --benchmark-compare-fail=min:20%``
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import write_scan, write_empty_files
+import pattern_io as pio
+
+
+def pytest_addoption(parser):
+    parser.addoption('--files', type=int, default=20000, help='empty files for listing and sorting')
+    parser.addoption('--compression', choices=['gzip', 'lzf'], help='hdf5 compression of the synthetic files')
+
+
+@pytest.fixture(scope='session')
+def scan(tmp_path_factory, request):
+    '''file names of the synthetic scan by kind, ``empty`` is a folder of
+    empty cbf files'''
+    folder = str(tmp_path_factory.mktemp('scan'))
+    empty = os.path.join(folder, 'empty')
+    os.mkdir(empty)
+    write_empty_files(empty, request.config.getoption('--files', 20000))
+    names = write_scan(folder, np.random.default_rng(0), compression=request.config.getoption('--compression', None))
+    names['empty'] = empty
+    yield names
+    pio.h5_pool.close()
+
+
+@pytest.fixture(scope='session')
+def frames(scan):
+    '''first frame of each detector, the nexus files are open'''
+    r = pio.LambdaReader(scan['lambda'])
+    r.open()
+    r3 = pio.Lambda3MReader(scan['lambda3m'])
+    r3.open()
+    yield {'cbf': pio.CBFreader(scan['cbf'][0]), 'lambda': pio.LambdaItem(r, 0), 'lambda3m': pio.LambdaItem(r3, 0)}
+    r.close()
+    r3.close()
@@ -0,0 +1,77 @@
+'''Synthetic detector files for the benchmarks
+
+* Pilatus cbf files (byte offset compressed, -1 in the module gaps)
+* single module Lambda NeXus files (/entry/instrument/detector/data)
+* Lambda 3M files, one NeXus file per module (<prefix>_m01.nxs, ...)
+
+The frames have a Poisson background and a few strong Bragg peaks.
+'''
+import os
+import sys
+
+import numpy as np
+import h5py
+from fabio.cbfimage import CbfImage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pattern_io import LAMBDA_3M
+
+
+def detector_frame(shape, rng, dtype=np.int32):
+    data = rng.poisson(20, shape).astype(dtype)
+    peaks = rng.integers(0, data.size, 200)
+    data.flat[peaks] = rng.integers(1000, 1000000, len(peaks))
+    return data
+
+
+def pilatus_frame(shape, rng):
+    data = detector_frame(shape, rng)
+    # modules are 487x195 pixel with gaps of 7 and 17 pixel
+    for x in range(487, shape[1], 494):
+        data[:, x:x+7] = -1
+    for y in range(195, shape[0], 212):
+        data[y:y+17, :] = -1
+    return data
+
+
+def write_cbf(fname, data):
+    CbfImage(data=data).write(fname)
+
+
+def write_nexus(fname, frames, compression=None):
+    '''frames (frames, y, x) in the dataset of Lambda NeXus files, one
+    chunk per frame'''
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('/entry/instrument/detector/data', data=frames,
+                         chunks=(1,) + frames.shape[1:], compression=compression)
+
+
+def write_lambda3m(prefix, nframes, rng, geometry=LAMBDA_3M, compression=None):
+    '''module files ``<prefix>_m01.nxs``, ... of ``geometry``'''
+    for m in range(geometry.modules):
+        frames = np.stack([detector_frame(geometry.tile, rng, np.uint32) for i in range(nframes)])
+        write_nexus('%s_m%02d.nxs' %(prefix, m+1), frames, compression)
+
+
+def write_scan(folder, rng, cbf_shape=(1043, 981), ncbf=8, nexus_frames=8, l3m_frames=4, compression=None):
+    '''a folder with cbf files, a Lambda and a Lambda 3M file
+
+    :returns: dict of the file names by kind
+    '''
+    names = {'cbf': [], 'lambda': None, 'lambda3m': None}
+    for i in range(ncbf):
+        fname = os.path.join(folder, 'bench_00001_%05d.cbf' %(i+1))
+        write_cbf(fname, pilatus_frame(cbf_shape, rng))
+        names['cbf'].append(fname)
+    names['lambda'] = os.path.join(folder, 'bench_00002_00001.nxs')
+    frames = np.stack([detector_frame(LAMBDA_3M.tile, rng, np.uint32) for i in range(nexus_frames)])
+    write_nexus(names['lambda'], frames, compression)
+    names['lambda3m'] = os.path.join(folder, 'bench_00003_00001')
+    write_lambda3m(names['lambda3m'], l3m_frames, rng, compression=compression)
+    return names
+
+
+def write_empty_files(folder, n):
+    '''``n`` empty cbf files, for listing and sorting'''
+    for i in range(n):
+        open(os.path.join(folder, 'empty_%05d_%05d.cbf' %(i // 1000 + 1, i % 1000 + 1)), 'w').close()
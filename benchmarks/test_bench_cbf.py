@@ -0,0 +1,46 @@
+'''Benchmarks of the cbf readers
+
+Synthetic Pilatus 1M and 2M frames (Poisson background, a few Bragg peaks
+and -1 in the gaps between the modules) read with
+
+* fabio.open
+* read_cbf, with the compiled byte offset decoder of fabio
+* read_cbf, with the numpy byte offset decoder
+'''
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+from synthetic import pilatus_frame, write_cbf
+import pattern_io as pio
+
+detectors = {'Pilatus 1M': (1043, 981), 'Pilatus 2M': (1679, 1475)}
+
+
+@pytest.fixture(scope='module', params=list(detectors))
+def cbf(request, tmp_path_factory):
+    '''(file name, frame) of a detector'''
+    data = pilatus_frame(detectors[request.param], np.random.default_rng(0))
+    fname = os.path.join(str(tmp_path_factory.mktemp('cbf')), 'frame.cbf')
+    write_cbf(fname, data)
+    return fname, data
+
+
+def test_fabio(benchmark, cbf):
+    fname, data = cbf
+    assert np.array_equal(benchmark(lambda: pio.fabio.open(fname).data), data)
+
+
+def test_read_cbf_compiled(benchmark, cbf):
+    if pio._dec_cbf32() is None:
+        pytest.skip('no compiled decoder')
+    fname, data = cbf
+    assert np.array_equal(benchmark(pio.read_cbf, fname), data)
+
+
+def test_read_cbf_numpy(benchmark, cbf, monkeypatch):
+    monkeypatch.setattr(pio, '_dec_cbf32', lambda: None)
+    fname, data = cbf
+    assert np.array_equal(benchmark(pio.read_cbf, fname), data)
@@ -0,0 +1,142 @@
+'''Benchmarks of the readers and the display pipeline
+
+* listing and sorting a folder of empty cbf files
+* CBFreader, LambdaReader and Lambda3MReader (open and first frame)
+* masking, transform, scale, mipmap, levels and the azimuthal integration
+* ``PatternViewerWidget._set_pattern`` (offscreen Qt) for each detector
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+import pattern_io as pio
+
+kinds = ('cbf', 'lambda', 'lambda3m')
+rounds = 10
+
+
+def uncached(frame):
+    '''frame read without frame_cache and h5_pool'''
+    def read():
+        pio.h5_pool.close()
+        pio.decode_frame(frame)
+    return read
+
+
+def test_listing(benchmark, scan):
+    def listing():
+        files = pio.FileIndex()
+        files.append(pio.iter_pattern_files(os.path.join(scan['empty'], '*.cbf')))
+        return files
+    assert len(benchmark(listing))
+
+
+def test_sorting(benchmark, scan):
+    files = pio.FileIndex()
+    files.append(pio.iter_pattern_files(os.path.join(scan['empty'], '*.cbf')))
+    benchmark(files.sort)
+
+
+@pytest.mark.parametrize('kind', ['lambda', 'lambda3m'])
+def test_open(benchmark, scan, kind):
+    r = pio.LambdaReader(scan[kind]) if kind == 'lambda' else pio.Lambda3MReader(scan[kind])
+    benchmark.pedantic(r.open, setup=pio.h5_pool.close, rounds=rounds)
+    r.close()
+
+
+@pytest.mark.parametrize('kind', kinds)
+def test_read(benchmark, frames, kind):
+    frame = frames[kind]
+    setup = getattr(frame, 'reader', None)
+    benchmark.pedantic(uncached(frame), setup=setup.open if setup is not None else None, rounds=rounds)
+
+
+@pytest.mark.parametrize('kind', kinds)
+def test_mask(benchmark, frames, kind):
+    data = frames[kind].image().astype(np.float64)
+    geometry = getattr(frames[kind], 'geometry', None)
+    benchmark(lambda: pio.detector_masks.apply(data.copy(), geometry))
+
+
+@pytest.fixture
+def pipeline(frames, request):
+    pipeline = pio.DisplayPipeline()
+    pipeline.frame = pio.decode_frame(frames[request.param])
+    return pipeline
+
+
+@pytest.mark.parametrize('pipeline', kinds, indirect=True)
+def test_transform(benchmark, pipeline):
+    def transform():
+        pipeline.transform = 'None'
+        pipeline.transform = 'rotate 90'
+        pipeline.pattern
+    benchmark(transform)
+
+
+@pytest.mark.parametrize('pipeline', kinds, indirect=True)
+def test_scale(benchmark, pipeline):
+    def scale():
+        pipeline.scale = 'lin'
+        pipeline.scale = 'log10'
+        pipeline.display()
+    benchmark(scale)
+
+
+@pytest.mark.parametrize('pipeline', kinds, indirect=True)
+def test_mipmap(benchmark, pipeline):
+    data = pipeline.frame
+    def mipmap():
+        pipeline.frame = data
+        pipeline.mipmap(pipeline.mipmap_levels() - 1)
+    benchmark(mipmap)
+
+
+@pytest.mark.parametrize('kind', kinds)
+def test_levels(benchmark, frames, kind):
+    data = pio.decode_frame(frames[kind])
+    levels = pio.LevelsEngine()
+    benchmark(lambda: levels.levels(data, 'log10'))
+
+
+@pytest.mark.parametrize('kind', kinds)
+def test_integrate(benchmark, frames, kind):
+    data = pio.decode_frame(frames[kind])
+    integrator = pio.AzimuthalIntegrator(center=(data.shape[0] / 2., data.shape[1] / 2.), bins=500)
+    # the lookup is built once per frame shape
+    integrator.integrate(data)
+    x, y = benchmark(integrator.integrate, data)
+    assert len(y) == 500
+
+
+@pytest.fixture(scope='module')
+def widget():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    pytest.importorskip('PyQt5.QtWidgets')
+    from PyQt5.QtWidgets import QApplication
+    import pattern_viewer
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    widget = pattern_viewer.PatternViewerWidget()
+    widget.resize(1000, 700)
+    widget.show()
+    app.processEvents()
+    yield widget
+    widget.close()
+
+
+@pytest.mark.parametrize('kind', kinds)
+def test_set_pattern(benchmark, widget, frames, kind):
+    '''``_set_pattern`` with a new frame, like moving through a scan'''
+    frame = frames[kind]
+    data = pio.decode_frame(frame)
+    def new_frame():
+        widget.pattern = widget.pattern_o = data
+        widget.pipeline.frame = data
+        widget._frame_key = pio.frame_key(frame) + (time.perf_counter(),)
+        widget._geometry = getattr(frame, 'geometry', None)
+        widget.new = True
+    benchmark.pedantic(widget._set_pattern, setup=new_frame, rounds=rounds)
@@ -0,0 +1,246 @@
+'''Headless export of scattering patterns
+
+Converts all frames found for a path (glob pattern or folder, as in the
+viewer) to TIFF, NPY or HDF5, with the transforms and scales of the
+viewer.  The frames are read and processed on a pool of processes; Qt is
+not needed.
+
+usage: python pattern_batch.py "data/scan/*.cbf" -o out -f tiff -s log10
+'''
+import sys
+import os
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import h5py
+from PIL import Image
+
+from pattern_io import (FileIndex, ScanIndex, DisplayPipeline, CBFreader, LambdaItem,
+                        entry_reader, iter_pattern_files, h5_pool, detector_masks, decode_frame,
+                        instrument)
+
+formats = {'tiff': '.tiff', 'npy': '.npy', 'hdf5': '.h5'}
+
+
+def collect_files(name):
+    '''sorted ``FileIndex`` for a glob pattern or a folder, folders use
+    their scan index like the viewer'''
+    if os.path.isdir(name):
+        name = os.path.join(name, '')
+    if any([i in name for i in '[*?']):
+        files = FileIndex()
+        files.append(iter_pattern_files(name))
+        files.sort()
+        return files
+    index = ScanIndex(os.path.dirname(name) or os.curdir)
+    files, paths = index.load()
+    if files.append(paths):
+        files.sort()
+    if index.dirty:
+        index.save(files, wait=True)
+    return files
+
+
+def collect_frames(files):
+    '''(kind, path, frame, output name) of all frames in sorted order,
+    frame is None for cbf files'''
+    frames = []
+    for entry in files.order:
+        kind = files.kind[entry]
+        path = files.path(entry)
+        if kind == FileIndex.CBF:
+            frames.append((kind, path, None, os.path.splitext(files.display_name(entry))[0]))
+            continue
+        r = entry_reader(files, entry)
+        try:
+            r.open()
+        except (OSError, KeyError, ValueError) as e:
+            print('skipping %s: %s' %(path, e))
+            continue
+        name = os.path.splitext(r.name)[0]
+        frames.extend((kind, path, i, name + '_%05d' %(i+1)) for i in r.images)
+        r.close()
+    # the workers open the files themselves
+    h5_pool.close()
+    return frames
+
+
+_readers = {}
+_pipeline = None
+
+
+def _init_worker(transform, scale, verbose, masks=(), masked=True):
+    global _pipeline
+    _pipeline = DisplayPipeline()
+    _pipeline.transform = transform
+    _pipeline.scale = scale
+    detector_masks.set_enabled(masked)
+    for fname in masks:
+        detector_masks.load(fname)
+    instrument.trace = instrument.trace or verbose
+
+
+def _frame(kind, path, idx):
+    if kind == FileIndex.CBF:
+        return CBFreader(path)
+    r = _readers.get(path)
+    if r is None:
+        files = FileIndex()
+        files.append([path if kind == FileIndex.LAMBDA else path + '_m01.nxs'])
+        r = _readers[path] = entry_reader(files, 0)
+    if not r.is_open:
+        r.open()
+    return LambdaItem(r, idx)
+
+
+def write_frame(fname, data, fmt, scale='lin'):
+    '''write a single frame, TIFF files are oriented as shown in the viewer
+    (like its export), 32 bit integers for the linear scale with masked
+    pixels as -1
+
+    :returns: number of bytes written
+    '''
+    if fmt == 'tiff':
+        if scale == 'lin':
+            data = np.where(np.isnan(data), -1, data)
+            img = Image.fromarray(np.ascontiguousarray(data.T, dtype=np.int32), 'I')
+        else:
+            img = Image.fromarray(np.ascontiguousarray(data.T, dtype=np.float32), 'F')
+        img.save(fname, compression='tiff_lzw')
+    else:
+        np.save(fname, data)
+    return os.path.getsize(fname)
+
+
+def _process(tasks, output, fmt):
+    '''read, transform and scale a batch of frames in a worker process
+
+    TIFF and NPY files are written by the worker, for HDF5 the arrays are
+    returned to the parent which owns the output file.
+    '''
+    results = []
+    for n, kind, path, idx, name in tasks:
+        try:
+            _pipeline.frame = decode_frame(_frame(kind, path, idx))
+            data = _pipeline.display()
+            if fmt == 'hdf5':
+                results.append((n, name, data.nbytes, np.array(data), None))
+            else:
+                fname = os.path.join(output, name + formats[fmt])
+                results.append((n, name, data.nbytes, write_frame(fname, data, fmt, _pipeline.scale), None))
+        except Exception as e:
+            results.append((n, name, 0, None, '%s: %s' %(type(e).__name__, e)))
+    return results
+
+
+class HDF5Writer:
+    '''frames in one dataset ``/data`` of shape (frames, y, x) with one
+    chunk per frame, names in ``/names``; frames of another shape than the
+    first are skipped'''
+    def __init__(self, fname, nframes, compression=None):
+        self.file = h5py.File(fname, 'w')
+        self.nframes = nframes
+        self.compression = compression
+        self.data = None
+        self.names = self.file.create_dataset('names', (nframes,), dtype=h5py.string_dtype())
+
+    def write(self, n, name, data):
+        if self.data is None:
+            self.data = self.file.create_dataset('data', (self.nframes,) + data.shape, dtype=np.float32,
+                                                 chunks=(1,) + data.shape, compression=self.compression)
+        if data.shape != self.data.shape[1:]:
+            raise ValueError('shape %s differs from %s' %(data.shape, self.data.shape[1:]))
+        self.data[n] = data
+        self.names[n] = name
+        return data.nbytes
+
+    def close(self):
+        self.file.close()
+
+
+def export(frames, output, fmt='tiff', transform='None', scale='lin', jobs=None,
+           batch=8, verbose=False, compression=None, masks=(), masked=True):
+    '''export frames (see ``collect_frames``) on a process pool
+
+    :returns: (frames exported, errors, bytes decoded, bytes written, seconds)
+    '''
+    if fmt == 'hdf5':
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        writer = HDF5Writer(output, len(frames), compression)
+    else:
+        os.makedirs(output, exist_ok=True)
+        writer = None
+    tasks = [(n,) + f for n, f in enumerate(frames)]
+    # spawn, not fork: forked children would inherit open hdf5 handles
+    context = multiprocessing.get_context('spawn')
+    done = errors = decoded = written = 0
+    t = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init_worker,
+                                 initargs=(transform, scale, verbose, masks, masked)) as pool:
+            futures = [pool.submit(_process, tasks[i:i+batch], output, fmt)
+                       for i in range(0, len(tasks), batch)]
+            for future in as_completed(futures):
+                for n, name, nbytes, result, error in future.result():
+                    if error is None and writer is not None:
+                        try:
+                            result = writer.write(n, name, result)
+                        except ValueError as e:
+                            error = str(e)
+                    if error is not None:
+                        errors += 1
+                        print('\n%s: %s' %(name, error), file=sys.stderr)
+                        continue
+                    done += 1
+                    decoded += nbytes
+                    written += result
+                dt = time.perf_counter() - t
+                print('\r%d/%d frames, %.1f frames/s' %(done+errors, len(tasks), done/dt),
+                      end='', file=sys.stderr, flush=True)
+    finally:
+        if writer is not None:
+            writer.close()
+    print(file=sys.stderr)
+    return done, errors, decoded, written, time.perf_counter() - t
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export scattering patterns without the viewer.')
+    parser.add_argument('path', help='glob pattern or folder (all pattern files in it)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output folder, the output file for hdf5')
+    parser.add_argument('-f', '--format', choices=list(formats), default='tiff')
+    parser.add_argument('-t', '--transform', choices=list(DisplayPipeline.transforms), default='None')
+    parser.add_argument('-s', '--scale', choices=DisplayPipeline.scales, default='lin')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--batch', type=int, default=8, help='frames per task')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], help='hdf5 compression')
+    parser.add_argument('-m', '--mask', action='append', default=[],
+                        help='mask file, nonzero pixels are masked (nan, -1 in integer tiff)')
+    parser.add_argument('--no-mask', action='store_true',
+                        help='keep gaps, negative and overflowing pixels')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the files opened by the workers')
+    args = parser.parse_args(argv)
+
+    files = collect_files(args.path)
+    frames = collect_frames(files)
+    if not frames:
+        print('no frames found for %s' %args.path)
+        return 1
+    print('exporting %d frames from %d files' %(len(frames), len(files)))
+    done, errors, decoded, written, dt = export(frames, args.output, args.format, args.transform,
+                                                args.scale, args.jobs, args.batch, args.verbose,
+                                                args.compression, args.mask, not args.no_mask)
+    print('%d frames in %.2f s: %.1f frames/s, %.1f MB/s decoded, %.1f MB/s written'
+          %(done, dt, done/dt, decoded/dt/1e6, written/dt/1e6))
+    if errors:
+        print('%d frames failed' %errors)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
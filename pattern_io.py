@@ -0,0 +1,2729 @@
+'''Reading, indexing and processing of scattering patterns
+
+Everything that does not need Qt, shared by the viewer and the batch
+export (``pattern_batch.py``).
+'''
+import sys
+import glob
+import functools
+import importlib
+import os
+import re
+import hashlib
+import json
+import mmap
+import struct
+import zlib
+import itertools
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+
+def user_cache_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'pattern_viewer')
+
+
+def user_config_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('APPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+    return os.path.join(base, 'pattern_viewer')
+
+
+class Instrumentation:
+    '''Timing spans of the read and display path
+
+    Spans are named stages (listing, sorting, open, decode, transform,
+    scale, mipmap, levels, render, integrate).  While ``enabled``, the
+    count, total, last and maximum duration of each name and the last
+    ``max_events`` events are kept, otherwise recording costs a flag test.
+    ``trace`` switches the messages about opened and closed files on, it is
+    set by the environment variable PATTERN_VIEWER_TRACE.
+    '''
+    def __init__(self, max_events=10000):
+        self.enabled = False
+        self.trace = bool(os.environ.get('PATTERN_VIEWER_TRACE'))
+        self.stats = OrderedDict()
+        self.events = deque(maxlen=max_events)
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, start=None):
+        '''add a span of ``seconds`` that started at ``start`` (perf_counter)'''
+        if not self.enabled:
+            return
+        with self._lock:
+            s = self.stats.get(name)
+            if s is None:
+                s = self.stats[name] = {'count': 0, 'total': 0., 'last': 0., 'max': 0.}
+            s['count'] += 1
+            s['total'] += seconds
+            s['last'] = seconds
+            s['max'] = max(s['max'], seconds)
+            if start is None:
+                start = time.perf_counter() - seconds
+            self.events.append((name, start - self._t0, seconds, threading.current_thread().name))
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t, t)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.events.clear()
+
+    def timed(self, name):
+        '''decorator recording each call of a function as span ``name``'''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        '''statistics per span name in ms'''
+        with self._lock:
+            return OrderedDict((name, {'count': s['count'], 'mean_ms': 1000*s['total']/s['count'],
+                                       'last_ms': 1000*s['last'], 'max_ms': 1000*s['max'],
+                                       'total_ms': 1000*s['total']})
+                               for name, s in self.stats.items())
+
+    def status(self, names=None):
+        '''one line with the last duration of each span'''
+        with self._lock:
+            return ' | '.join('%s %.1f ms' %(name, 1000*s['last']) for name, s in self.stats.items()
+                              if names is None or name in names)
+
+    def dump(self, fname):
+        '''write summary and events as JSON'''
+        with self._lock:
+            events = [{'name': n, 'start_ms': 1000*t, 'duration_ms': 1000*d, 'thread': th}
+                      for n, t, d, th in self.events]
+        with open(fname, 'w') as f:
+            json.dump({'summary': self.summary(), 'events': events}, f, indent=1)
+
+
+instrument = Instrumentation()
+
+
+def trace(msg):
+    '''debug message, only printed if ``instrument.trace`` is set'''
+    if instrument.trace:
+        print(msg)
+
+
+class LazyModule:
+    '''Module imported on first attribute access
+
+    The format backends take longer to import than the rest of the
+    viewer, so they are only imported when the first file is read (or by
+    ``warm_up`` in the background).
+
+    :param name: module name, e.g. ``'h5py'``
+    :type name: string
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+
+    def __repr__(self):
+        return '<LazyModule %s%s>' %(self.name, '' if self._module is None else ' (imported)')
+
+    def load(self):
+        ''':returns: the imported module'''
+        if self._module is None:
+            t = time.perf_counter()
+            # the import lock makes concurrent first uses wait for one import
+            self._module = importlib.import_module(self.name)
+            instrument.record('import', time.perf_counter() - t, t)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+h5py = LazyModule('h5py')
+fabio = LazyModule('fabio')
+# PIL is only needed for exports
+Image = LazyModule('PIL.Image')
+TiffImagePlugin = LazyModule('PIL.TiffImagePlugin')
+
+
+def warm_up(modules=(h5py, fabio)):
+    '''import lazy modules in a daemon thread
+
+    :returns: the thread
+    '''
+    def load():
+        for module in modules:
+            try:
+                module.load()
+            except ImportError as e:
+                print('import of %s failed: %s' %(module.name, e))
+    thread = threading.Thread(target=load, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+@functools.lru_cache(maxsize=None)
+def _dec_cbf32():
+    # compiled byte offset decoder of fabio, None if not available
+    try:
+        from fabio.ext.byte_offset import dec_cbf32
+    except ImportError:
+        return None
+    return dec_cbf32
+
+
+@functools.lru_cache(maxsize=None)
+def _imageio():
+    # optional, mp4 export with imageio and its ffmpeg plugin
+    try:
+        import imageio.v2 as imageio
+        import imageio_ffmpeg
+    except ImportError:
+        return None
+    return imageio
+
+
+@functools.lru_cache(maxsize=None)
+def _sparse():
+    # optional, sparse matrices for pixel splitting in AzimuthalIntegrator
+    try:
+        import scipy.sparse
+    except ImportError:
+        return None
+    return scipy.sparse
+
+_cbf_binary_start = b'\x0c\x1a\x04\xd5'
+
+_cbf_element_types = {b'signed 32-bit integer': np.int32,
+                      b'unsigned 32-bit integer': np.uint32,
+                      b'signed 16-bit integer': np.int16,
+                      b'unsigned 16-bit integer': np.uint16,
+                      b'signed 8-bit integer': np.int8,
+                      b'unsigned 8-bit integer': np.uint8}
+
+
+def _cbf_header_value(header, key):
+    m = re.search(rb'^' + key + rb':\s*"?([^"\r\n]*?)"?\s*$', header, re.M)
+    if m is None:
+        raise ValueError('no %s in cbf header' %key.decode())
+    return m.group(1)
+
+
+def decode_byte_offset(raw, n):
+    '''decode a CBF byte offset compressed stream
+
+    The escapes (a -128 byte announcing a 16 bit, then a 32 and 64 bit
+    delta) are located and decoded with array operations.  Only escapes
+    that start inside the payload of an earlier escape need to be resolved
+    one by one, which is rare.
+
+    :param raw: compressed data
+    :type raw: int8 array
+    :param n: number of values, the stream may hold more
+    :returns: int32 array of the decoded values
+    '''
+    u8 = raw.view(np.uint8)
+    last = len(raw) - 1
+    def read(pos, nbytes):
+        # little endian signed integers at the byte positions ``pos``
+        v = np.zeros(len(pos), dtype=np.uint64)
+        for i in range(nbytes):
+            v |= u8[np.minimum(pos+i, last)].astype(np.uint64) << np.uint64(8*i)
+        return v.astype('u%d' %nbytes).view('i%d' %nbytes).astype(np.int64)
+
+    cand = np.flatnonzero(raw == -128)
+    value = read(cand+1, 2)
+    length = np.full(len(cand), 3, dtype=np.int64)
+    wide = np.flatnonzero(value == -0x8000)
+    if len(wide):
+        value[wide] = read(cand[wide]+3, 4)
+        length[wide] = 7
+        wider = wide[value[wide] == -0x80000000]
+        if len(wider):
+            value[wider] = read(cand[wider]+7, 8)
+            length[wider] = 15
+    end = cand + length
+
+    # a candidate behind the end of every earlier candidate is an escape,
+    # the others may be payload of an earlier escape
+    reach = np.maximum.accumulate(end)
+    ambiguous = np.zeros(len(cand), dtype=bool)
+    ambiguous[1:] = cand[1:] < reach[:-1]
+    valid = ~ambiguous
+    if ambiguous.any():
+        # end of the last unambiguous escape before each candidate
+        before = np.maximum.accumulate(np.where(valid, end, 0))
+        before = np.concatenate([[0], before[:-1]])
+        cover = 0
+        for i in np.flatnonzero(ambiguous).tolist():
+            cover = max(cover, before[i])
+            if cand[i] >= cover:
+                valid[i] = True
+                cover = end[i]
+    cand, value, length = cand[valid], value[valid], length[valid]
+
+    # drop the payload bytes, the escape bytes take the decoded deltas
+    keep = np.ones(len(raw), dtype=bool)
+    if len(cand):
+        skip = length - 1
+        first = np.repeat(cand + 1 - np.cumsum(skip) + skip, skip)
+        keep[first + np.arange(len(first))] = False
+    deltas = raw[keep][:n].astype(np.int32)
+    if len(deltas) < n:
+        raise ValueError('byte offset stream too short')
+    # position of the escapes after dropping the payload, the stream may
+    # go on beyond the ``n`` values
+    pos = cand - np.cumsum(length - 1) + length - 1
+    inside = pos < n
+    deltas[pos[inside]] = value[inside]
+    return np.cumsum(deltas, dtype=np.int32)
+
+
+def read_cbf(fname, rows=None):
+    '''read a cbf file with a byte offset compressed or uncompressed image
+
+    The file is memory mapped, uncompressed data is returned as a view of
+    the map.  Byte offset data is decoded with the compiled decoder of
+    fabio if available, otherwise with ``decode_byte_offset``.  Anything
+    else raises ``ValueError``, use fabio for those.
+
+    :param fname: file name
+    :param rows: slice of rows, only the values up to its end are decoded
+    :returns: 2d image array
+    '''
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = mm.find(_cbf_binary_start)
+    section = mm.rfind(b'--CIF-BINARY-FORMAT-SECTION--', 0, start)
+    if start < 0 or section < 0:
+        mm.close()
+        raise ValueError('no binary section in %s' %fname)
+    header = mm[section:start]
+    try:
+        m = re.search(rb'conversions="([^"]*)"', header)
+        conversion = m.group(1) if m else b'x-CBF_NONE'
+        element_type = _cbf_header_value(header, b'X-Binary-Element-Type')
+        if element_type not in _cbf_element_types:
+            raise ValueError('unsupported element type %s' %element_type.decode())
+        dtype = _cbf_element_types[element_type]
+        if _cbf_header_value(header, b'X-Binary-Element-Byte-Order') != b'LITTLE_ENDIAN':
+            raise ValueError('big endian cbf')
+        size = int(_cbf_header_value(header, b'X-Binary-Size'))
+        n = int(_cbf_header_value(header, b'X-Binary-Number-of-Elements'))
+        shape = (int(_cbf_header_value(header, b'X-Binary-Size-Second-Dimension')),
+                 int(_cbf_header_value(header, b'X-Binary-Size-Fastest-Dimension')))
+        if shape[0]*shape[1] != n or start + 4 + size > len(mm):
+            raise ValueError('inconsistent cbf header')
+        if rows is None:
+            rows = slice(None)
+        if conversion == b'x-CBF_NONE':
+            return np.frombuffer(mm, dtype=np.dtype(dtype).newbyteorder('<'), count=n, offset=start+4).reshape(shape)[rows]
+        if conversion != b'x-CBF_BYTE_OFFSET' or dtype not in (np.int32, np.uint32):
+            raise ValueError('unsupported cbf conversion %s' %conversion.decode())
+        # the stream is decoded from the start, but not beyond the last row
+        stop = rows.indices(shape[0])[1]
+        n = max(stop, 0) * shape[1]
+        dec_cbf32 = _dec_cbf32()
+        if dec_cbf32 is not None:
+            # the compiled decoder only takes bytes, which copies the
+            # compressed stream (a small part of the decoding time)
+            data = dec_cbf32(mm[start+4:start+4+size], n).astype(np.int32, copy=False)
+        else:
+            raw = np.frombuffer(mm, dtype=np.int8, count=size, offset=start+4)
+            data = decode_byte_offset(raw, n)
+            del raw
+        mm.close()
+        data = data.reshape(-1, shape[1])[rows]
+        return data if dtype == np.int32 else data.view(np.uint32)
+    except ValueError:
+        if not mm.closed:
+            try:
+                mm.close()
+            except BufferError:
+                pass
+        raise
+
+
+class CBFreader:
+    '''Reader for CBF files
+
+    :param fname: file name of cbf file
+    :type fname: string
+
+    .. autoinstanceattribute:: map
+       :annotation:
+
+        array of the image
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.name = os.path.basename(self.fname)
+        self.path = self.fname
+        self.key = (self.path, 0)
+        self.geometry = None
+        self.file = None
+
+    def image(self):
+        trace('opening file %s' %self.name)
+        try:
+            return read_cbf(self.fname)
+        except ValueError:
+            self.file = fabio.open(self.fname)
+            return self.file.data
+    
+    def close(self):
+        # frames served from frame_cache never opened the file
+        if self.file is not None:
+            trace('closing file %s' %self.name)
+            self.file.close()
+            self.file = None
+
+
+class H5FilePool:
+    '''LRU pool of open hdf5 files
+
+    Readers get their files from the pool instead of opening and closing
+    them on every selection change.  The least recently used file is
+    closed when more than ``max_open`` files are open, readers notice that
+    their datasets became invalid and get the file again.  Files used in a
+    ``using`` block (e.g. read on a worker thread) are neither evicted nor
+    closed before the block is left.
+
+    :param max_open: maximum number of open files
+    :type max_open: int
+    :param rdcc_nbytes: size of the chunk cache of each file in bytes
+    :param rdcc_nslots: number of chunk cache slots, a prime number
+    :param swmr: open files in SWMR read mode if they support it, so
+                 files still written by the detector can be followed
+    '''
+    def __init__(self, max_open=16, rdcc_nbytes=32 * 2**20, rdcc_nslots=1031, swmr=True):
+        self.max_open = max_open
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.swmr = swmr
+        self._files = OrderedDict()
+        self._users = {}
+        self._closing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def _open(self, fname):
+        kwargs = dict(rdcc_nbytes=self.rdcc_nbytes, rdcc_nslots=self.rdcc_nslots)
+        if self.swmr:
+            try:
+                return h5py.File(fname, 'r', swmr=True, **kwargs)
+            except OSError:
+                # files written without SWMR support (old superblock)
+                pass
+        return h5py.File(fname, 'r', **kwargs)
+
+    def get(self, fname):
+        '''open h5py.File of ``fname``'''
+        return self.get_all([fname])[0]
+
+    def get_all(self, fnames):
+        '''open h5py.Files of ``fnames``, e.g. all modules of a detector,
+        none of them is closed to make room for the others'''
+        with self._lock:
+            return self._get_all(fnames)
+
+    @contextmanager
+    def using(self, fnames):
+        '''open h5py.Files of ``fnames`` (see ``get_all``), kept open until
+        the block is left'''
+        with self._lock:
+            files = self._get_all(fnames)
+            for fname in fnames:
+                self._users[fname] = self._users.get(fname, 0) + 1
+        try:
+            yield files
+        finally:
+            with self._lock:
+                for fname in fnames:
+                    self._users[fname] -= 1
+                    if not self._users[fname]:
+                        del self._users[fname]
+                        if fname in self._closing:
+                            self._close(fname)
+                self._evict(())
+
+    def _get_all(self, fnames):
+        files = []
+        for fname in fnames:
+            f = self._files.get(fname)
+            if f is not None and f.id.valid:
+                self._files.move_to_end(fname)
+            else:
+                trace('opening file %s' %os.path.basename(fname))
+                f = self._files[fname] = self._open(fname)
+            files.append(f)
+        self._evict(fnames)
+        return files
+
+    def _evict(self, keep):
+        excess = len(self._files) - self.max_open
+        for fname in list(self._files):
+            if excess <= 0:
+                break
+            if fname not in keep and fname not in self._users:
+                self._close(fname)
+                excess -= 1
+
+    def _close(self, fname):
+        self._closing.discard(fname)
+        f = self._files.pop(fname, None)
+        if f is not None:
+            trace('closing file %s' %os.path.basename(fname))
+            f.close()
+
+    def close(self, fname=None):
+        '''close ``fname`` or all files, files in use once they are released'''
+        with self._lock:
+            for name in ([fname] if fname is not None else list(self._files)):
+                if name in self._users:
+                    self._closing.add(name)
+                else:
+                    self._close(name)
+
+
+h5_pool = H5FilePool()
+
+
+class LambdaReader:
+    def __init__(self, fname):
+        self.fname = fname
+        self.name = os.path.basename(self.fname)
+        self.path = self.fname
+        self.is_open = False
+        # replacing the file and dataset of an evicted file
+        self._lock = threading.Lock()
+
+    @instrument.timed('open')
+    def open(self):
+        self._mtime = os.stat(self.fname).st_mtime_ns
+        self.file = h5_pool.get(self.fname)
+        self.data = self.file['/entry/instrument/detector/data']
+        self._handle = (self.file, self.data)
+        self.images = range(self.data.shape[0])
+        self.is_open = True
+
+    def refresh(self):
+        '''update the number of frames of a file still being written
+
+        :returns: True if the file changed
+        '''
+        if os.stat(self.fname).st_mtime_ns == self._mtime:
+            return False
+        with h5_pool.using([self.fname]) as (f,):
+            if f.swmr_mode:
+                self._mtime = os.stat(self.fname).st_mtime_ns
+                self.file, self.data = self._handle = f, f['/entry/instrument/detector/data']
+                self.data.refresh()
+                self.images = range(self.data.shape[0])
+                return True
+        # without SWMR the cached metadata is only updated by reopening
+        h5_pool.close(self.fname)
+        self.open()
+        return True
+
+    def close(self):
+        # the file stays in h5_pool
+        self.is_open = False
+
+    def image(self, idx):
+        with h5_pool.using([self.fname]) as (f,):
+            # file and dataset are replaced together, other threads read too
+            with self._lock:
+                file, data = self._handle
+                if f is not file:
+                    # evicted from h5_pool and opened again
+                    data = f['/entry/instrument/detector/data']
+                    self._handle = (f, data)
+            return data[idx]
+
+class LambdaItem:
+    def __init__(self, reader, item):
+        self.reader = reader
+        self.item = item
+        self.name = self.reader.name + '_%05d' %(item+1)
+        self.key = (self.reader.path, item)
+        # stitched detectors (Lambda 3M) have a geometry
+        self.geometry = getattr(reader, 'geometry', None)
+
+    def image(self):
+        return self.reader.image(self.item)
+
+class DetectorGeometry:
+    '''Layout of a detector with one file per module
+
+    The modules are placed into the stitched image at their offsets, the
+    pixels not covered by a module (gaps) get ``fill``.  The gaps are kept
+    as rectangles so clearing them is a few slice assignments.
+
+    Additional layouts are read from ``detectors.json`` in the user config
+    directory, a list of objects with the keyword arguments below.
+
+    :param name: detector name
+    :type name: string
+    :param shape: (rows, columns) of the stitched image
+    :param tile: (rows, columns) of a module
+    :param offsets: (row, column) of the upper left corner of each module,
+                    in the order of the module files (_m01.nxs, _m02.nxs, ...)
+    :param fill: value of the gap pixels, e.g. nan
+    :type fill: float
+    '''
+    def __init__(self, name, shape, tile, offsets, fill=0.):
+        self.name = name
+        self.shape = tuple(shape)
+        self.tile = tuple(tile)
+        self.offsets = [tuple(o) for o in offsets]
+        self.fill = float(fill)
+        self.modules = len(self.offsets)
+        self.slices = [np.s_[y:y+self.tile[0], x:x+self.tile[1]] for y, x in self.offsets]
+        self.gaps = self._gap_rectangles()
+        self._gap_mask = None
+
+    def __repr__(self):
+        return '<DetectorGeometry %s, %d modules>' %(self.name, self.modules)
+
+    def _gap_rectangles(self):
+        # split the image into bands of rows at the module edges, in each
+        # band the gaps are the columns not covered by a module
+        th, tw = self.tile
+        edges = sorted(set([0, self.shape[0]] + [y for y, _ in self.offsets] + [y+th for y, _ in self.offsets]))
+        gaps = []
+        for y0, y1 in zip(edges, edges[1:]):
+            if y1 > self.shape[0]:
+                break
+            cols = sorted((x, x+tw) for y, x in self.offsets if y < y1 and y+th > y0)
+            x0 = 0
+            for c0, c1 in cols:
+                if c0 > x0:
+                    gaps.append(np.s_[y0:y1, x0:c0])
+                x0 = max(x0, c1)
+            if x0 < self.shape[1]:
+                gaps.append(np.s_[y0:y1, x0:self.shape[1]])
+        return gaps
+
+    def stitch(self, dsets, idx, out=None, pool=None):
+        '''read frame ``idx`` of the module datasets into the stitched image
+
+        The modules are read with ``read_direct`` into their place in
+        ``out`` (float32 of ``shape``, allocated if not given), only the gaps
+        are filled, so each pixel is written once.  With a thread pool the
+        modules are read in parallel.
+        '''
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        for gap in self.gaps:
+            out[gap] = self.fill
+        def read(m):
+            dsets[m].read_direct(out, source_sel=np.s_[idx], dest_sel=self.slices[m])
+        if pool is None:
+            for m in range(self.modules):
+                read(m)
+        else:
+            list(pool.map(read, range(self.modules)))
+        return out
+
+    def assemble(self, tiles):
+        '''stitched image of per module images, e.g. sums over frames'''
+        dtype = tiles[0].dtype
+        if not float(self.fill).is_integer():
+            dtype = np.result_type(dtype, np.float32)
+        out = np.full(self.shape, self.fill, dtype=dtype)
+        for m, tile in enumerate(tiles):
+            out[self.slices[m]] = tile
+        return out
+
+    def gap_mask(self):
+        '''boolean image, True in the gaps (shared, do not modify)'''
+        if self._gap_mask is None:
+            self._gap_mask = np.zeros(self.shape, dtype=bool)
+            for gap in self.gaps:
+                self._gap_mask[gap] = True
+        return self._gap_mask
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as f:
+            return [cls(**d) for d in json.load(f)]
+
+
+## initial layout from A.R., the stitching code is from  Andre Rothkirch <andre.rothkirch@desy.de>
+LAMBDA_3M = DetectorGeometry('Lambda 3M', shape=(1834, 3147), tile=(516, 1556),
+                             offsets=[(1311, 0), (0, 1587), (658, 1591), (1318, 1584)])
+
+_detector_geometries = None
+
+
+def detector_geometries():
+    '''known multi module layouts, the built-in ones and those from detectors.json'''
+    global _detector_geometries
+    if _detector_geometries is None:
+        _detector_geometries = [LAMBDA_3M]
+        fname = os.path.join(user_config_dir(), 'detectors.json')
+        if os.path.exists(fname):
+            try:
+                _detector_geometries = DetectorGeometry.load(fname) + _detector_geometries
+            except (OSError, ValueError, TypeError) as e:
+                print('ignoring %s: %s' %(fname, e))
+    return _detector_geometries
+
+
+_stitch_pool = None
+_stitch_lock = threading.Lock()
+
+
+def stitch_pool():
+    '''thread pool reading the modules of stitched frames, shared by all
+    ``Lambda3MReader`` instances'''
+    global _stitch_pool
+    with _stitch_lock:
+        if _stitch_pool is None:
+            _stitch_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='stitch')
+        return _stitch_pool
+
+
+class Lambda3MReader:
+    '''Reader for detectors with one nexus file per module (Lambda 3M)
+
+    :param fname: common prefix of the module files ``<fname>_m01.nxs``, ...
+    :type fname: string
+    :param geometry: module layout, by default the first known layout
+                     matching the number and size of the modules
+    :type geometry: DetectorGeometry
+    '''
+    def __init__(self, fname, geometry=None):
+        self.fname = fname
+        self.name = os.path.basename(self.fname)
+        self.path = self.fname + '_m01.nxs'
+        self.geometry = geometry
+        self.is_open = False
+        # replacing the files and datasets of evicted files
+        self._lock = threading.Lock()
+
+    @instrument.timed('open')
+    def open(self):
+        # hdf5 convention is [z,y,x]
+        self._fnames = sorted(glob.glob(glob.escape(self.fname) + '_m[0-9][0-9].nxs'))
+        self._mtimes = [os.stat(fname).st_mtime_ns for fname in self._fnames]
+        files = h5_pool.get_all(self._fnames)
+        self.dsets = [f['/entry/instrument/detector/data'] for f in files]
+        self._handles = (files, self.dsets)
+        if self.geometry is None:
+            for g in detector_geometries():
+                if g.modules == len(self.dsets) and all(d.shape[1:] == g.tile for d in self.dsets):
+                    self.geometry = g
+                    break
+            else:
+                raise ValueError('no detector layout for %d modules of %s' %(len(self.dsets), self.name))
+        self.images = range(min(d.shape[0] for d in self.dsets))
+        self.is_open = True
+
+    def close(self):
+        # the files stay in h5_pool
+        self.is_open = False
+
+    def refresh(self):
+        '''update the number of frames of files still being written
+
+        :returns: True if the files changed
+        '''
+        mtimes = [os.stat(fname).st_mtime_ns for fname in self._fnames]
+        if mtimes == self._mtimes:
+            return False
+        with h5_pool.using(self._fnames) as files:
+            if all(f.swmr_mode for f in files):
+                self._mtimes = mtimes
+                self.dsets = [f['/entry/instrument/detector/data'] for f in files]
+                self._handles = (files, self.dsets)
+                for d in self.dsets:
+                    d.refresh()
+                self.images = range(min(d.shape[0] for d in self.dsets))
+                return True
+        for fname in self._fnames:
+            h5_pool.close(fname)
+        self.open()
+        return True
+
+    def image(self, idx, out=None, threads=True):
+        '''stitched frame ``idx``, the modules are read on ``stitch_pool``
+        unless ``threads`` is False (e.g. on threads of another pool)'''
+        with h5_pool.using(self._fnames) as files:
+            # files and datasets are replaced together, other threads read too
+            with self._lock:
+                opened, dsets = self._handles
+                if any(f is not g for f, g in zip(files, opened)):
+                    # evicted from h5_pool and opened again
+                    dsets = [f['/entry/instrument/detector/data'] for f in files]
+                    self._handles = (files, dsets)
+            # for lambda, float32 is sufficient
+            try:
+                return self.geometry.stitch(dsets, idx, out=out, pool=stitch_pool() if threads else None)
+            except RuntimeError:
+                if not threads:
+                    raise
+                # the pool is shut down at interpreter exit
+                return self.geometry.stitch(dsets, idx, out=out)
+
+
+class FrameCache:
+    '''LRU cache of decoded frames with a memory budget
+
+    Frames are evicted by size, least recently used first.  Keys include the
+    modification time of the file, so rewritten files are read again.
+
+    :param max_bytes: memory budget for the cached arrays
+    :type max_bytes: int
+    '''
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        # shared by the GUI and the prefetch threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __repr__(self):
+        return '<FrameCache %d frames, %.1f/%.1f MB, %d hits, %d misses>' %(
+            len(self), self.nbytes/2**20, self.max_bytes/2**20, self.hits, self.misses)
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._frames.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+
+frame_cache = FrameCache()
+
+
+def frame_key(frame):
+    '''cache key of a frame, changes when its file is modified'''
+    try:
+        mtime = os.stat(frame.key[0]).st_mtime_ns
+    except OSError:
+        mtime = None
+    return frame.key + (mtime,)
+
+
+class DetectorMasks:
+    '''Bad pixel masks, applied once when a frame is decoded
+
+    Masked pixels are set to nan, so scaling, levels, mipmaps and export
+    skip them without a separate mask.  Pixels are masked by
+
+    * mask files (nonzero pixels, any format fabio reads or npy), which
+      apply to frames of the same shape,
+    * the gaps of stitched detectors (``DetectorGeometry``) and
+    * the detector conventions: negative values (Pilatus gaps -1 and bad
+      pixels -2) and values at or above ``hot`` (overflow markers).
+
+    The static part (files and gaps) is kept as a packed bitmap per
+    geometry or frame shape for ``array``.  Frames are masked with the gap
+    rectangles of the geometry and a boolean image of the mask file of
+    their shape.  ``version`` changes with every change of the masks, it
+    is part of the frame cache keys.
+    '''
+    def __init__(self, hot=2**31-1):
+        self.enabled = True
+        self.conventions = True
+        self.gaps = True
+        self.hot = hot
+        self.version = 0
+        self._files = {}
+        self._bitmaps = {}
+        self._static = {}
+        self._lock = threading.Lock()
+
+    def _changed(self):
+        with self._lock:
+            self._bitmaps.clear()
+            self._static.clear()
+            self.version += 1
+
+    def set_enabled(self, on):
+        self.enabled = bool(on)
+        self._changed()
+
+    def load(self, fname):
+        '''load a mask file, replaces the mask of the same shape
+
+        :returns: shape of the mask
+        '''
+        if fname.endswith('.npy'):
+            data = np.load(fname)
+        else:
+            data = fabio.open(fname).data
+        if data.ndim != 2:
+            raise ValueError('%s is not an image' %fname)
+        self._files[data.shape] = (fname, np.packbits(data != 0), data.size)
+        self._changed()
+        return data.shape
+
+    def clear(self):
+        '''forget all mask files'''
+        self._files.clear()
+        self._changed()
+
+    @property
+    def files(self):
+        return [fname for fname, bits, size in self._files.values()]
+
+    def bitmap(self, shape, geometry=None):
+        '''packed static mask for frames of ``shape``, None if no pixel is masked'''
+        shape = tuple(shape)
+        key = (shape, geometry.name if geometry is not None else None)
+        with self._lock:
+            if key not in self._bitmaps:
+                gaps, mask = self._static_masks(shape, geometry)
+                mask = np.zeros(shape, dtype=bool) if mask is None else mask.copy()
+                for gap in gaps:
+                    mask[gap] = True
+                self._bitmaps[key] = np.packbits(mask) if mask.any() else None
+            return self._bitmaps[key]
+
+    def _static_masks(self, shape, geometry):
+        # gap rectangles and boolean image of the mask file (or None), with
+        # the lock held
+        key = (shape, geometry.name if geometry is not None else None)
+        if key not in self._static:
+            mask = None
+            if shape in self._files:
+                fname, bits, size = self._files[shape]
+                mask = np.unpackbits(bits, count=size).view(bool).reshape(shape)
+            gaps = geometry.gaps if self.gaps and geometry is not None and geometry.shape == shape else []
+            self._static[key] = (gaps, mask)
+        return self._static[key]
+
+    def array(self, shape, geometry=None):
+        '''static mask as boolean image, None if no pixel is masked'''
+        bits = self.bitmap(shape, geometry)
+        if bits is None or not self.enabled:
+            return None
+        return np.unpackbits(bits, count=int(np.prod(shape))).view(bool).reshape(shape)
+
+    def apply(self, data, geometry=None, conventions=True):
+        '''mask a float frame in place, without the detector conventions
+        unless ``conventions`` is set (e.g. not for sums of frames)'''
+        if not self.enabled:
+            return data
+        with self._lock:
+            gaps, mask = self._static_masks(data.shape, geometry)
+        for gap in gaps:
+            data[gap] = np.nan
+        if mask is not None:
+            np.copyto(data, np.nan, where=mask)
+        if self.conventions and conventions:
+            bad = data < 0
+            np.logical_or(bad, data >= self.hot, out=bad)
+            data[bad] = np.nan
+        return data
+
+
+detector_masks = DetectorMasks()
+
+
+@instrument.timed('decode')
+def decode_frame(frame, masks=detector_masks):
+    '''float32 array of a frame with the masked pixels set to nan'''
+    data = np.asarray(frame.image(), dtype=np.float32)
+    if masks is not None and masks.enabled:
+        if not data.flags.writeable:
+            data = data.copy()
+        masks.apply(data, getattr(frame, 'geometry', None), getattr(frame, 'conventions', True))
+    return data
+
+
+def read_frame(frame, cache=frame_cache, masks=detector_masks):
+    '''decoded and masked float32 array of a frame (``CBFreader`` or ``LambdaItem``)
+
+    The array is shared with the cache and therefore read-only.
+    '''
+    key = frame_key(frame) + (masks.version if masks is not None else None,)
+    data = cache.get(key)
+    if data is None:
+        data = decode_frame(frame, masks)
+        data.flags.writeable = False
+        cache.put(key, data)
+    return data
+
+
+class FramePrefetcher:
+    '''Reads frames ahead of the cursor on a pool of worker threads
+
+    Frames are the objects handed to ``show_pattern`` (``CBFreader`` or
+    ``LambdaItem``), identified by their ``key`` attribute.
+
+    :param depth: number of frames to read ahead of and behind the cursor
+    :type depth: int
+    :param workers: number of worker threads
+    :type workers: int
+    '''
+    def __init__(self, depth=4, workers=2):
+        self.depth = depth
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._futures = {}
+
+    read = staticmethod(read_frame)
+
+    def schedule(self, frames):
+        '''start reading ``frames`` in the background (nearest first),
+        pending reads of frames not in ``frames`` are dropped'''
+        keys = set(f.key for f in frames)
+        for key in list(self._futures):
+            if key not in keys:
+                self._futures.pop(key).cancel()
+        for f in frames:
+            if f.key not in self._futures:
+                self._futures[f.key] = self._pool.submit(self.read, f)
+
+    def ready(self, frame):
+        '''True if the read of ``frame`` has finished, ``get`` will not wait'''
+        future = self._futures.get(frame.key)
+        return future is not None and future.done()
+
+    def get(self, frame):
+        '''decoded float32 array of ``frame``, waits for a read already in flight'''
+        future = self._futures.pop(frame.key, None)
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()
+            except Exception as e:
+                # e.g. the file was closed under the worker, just read it again
+                print('prefetch of %s failed: %s' %(frame.name, e))
+        return self.read(frame)
+
+    def get_all(self, frames):
+        '''decoded arrays of ``frames``, the reads not yet in flight are
+        started together and run concurrently'''
+        for f in frames:
+            if f.key not in self._futures:
+                self._futures[f.key] = self._pool.submit(self.read, f)
+        return [self.get(f) for f in frames]
+
+    def shutdown(self):
+        self._futures = {}
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class DisplayPipeline:
+    '''Transform and scale stages between a decoded frame and the display
+
+    The transform is a single strided view of the frame (a transposition
+    and flips), so the frame is neither copied nor modified.  Scaling
+    writes into a display buffer that is reused as long as the shape does
+    not change.  Each stage is only redone when its input changed:
+    a new scale does not redo the transform and a new transform does not
+    need the frame again.  The duration of the last run of each stage is
+    kept in ``timings`` (seconds).
+
+    Large frames are also available as a mipmap pyramid (``mipmap``) of
+    the display frame, each level reduced by 2x2 blocks.  The levels are
+    computed on demand and kept until the display frame changes.
+    '''
+    # name: (transpose, flip rows, flip columns)
+    transforms = OrderedDict([
+        ("None", (False, False, False)),
+        ("rotate 90", (True, False, True)),
+        ("rotate 180", (False, True, True)),
+        ("rotate 270", (True, True, False)),
+        ("flip up/down", (False, False, True)),
+        ("flip left/right", (False, True, False)),
+        ("rotate 90 & flip up/down", (True, False, False)),
+        ("rotate 90 & flip left/right", (True, True, True)),
+    ])
+    scales = ("lin", "log10", "sqrt")
+
+    def __init__(self, reduce='max', min_size=256):
+        self._frame = None
+        self._transform = "None"
+        self._scale = "lin"
+        self._pattern = None
+        self._display = None
+        self._buffer = None
+        self._levels = []
+        # max keeps Bragg peaks visible in the reduced levels
+        self.reduce = reduce
+        self.min_size = min_size
+        self.timings = {}
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = frame
+        self._pattern = self._display = None
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, name):
+        if name not in self.transforms:
+            raise ValueError('unknown transform %s' %name)
+        if name != self._transform:
+            self._transform = name
+            self._pattern = self._display = None
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, name):
+        if name not in self.scales:
+            raise ValueError('unknown scale %s' %name)
+        if name != self._scale:
+            self._scale = name
+            self._display = None
+
+    @classmethod
+    def apply_transform(cls, frame, name):
+        transpose, flip_rows, flip_cols = cls.transforms[name]
+        view = frame.T if transpose else frame
+        return view[::-1 if flip_rows else 1, ::-1 if flip_cols else 1]
+
+    def _timed(self, name, t):
+        self.timings[name] = time.perf_counter() - t
+        instrument.record(name, self.timings[name], t)
+
+    @staticmethod
+    def apply_scale(values, name, out=None):
+        '''scaled float32 copy of ``values`` (written to ``out`` if given),
+        negative values are clipped for log10 and sqrt'''
+        if out is None:
+            out = np.empty(np.shape(values), dtype=np.float32)
+        if name == "lin":
+            out[...] = values
+            return out
+        np.maximum(values, 0, out=out)
+        if name == "log10":
+            np.add(out, 1, out=out)
+            np.log10(out, out=out)
+        else:
+            np.sqrt(out, out=out)
+        return out
+
+    @property
+    def pattern(self):
+        '''transformed (unscaled) frame, a view of ``frame``'''
+        if self._pattern is None and self._frame is not None:
+            t = time.perf_counter()
+            self._pattern = self.apply_transform(self._frame, self._transform)
+            self._timed('transform', t)
+        return self._pattern
+
+    def display(self):
+        '''transformed and scaled frame, negative values are clipped for
+        log10 and sqrt; the result is overwritten by the next frame'''
+        if self._display is None and self._frame is not None:
+            pattern = self.pattern
+            t = time.perf_counter()
+            if self._scale == "lin":
+                self._display = pattern
+            else:
+                if self._buffer is None or self._buffer.shape != pattern.shape:
+                    self._buffer = np.empty(pattern.shape, dtype=np.float32)
+                self._display = self.apply_scale(pattern, self._scale, out=self._buffer)
+            self._levels = [self._display]
+            self._timed('scale', t)
+        return self._display
+
+    def mipmap_levels(self):
+        '''number of mipmap levels of the display frame, the last level
+        is the first one smaller than ``min_size`` in any direction'''
+        if self.pattern is None:
+            return 0
+        shape, n = self.pattern.shape, 1
+        while min(shape) >= 2*self.min_size:
+            shape = ((shape[0]+1)//2, (shape[1]+1)//2)
+            n += 1
+        return n
+
+    def mipmap(self, level):
+        '''display frame reduced ``level`` times by 2x2 blocks, level 0 is ``display()``'''
+        level = min(level, self.mipmap_levels()-1)
+        self.display()
+        if len(self._levels) <= level:
+            t = time.perf_counter()
+            while len(self._levels) <= level:
+                self._levels.append(downsample(self._levels[-1], self.reduce))
+            self._timed('mipmap', t)
+        return self._levels[level]
+
+
+def downsample(a, reduce='max'):
+    '''reduce 2x2 blocks of a 2d array to their max or mean (float32), odd
+    edges are treated as if padded by repeating the last row/column'''
+    # fmax ignores masked (nan) pixels, a mean of a block with one is nan
+    op = np.fmax if reduce == 'max' else np.add
+    h, w = a.shape
+    rows = np.array(a[0::2], dtype=np.float32)
+    op(rows[:h//2], a[1::2], out=rows[:h//2])
+    out = np.array(rows[:, 0::2])
+    op(out[:, :w//2], rows[:, 1::2], out=out[:, :w//2])
+    if reduce != 'max':
+        if h % 2:
+            out[-1] *= 2
+        if w % 2:
+            out[:, -1] *= 2
+        out *= 0.25
+    return out
+
+
+class LevelsEngine:
+    '''Percentile levels and histograms of frames from a strided sample
+
+    About ``sample`` pixels are taken at a fixed stride, so the result for
+    a frame is always the same.  Pixels that are not finite, negative
+    (gaps and dead pixels), at or above ``hot`` (overflow markers of 32 bit
+    detectors) or in ``exclude`` are left out.  The percentiles are found
+    with ``np.partition`` on the unscaled sample and then scaled, which is
+    the same for monotonic scales.  Samples and histograms are cached per
+    frame key (see ``frame_key``).
+
+    :param low: lower percentile
+    :param high: upper percentile
+    :param sample: number of pixels sampled
+    :type sample: int
+    :param max_frames: number of frames in the cache
+    :type max_frames: int
+    '''
+    def __init__(self, low=0.1, high=99.9, sample=1<<16, hot=2**31-1, bins=256, max_frames=64):
+        self.low = low
+        self.high = high
+        self.sample = sample
+        self.hot = hot
+        self.bins = bins
+        self.max_frames = max_frames
+        self._samples = OrderedDict()
+        self._histograms = OrderedDict()
+
+    def _sample(self, key, frame, exclude=None):
+        s = self._samples.get(key) if key is not None else None
+        if s is None:
+            # odd stride, so it does not line up with module rows
+            step = max(1, frame.size // self.sample) | 1
+            s = np.ravel(frame)[::step]
+            valid = np.isfinite(s) & (s >= 0) & (s < self.hot)
+            if exclude is not None:
+                valid &= ~np.ravel(exclude)[::step]
+            s = s[valid]
+            if key is not None:
+                self._samples[key] = s
+                while len(self._samples) > self.max_frames:
+                    self._samples.popitem(last=False)
+        else:
+            self._samples.move_to_end(key)
+        return s
+
+    @instrument.timed('levels')
+    def levels(self, frame, scale='lin', key=None, exclude=None):
+        '''(low, high) display levels of ``frame`` for ``scale``, None if
+        no pixel is valid'''
+        s = self._sample(key, frame, exclude)
+        if not len(s):
+            return None
+        k = [int(round(p/100.*(len(s)-1))) for p in (self.low, self.high)]
+        lo, hi = np.partition(s, k)[k]
+        lo, hi = DisplayPipeline.apply_scale(np.array([lo, hi]), scale)
+        if hi <= lo:
+            hi = lo + 1
+        return float(lo), float(hi)
+
+    @instrument.timed('levels')
+    def histogram(self, frame, scale='lin', key=None, exclude=None):
+        '''(left bin edges, counts) of the scaled sample, like
+        ``pyqtgraph.ImageItem.getHistogram``'''
+        h = self._histograms.get((key, scale)) if key is not None else None
+        if h is None:
+            s = self._sample(key, frame, exclude)
+            if not len(s):
+                return None, None
+            counts, edges = np.histogram(DisplayPipeline.apply_scale(s, scale), bins=self.bins)
+            h = (edges[:-1], counts)
+            if key is not None:
+                self._histograms[(key, scale)] = h
+                while len(self._histograms) > self.max_frames:
+                    self._histograms.popitem(last=False)
+        return h
+
+
+class FrameComparison:
+    '''Difference or ratio of a frame and a reference frame
+
+    The result is written into a buffer that is reused as long as the
+    shape does not change, so the returned array is only valid until the
+    next call.  Ratios with a zero reference are nan, like masked pixels.
+
+    :param mode: one of ``modes``
+    :type mode: string
+    '''
+    modes = ('difference', 'ratio')
+
+    def __init__(self, mode='difference'):
+        self.mode = mode
+        self._out = None
+        self._valid = None
+
+    def compare(self, frame, reference):
+        if frame.shape != reference.shape:
+            raise ValueError('frames of shape %s and %s cannot be compared' %(frame.shape, reference.shape))
+        if self._out is None or self._out.shape != frame.shape:
+            self._out = np.empty(frame.shape, dtype=np.float32)
+            self._valid = np.empty(frame.shape, dtype=bool)
+        if self.mode == 'difference':
+            return np.subtract(frame, reference, out=self._out)
+        if self.mode == 'ratio':
+            np.not_equal(reference, 0, out=self._valid)
+            self._out.fill(np.nan)
+            return np.divide(frame, reference, out=self._out, where=self._valid)
+        raise ValueError('unknown mode %s' %self.mode)
+
+    def levels(self, result, percentile=99.5, sample=1<<16):
+        '''display levels of a result, symmetric around 0 (difference) or
+        1 (ratio) and covering ``percentile`` of a sample of the pixels'''
+        center = 0. if self.mode == 'difference' else 1.
+        step = max(1, result.size // sample) | 1
+        s = np.ravel(result)[::step]
+        s = np.abs(s[np.isfinite(s)] - center)
+        if not len(s):
+            return center - 1, center + 1
+        k = int(round(percentile/100.*(len(s)-1)))
+        d = float(np.partition(s, k)[k]) or 1.
+        return center - d, center + d
+
+
+class Accumulator:
+    '''running sum or max over frames, in int64 for integer frames and in
+    float64 otherwise
+
+    With ``hot`` the detector conventions of ``DetectorMasks`` are applied
+    to each frame: pixels <0 or >=hot are left out (counted as 0) and the
+    valid frames are counted per pixel, means are taken over them and
+    pixels without any valid frame are nan in the result.
+    '''
+    def __init__(self, mode='sum', hot=None):
+        self.mode = mode
+        self.hot = hot
+        self.data = None
+        self.valid = None
+        self.count = 0
+
+    def add(self, frames):
+        '''add a stack of frames (frames, y, x)'''
+        if not len(frames):
+            return
+        valid = None
+        if self.hot is not None:
+            good = (frames >= 0) & (frames < self.hot)
+            frames = np.where(good, frames, 0)
+            valid = good.sum(axis=0, dtype=np.int64)
+        dtype = np.int64 if frames.dtype.kind in 'iub' else np.float64
+        if self.mode == 'max':
+            part = frames.max(axis=0).astype(dtype)
+        else:
+            part = frames.sum(axis=0, dtype=dtype)
+        self.merge(part, len(frames), valid)
+
+    def merge(self, data, count, valid=None):
+        '''add the result of another accumulator (its ``data``, ``count``
+        and ``valid``)'''
+        if self.data is None:
+            self.data = data
+        elif data.shape != self.data.shape:
+            raise ValueError('frame shape %s differs from %s' %(data.shape, self.data.shape))
+        elif self.mode == 'max':
+            self.data = np.maximum(self.data, data)
+        else:
+            self.data = self.data + data
+        if valid is not None:
+            self.valid = valid if self.valid is None else self.valid + valid
+        self.count += count
+
+    def result(self):
+        if self.valid is not None:
+            if self.mode == 'mean':
+                return np.where(self.valid > 0, self.data / np.maximum(self.valid, 1), np.nan)
+            if not self.valid.all():
+                return np.where(self.valid > 0, self.data, np.nan)
+            return self.data
+        if self.mode == 'mean' and self.count:
+            return self.data / self.count
+        return self.data
+
+
+def _aggregate_cbf(fnames, mode, hot):
+    # runs in a worker process
+    acc = Accumulator(mode, hot)
+    for fname in fnames:
+        acc.add(np.asarray(CBFreader(fname).image())[np.newaxis])
+    return acc.data, acc.count, acc.valid
+
+
+class FrameAggregator:
+    '''Sum, mean or max over ranges of frames with bounded memory
+
+    Nexus frames are read as hyperslabs of up to ``chunk_bytes`` along the
+    frame axis, Lambda 3M modules are reduced separately and stitched at
+    the end.  Runs of cbf files are split into batches reduced on a spawn
+    process pool (if there are more than ``batch`` files), with at most
+    two batches per worker in flight.  Only the accumulators and one chunk
+    per worker are in memory at any time.  The detector conventions of
+    ``masks`` (if enabled) are applied to each frame before it is added,
+    see ``Accumulator``; the result is shown as an ``AggregateFrame``,
+    which is not masked by them again.
+
+    A source is ``(kind, path, start, stop)`` with the ``FileIndex`` kind
+    and path; start and stop select frames of nexus files and are ignored
+    for cbf files.
+
+    :param mode: 'sum', 'mean' or 'max'
+    :type mode: string
+    :param workers: number of processes for cbf files
+    :type workers: int
+    '''
+    modes = ('sum', 'mean', 'max')
+
+    def __init__(self, mode='sum', chunk_bytes=64 * 2**20, batch=64, workers=None, masks=detector_masks):
+        if mode not in self.modes:
+            raise ValueError('unknown mode %s' %mode)
+        self.mode = mode
+        self.hot = masks.hot if masks is not None and masks.enabled and masks.conventions else None
+        self.chunk_bytes = chunk_bytes
+        self.batch = batch
+        self.workers = workers or os.cpu_count()
+        # layout of stitched sources, if any
+        self.geometry = None
+
+    @staticmethod
+    def count(sources):
+        '''number of frames of the sources'''
+        return sum(1 if kind == FileIndex.CBF else stop - start for kind, path, start, stop in sources)
+
+    def run(self, sources, progress=None, cancelled=None):
+        '''aggregate the frames of ``sources``
+
+        :param progress: called with (frames done, frames) after each chunk
+        :param cancelled: returns True to stop
+        :returns: (result, number of frames), result is None if cancelled
+        '''
+        total = self.count(sources)
+        self._done = 0
+        def step(n):
+            self._done += n
+            if progress is not None:
+                progress(self._done, total)
+            return cancelled is not None and cancelled()
+
+        acc = Accumulator(self.mode, self.hot)
+        cbfs = [path for kind, path, start, stop in sources if kind == FileIndex.CBF]
+        try:
+            for kind, path, start, stop in sources:
+                if kind == FileIndex.LAMBDA:
+                    self._add_dataset(acc, path, start, stop, step)
+                elif kind == FileIndex.LAMBDA3M:
+                    self._add_modules(acc, path, start, stop, step)
+            self._add_cbfs(acc, cbfs, step)
+        except _Cancelled:
+            return None, self._done
+        return acc.result(), acc.count
+
+    @staticmethod
+    def _layout(fname):
+        '''shape and type of the frames of a nexus file'''
+        with h5_pool.using([fname]) as (f,):
+            dset = f['/entry/instrument/detector/data']
+            return dset.shape, dset.dtype
+
+    @staticmethod
+    def _read(fname, selection):
+        # from the pool each time, it may have closed the file in the meantime
+        with h5_pool.using([fname]) as (f,):
+            return f['/entry/instrument/detector/data'][selection]
+
+    def _chunk_frames(self, layout):
+        shape, dtype = layout
+        return max(1, self.chunk_bytes // (dtype.itemsize * int(np.prod(shape[1:]))))
+
+    def _add_dataset(self, acc, fname, start, stop, step):
+        n = self._chunk_frames(self._layout(fname))
+        for i in range(start, stop, n):
+            acc.add(self._read(fname, np.s_[i:min(i+n, stop)]))
+            if step(min(i+n, stop) - i):
+                raise _Cancelled()
+
+    def _add_modules(self, acc, prefix, start, stop, step):
+        reader = Lambda3MReader(prefix)
+        reader.open()
+        reader.close()
+        tiles = [Accumulator(acc.mode, acc.hot) for fname in reader._fnames]
+        n = self._chunk_frames(self._layout(reader._fnames[0]))
+        for i in range(start, stop, n):
+            for tile, fname in zip(tiles, reader._fnames):
+                tile.add(self._read(fname, np.s_[i:min(i+n, stop)]))
+            if step(min(i+n, stop) - i):
+                raise _Cancelled()
+        valid = None
+        if acc.hot is not None:
+            # gaps have no valid frames
+            valid = np.zeros(reader.geometry.shape, dtype=np.int64)
+            for m, tile in enumerate(tiles):
+                valid[reader.geometry.slices[m]] = tile.valid
+        acc.merge(reader.geometry.assemble([tile.data for tile in tiles]), stop - start, valid)
+        self.geometry = reader.geometry
+
+    def _add_cbfs(self, acc, fnames, step):
+        if len(fnames) <= self.batch:
+            for fname in fnames:
+                acc.add(np.asarray(CBFreader(fname).image())[np.newaxis])
+                if step(1):
+                    raise _Cancelled()
+            return
+        batches = [fnames[i:i+self.batch] for i in range(0, len(fnames), self.batch)]
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            pending = set()
+            try:
+                while batches or pending:
+                    while batches and len(pending) < 2*self.workers:
+                        pending.add(pool.submit(_aggregate_cbf, batches.pop(0), acc.mode, acc.hot))
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        data, count, valid = future.result()
+                        acc.merge(data, count, valid)
+                        if step(count):
+                            raise _Cancelled()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class AggregateFrame:
+    '''virtual pattern holding the result of a ``FrameAggregator``'''
+    _count = itertools.count()
+    # applied to the single frames, not to sums (see ``DetectorMasks.apply``)
+    conventions = False
+
+    def __init__(self, name, data, geometry=None):
+        self.name = name
+        self.data = data
+        self.geometry = geometry
+        self.key = ('<aggregate>', next(self._count))
+
+    def image(self):
+        return self.data
+
+
+class AzimuthalIntegrator:
+    '''Radial profiles I(q) or I(2theta) of frames
+
+    The bin of each pixel is computed once per frame shape, transform,
+    mask and parameter set and cached, a profile then costs one
+    ``np.bincount`` over the frame.  If scipy is installed, the lookup is
+    a sparse CSR matrix (bins x pixels) instead and a profile is one
+    sparse matrix-vector product.  With ``split`` > 1 each pixel is split
+    into split x split sub-pixels which are binned separately, the pixel
+    then contributes to each bin with the fraction of its sub-pixels in
+    it.  The sub-pixels are binned one layer at a time, and ``split`` is
+    reduced for large frames so that there are at most ``max_subpixels``.
+    The range of the bins is that of the pixel centers.
+
+    The beam center is given in pixels of the transformed frame, i.e. the
+    positions shown for the cursor (first, second axis).  The lookup is
+    built for the untransformed frame, so frames are integrated as read.
+    Masked pixels (nan) and the static mask are left out.  The nan pixels
+    of a frame are taken out of a copy of the lookup, which is kept as
+    long as the following frames have the same nan pixels (e.g. the gaps
+    of a Pilatus detector).
+
+    :param center: beam center (first, second axis) in pixels
+    :param distance: sample-detector distance in mm
+    :param pixel_size: pixel size in mm
+    :param wavelength: wavelength in Angstrom
+    :param unit: 'q' (1/nm) or '2theta' (degrees)
+    :param bins: number of bins
+    :param split: sub-pixels per pixel and direction
+    :param max_subpixels: limit of split x split x pixels
+    '''
+    units = OrderedDict([('q', 'q (1/nm)'), ('2theta', '2θ (deg)')])
+
+    def __init__(self, center=(0., 0.), distance=1000., pixel_size=0.172, wavelength=1.,
+                 unit='q', bins=500, split=1, max_lookups=4, max_subpixels=2**25):
+        self.center = tuple(center)
+        self.distance = distance
+        self.pixel_size = pixel_size
+        self.wavelength = wavelength
+        self.unit = unit
+        self.bins = bins
+        self.split = split
+        self.max_lookups = max_lookups
+        self.max_subpixels = max_subpixels
+        self._lookups = OrderedDict()
+        # lookup key: (nan pixels, lookup without them, counts)
+        self._folded = {}
+
+    def _params(self):
+        return (self.center, self.distance, self.pixel_size, self.wavelength, self.unit, self.bins, self.split)
+
+    def _key(self, shape, transform, mask_key):
+        return (tuple(shape), transform, mask_key) + self._params()
+
+    def radial(self, pos0, pos1):
+        '''q or 2theta of positions in pixels (transformed frame)'''
+        r = np.hypot(pos0 - self.center[0], pos1 - self.center[1]) * self.pixel_size
+        two_theta = np.arctan2(r, self.distance)
+        if self.unit == '2theta':
+            return np.degrees(two_theta)
+        # wavelength in nm
+        return 4*np.pi/(self.wavelength/10.) * np.sin(two_theta/2)
+
+    def effective_split(self, shape):
+        '''``split`` limited by ``max_subpixels`` for frames of ``shape``'''
+        npix = max(int(np.prod(shape)), 1)
+        return max(1, min(self.split, int(np.sqrt(self.max_subpixels / float(npix)))))
+
+    def _layers(self, shape, transform, split):
+        # radial values of the sub-pixels, one (flat) layer at a time in
+        # the same buffer; written through the transform view so they end
+        # up in frame order
+        offsets = (np.arange(split) + 0.5) / split
+        layer = np.empty(shape, dtype=np.float64)
+        view = DisplayPipeline.apply_transform(layer, transform)
+        pos0 = np.arange(view.shape[0])[:, np.newaxis]
+        pos1 = np.arange(view.shape[1])[np.newaxis, :]
+        for o0, o1 in itertools.product(offsets, offsets):
+            view[...] = self.radial(pos0 + o0, pos1 + o1)
+            yield layer.reshape(-1)
+
+    def lookup(self, shape, transform='None', mask=None, mask_key=None):
+        '''(bin centers, lookup, pixel counts per bin) for frames of
+        ``shape``, cached per ``mask_key``; ``mask`` may be a function
+        returning the mask, it is only called to build the lookup.  The
+        lookup is None if all pixels are masked (empty profile).'''
+        key = self._key(shape, transform, mask_key)
+        lut = self._lookups.get(key)
+        if lut is not None:
+            self._lookups.move_to_end(key)
+            return lut
+        if callable(mask):
+            mask = mask()
+        npix = int(np.prod(shape))
+        valid = np.ones(npix, dtype=bool) if mask is None else ~np.ravel(mask)
+        if not valid.any():
+            lut = (np.empty(0), None, np.empty(0))
+        else:
+            lut = self._build(shape, transform, valid)
+        self._lookups[key] = lut
+        while len(self._lookups) > self.max_lookups:
+            old, _ = self._lookups.popitem(last=False)
+            self._folded.pop(old, None)
+        return lut
+
+    def _build(self, shape, transform, valid):
+        npix = valid.size
+        centers = next(self._layers(shape, transform, 1))
+        lo, hi = centers[valid].min(), centers[valid].max()
+        edges = np.linspace(lo, hi, self.bins + 1)
+        # a single value: everything in the first bin
+        scale = self.bins / (hi - lo) if hi > lo else 0.
+
+        def to_bins(layer):
+            layer -= lo
+            layer *= scale
+            np.clip(layer, 0, self.bins - 1, out=layer)
+            return layer.astype(np.int32)
+
+        base = to_bins(centers)
+        s = self.effective_split(shape)
+        if s == 1:
+            counts = {0: valid.view(np.uint8)}
+        else:
+            # number of sub-pixels per pixel in bin base + offset, the
+            # sub-pixels of a pixel fall into a few neighbouring bins
+            counts = {}
+            for layer in self._layers(shape, transform, s):
+                offset = to_bins(layer)
+                offset -= base
+                for o in range(offset.min(), offset.max() + 1):
+                    if o not in counts:
+                        counts[o] = np.zeros(npix, dtype=np.uint8)
+                    counts[o] += offset == o
+        sparse = _sparse()
+        if sparse is None and s == 1:
+            # intp, bincount would convert other index types on every call;
+            # masked pixels go to an extra bin which is dropped
+            idx = base.astype(np.intp)
+            idx[~valid] = self.bins
+            return (edges[:-1] + edges[1:]) / 2, idx, self._counts(idx)
+        # (bin, pixel, weight) of each pixel and bin it contributes to
+        bins, pixels, weights = [], [], []
+        for o, c in counts.items():
+            p = np.flatnonzero(c.astype(bool) & valid)
+            bins.append(base[p] + o)
+            pixels.append(p)
+            weights.append(c[p] * np.float32(1. / (s*s)))
+        bins, pixels, weights = (np.concatenate(a) for a in (bins, pixels, weights))
+        if sparse is not None:
+            # float32 weights: the product with a float32 frame needs no conversion
+            idx = sparse.csr_matrix((weights, (bins, pixels.astype(np.int32))), shape=(self.bins + 1, npix))
+        else:
+            idx = (bins.astype(np.intp), pixels, weights)
+        return (edges[:-1] + edges[1:]) / 2, idx, self._counts(idx)
+
+    def _is_sparse(self, idx):
+        sparse = _sparse()
+        return sparse is not None and sparse.issparse(idx)
+
+    def _sum(self, idx, values):
+        # sum of values per bin
+        if self._is_sparse(idx):
+            return idx.dot(values)
+        if isinstance(idx, tuple):
+            # pixel splitting without scipy
+            bins, pixels, weights = idx
+            return np.bincount(bins, weights=values[pixels] * weights, minlength=self.bins + 1)
+        return np.bincount(idx, weights=values, minlength=self.bins + 1)
+
+    def _counts(self, idx):
+        # (fractional) number of pixels per bin
+        if self._is_sparse(idx):
+            return np.asarray(idx.sum(axis=1)).ravel()
+        if isinstance(idx, tuple):
+            return np.bincount(idx[0], weights=idx[2], minlength=self.bins + 1)
+        return np.bincount(idx, minlength=self.bins + 1).astype(np.float64)
+
+    def _drop(self, idx, bad):
+        # lookup without the pixels ``bad`` (boolean per pixel)
+        if self._is_sparse(idx):
+            idx = idx.copy()
+            idx.data *= ~bad[idx.indices]
+            idx.eliminate_zeros()
+            return idx
+        if isinstance(idx, tuple):
+            keep = ~bad[idx[1]]
+            return tuple(a[keep] for a in idx)
+        return np.where(bad, self.bins, idx)
+
+    def integrate(self, frame, transform='None', mask=None, mask_key=None):
+        '''(bin centers, mean intensity per bin) of a frame as read,
+        bins without valid pixels are nan'''
+        key = self._key(frame.shape, transform, mask_key)
+        x, idx, counts = self.lookup(frame.shape, transform, mask, mask_key)
+        if idx is None:
+            return x, np.empty(0)
+        values = np.ravel(frame)
+        bad = None
+        folded = self._folded.get(key)
+        if folded is not None:
+            bad = np.isnan(values)
+            if np.array_equal(bad, folded[0]):
+                idx, counts = folded[1:]
+        sums = self._sum(idx, values)
+        # pixels of the static mask end up in the dropped bin (or have no
+        # lookup entries), other nan pixels are dropped from a copy of the
+        # lookup kept for the next frames
+        if not np.isfinite(sums[:self.bins]).all():
+            if bad is None:
+                bad = np.isnan(values)
+            if bad.any():
+                idx = self._drop(self._lookups[key][1], bad)
+                counts = self._counts(idx)
+                self._folded[key] = (bad, idx, counts)
+                sums = self._sum(idx, values)
+        sums = sums[:self.bins]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return x, np.where(counts[:self.bins] > 0, sums / counts[:self.bins], np.nan)
+
+
+def render_frame(data, levels, lut=None):
+    '''RGB image of a display frame (transformed and scaled) as shown in
+    the viewer, oriented like the TIFF export
+
+    :param levels: (low, high) display levels, mapped to the first and
+                   last colour; masked (nan) pixels get the first colour
+    :param lut: (n, 3) uint8 colour table, gray if None
+    :returns: (y, x, 3) uint8 array
+    '''
+    if lut is None:
+        lut = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+    low, high = levels
+    idx = np.subtract(data.T, low, dtype=np.float32)
+    idx *= (len(lut) - 1) / ((high - low) or 1.)
+    np.clip(idx, 0, len(lut) - 1, out=idx)
+    np.nan_to_num(idx, copy=False)
+    return lut[idx.astype(np.intp)]
+
+
+class MovieWriter:
+    '''Writes RGB frames (see ``render_frame``) one by one to an animated
+    (multi page) TIFF or, with imageio and imageio-ffmpeg installed, to an
+    MP4 file
+
+    :param fname: output file, MP4 for the extension ``.mp4``
+    :type fname: string
+    :param fps: frames per second of the MP4 file
+    :type fps: float
+    '''
+    def __init__(self, fname, fps=10.):
+        self.fname = fname
+        self.mp4 = fname.lower().endswith('.mp4')
+        if self.mp4:
+            imageio = _imageio()
+            if imageio is None:
+                raise ValueError('MP4 export needs imageio and imageio-ffmpeg')
+            self._writer = imageio.get_writer(fname, fps=fps, macro_block_size=1)
+        else:
+            self._writer = TiffImagePlugin.AppendingTiffWriter(fname, True)
+
+    @staticmethod
+    def available():
+        ''':returns: the supported extensions'''
+        return ('.tiff', '.mp4') if _imageio() is not None else ('.tiff',)
+
+    def write(self, rgb):
+        if self.mp4:
+            # yuv420p needs even sizes
+            pad = ((0, rgb.shape[0] % 2), (0, rgb.shape[1] % 2), (0, 0))
+            self._writer.append_data(np.pad(rgb, pad) if any(p[1] for p in pad) else rgb)
+        else:
+            Image.fromarray(rgb, 'RGB').save(self._writer, format='TIFF', compression='tiff_deflate')
+            self._writer.newFrame()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def export_movie(frames, fname, transform='None', scale='lin', levels=None, lut=None, fps=10.,
+                 progress=None, cancelled=None, ahead=4):
+    '''write ``frames`` (``CBFreader``, ``LambdaItem``, ...) as a movie
+    with a transform, scale and colour table like the viewer
+
+    The next ``ahead`` frames are read on two threads while a frame is
+    rendered and encoded.  Without ``levels`` the levels of the first
+    frame are used for all.
+
+    :returns: number of frames written, None if cancelled (the file is removed)
+    '''
+    pipeline = DisplayPipeline()
+    pipeline.transform = transform
+    pipeline.scale = scale
+    writer = MovieWriter(fname, fps)
+    todo = iter(frames)
+    n = 0
+    try:
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='movie') as pool:
+            reads = deque(pool.submit(read_frame, f) for f in itertools.islice(todo, ahead))
+            while reads:
+                if cancelled is not None and cancelled():
+                    for future in reads:
+                        future.cancel()
+                    raise _Cancelled()
+                pipeline.frame = reads.popleft().result()
+                reads.extend(pool.submit(read_frame, f) for f in itertools.islice(todo, 1))
+                if levels is None:
+                    levels = LevelsEngine().levels(pipeline.frame, scale) or (0, 1)
+                writer.write(render_frame(pipeline.display(), levels, lut))
+                n += 1
+                if progress is not None:
+                    progress(n, len(frames))
+    except _Cancelled:
+        writer.close()
+        os.remove(fname)
+        return None
+    finally:
+        writer.close()
+    return n
+
+
+class BigTiffWriter:
+    '''Writes 2d frames of any integer or float type as pages of a
+    BigTIFF file (no 4 GB limit), oriented like the viewer
+
+    ``encode`` transposes and compresses a frame into strips and may run on
+    several threads at once, ``write`` appends the encoded pages in order.
+
+    :param fname: output file
+    :param compression: ``'none'`` or ``'deflate'``
+    :param level: zlib level of ``'deflate'``
+    :param strip_bytes: uncompressed size of a strip
+    '''
+    _sample_formats = {'u': 1, 'i': 2, 'f': 3}
+
+    def __init__(self, fname, compression='none', level=6, strip_bytes=1 << 16):
+        self.compression = compression
+        self.level = level
+        self.strip_bytes = strip_bytes
+        self.file = open(fname, 'wb')
+        # header: byte order, version 43, offset size 8, first page offset
+        self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        self._link = 8
+
+    def encode(self, data):
+        ''':returns: shape, dtype, rows per strip and the strips of a frame'''
+        if data.ndim != 2 or data.dtype.kind not in self._sample_formats:
+            raise ValueError('cannot write %s frames of shape %s to tiff' %(data.dtype, data.shape))
+        image = np.ascontiguousarray(data.T, dtype=data.dtype.newbyteorder('<'))
+        rows = max(1, self.strip_bytes // (image.shape[1] * image.itemsize))
+        strips = [image[i:i+rows].tobytes() for i in range(0, image.shape[0], rows)]
+        if self.compression == 'deflate':
+            strips = [zlib.compress(strip, self.level) for strip in strips]
+        return image.shape, image.dtype, rows, strips
+
+    def write(self, encoded, description=''):
+        (height, width), dtype, rows, strips = encoded
+        f = self.file
+        f.seek(0, os.SEEK_END)
+        offsets = []
+        for strip in strips:
+            offsets.append(f.tell())
+            f.write(strip)
+        text = description.encode('ascii', 'replace') + b'\0'
+        def extra(data):
+            # values longer than 8 bytes are stored before the page
+            if f.tell() % 2:
+                f.write(b'\0')
+            pos = f.tell()
+            f.write(data)
+            return pos
+        counts = [len(strip) for strip in strips]
+        if len(strips) > 1:
+            strip_offsets = extra(struct.pack('<%dQ' %len(strips), *offsets))
+            strip_counts = extra(struct.pack('<%dQ' %len(strips), *counts))
+        else:
+            strip_offsets, strip_counts = offsets[0], counts[0]
+        text_offset = extra(text) if len(text) > 8 else None
+        # (tag, type, count, value), types 2 ascii, 3 short, 4 long, 16 long8
+        tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, dtype.itemsize * 8),
+                (259, 3, 1, 8 if self.compression == 'deflate' else 1), (262, 3, 1, 1),
+                (270, 2, len(text), text_offset if text_offset is not None else text),
+                (273, 16, len(strips), strip_offsets), (277, 3, 1, 1), (278, 4, 1, rows),
+                (279, 16, len(strips), strip_counts), (339, 3, 1, self._sample_formats[dtype.kind])]
+        if f.tell() % 2:
+            f.write(b'\0')
+        page = f.tell()
+        f.write(struct.pack('<Q', len(tags)))
+        for tag, kind, count, value in tags:
+            if isinstance(value, bytes):
+                value = value.ljust(8, b'\0')
+            else:
+                value = struct.pack({3: '<H', 4: '<I'}.get(kind, '<Q'), value).ljust(8, b'\0')
+            f.write(struct.pack('<HHQ', tag, kind, count) + value)
+        f.write(struct.pack('<Q', 0))
+        # link the page from the header or the previous page
+        f.seek(self._link)
+        f.write(struct.pack('<Q', page))
+        self._link = page + 8 + 20 * len(tags)
+
+    def close(self):
+        self.file.close()
+
+
+class _HDF5Stack:
+    # frames in /data (frames, y, x) with one chunk per frame and their
+    # names in /names, the type and shape are those of the first frame;
+    # gzip chunks are compressed by ``encode`` on the export threads
+    def __init__(self, fname, nframes, compression='none', level=4):
+        self.file = h5py.File(fname, 'w')
+        self.nframes = nframes
+        self.compression = compression
+        self.level = level
+        self.data = None
+        self.names = self.file.create_dataset('names', (nframes,), dtype=h5py.string_dtype())
+
+    def encode(self, data):
+        data = np.ascontiguousarray(data)
+        if self.compression == 'lzf':
+            return data, None
+        raw = data.tobytes()
+        return data, zlib.compress(raw, self.level) if self.compression == 'gzip' else raw
+
+    def write(self, n, name, encoded):
+        data, chunk = encoded
+        if self.data is None:
+            options = {'none': {}, 'gzip': {'compression': 'gzip', 'compression_opts': self.level},
+                       'lzf': {'compression': 'lzf'}}[self.compression]
+            self.data = self.file.create_dataset('data', (self.nframes,) + data.shape, dtype=data.dtype,
+                                                 chunks=(1,) + data.shape, **options)
+        _check_frame(data, self.data)
+        if chunk is not None and data.dtype == self.data.dtype:
+            self.data.id.write_direct_chunk((n,) + (0,) * data.ndim, chunk)
+        else:
+            self.data[n] = data
+        self.names[n] = name
+
+    def close(self):
+        self.file.close()
+
+
+class _NpyStack:
+    # frames in a memory mapped .npy file of the type and shape of the
+    # first frame
+    def __init__(self, fname, nframes):
+        self.fname = fname
+        self.nframes = nframes
+        self.data = None
+
+    def encode(self, data):
+        return data
+
+    def write(self, n, name, data):
+        if self.data is None:
+            self.data = np.lib.format.open_memmap(self.fname, mode='w+', dtype=data.dtype,
+                                                  shape=(self.nframes,) + data.shape)
+        _check_frame(data, self.data)
+        self.data[n] = data
+
+    def close(self):
+        if self.data is not None:
+            self.data.flush()
+            self.data = None
+
+
+def _check_frame(data, stack):
+    if data.shape != stack.shape[1:]:
+        raise ValueError('shape %s differs from %s' %(data.shape, stack.shape[1:]))
+    if not np.can_cast(data.dtype, stack.dtype, 'safe'):
+        raise ValueError('type %s does not fit into %s' %(data.dtype, stack.dtype))
+
+
+class StackExporter:
+    '''Writes frames in their own type (no masks, transforms or scales)
+    to one file: a multi page BigTIFF, a chunked HDF5 stack or an NPY
+    memory map
+
+    The frames are read and encoded (compressed) on a thread pool and
+    written in order.  HDF5 and NPY stacks take the shape and type of the
+    first frame, frames of another shape or of a type which cannot be cast
+    safely to it are skipped (zeros in the stack).
+    For nexus files ``virtual`` writes an HDF5 virtual dataset instead,
+    which refers to the frames in the original files (for Lambda 3M the
+    modules at their place in the stitched frame) without copying them.
+
+    :param fmt: one of ``formats``
+    :param compression: one of ``compressions[fmt]``
+    :param level: zlib level of ``deflate`` and ``gzip``
+    :param virtual: HDF5 virtual dataset if all frames are in nexus files
+    :param workers: threads reading and encoding frames
+    '''
+    formats = {'tiff': '.tiff', 'hdf5': '.h5', 'npy': '.npy'}
+    compressions = {'tiff': ('none', 'deflate'), 'hdf5': ('none', 'gzip', 'lzf'), 'npy': ('none',)}
+
+    def __init__(self, fmt='hdf5', compression='none', level=4, virtual=False, workers=None):
+        if compression not in self.compressions[fmt]:
+            raise ValueError('no %s compression for %s' %(compression, fmt))
+        self.format = fmt
+        self.compression = compression
+        self.level = level
+        self.virtual = virtual
+        self.workers = workers or min(8, os.cpu_count() or 1)
+
+    @staticmethod
+    def frames(sources):
+        '''(name, read) of each frame of ``sources``, (kind, path, start,
+        stop) like ``FrameAggregator`` or frames with an ``image`` method
+        (e.g. ``AggregateFrame``), and the readers of the nexus files,
+        which are opened here and are to be closed after reading'''
+        frames = []
+        readers = []
+        for source in sources:
+            if hasattr(source, 'image'):
+                frames.append((source.name, source.image))
+                continue
+            kind, path, start, stop = source
+            if kind == FileIndex.CBF:
+                frames.append((os.path.basename(path), CBFreader(path).image))
+                continue
+            r = LambdaReader(path) if kind == FileIndex.LAMBDA else Lambda3MReader(path)
+            r.open()
+            readers.append(r)
+            image = r.image
+            if kind == FileIndex.LAMBDA3M:
+                g = r.geometry
+                dtype = r.dsets[0].dtype
+                if not g.fill.is_integer():
+                    dtype = np.result_type(dtype, np.float32)
+                # stitched in the type of the modules, not float32, and
+                # on the export thread
+                image = lambda idx, r=r, dtype=dtype: r.image(idx, out=np.empty(r.geometry.shape, dtype=dtype),
+                                                              threads=False)
+            frames.extend(('%s_%05d' %(r.name, i+1), functools.partial(image, i)) for i in range(start, stop))
+        return frames, readers
+
+    def run(self, sources, fname, progress=None, cancelled=None):
+        '''export the frames of ``sources`` (see ``frames``) to ``fname``
+
+        :param progress: called with (frames done, frames)
+        :param cancelled: returns True to stop
+        :returns: number of frames written, None if cancelled (the file is removed)
+        '''
+        if self.format == 'hdf5' and self.virtual:
+            n = self._write_virtual(sources, fname)
+            if n is not None:
+                if progress is not None:
+                    progress(n, n)
+                return n
+            print('no virtual dataset for these frames, copying them')
+        frames, readers = self.frames(sources)
+        try:
+            return self._write(frames, fname, progress, cancelled)
+        finally:
+            for r in readers:
+                r.close()
+
+    def _write(self, frames, fname, progress, cancelled):
+        if self.format == 'tiff':
+            writer = BigTiffWriter(fname, self.compression, self.level)
+        elif self.format == 'hdf5':
+            writer = _HDF5Stack(fname, len(frames), self.compression, self.level)
+        else:
+            writer = _NpyStack(fname, len(frames))
+        def task(read):
+            return writer.encode(np.asarray(read()))
+        todo = iter(frames)
+        n = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='export') as pool:
+                pending = deque((name, pool.submit(task, read)) for name, read in itertools.islice(todo, 2*self.workers))
+                for pos in range(len(frames)):
+                    if cancelled is not None and cancelled():
+                        for _, future in pending:
+                            future.cancel()
+                        raise _Cancelled()
+                    name, future = pending.popleft()
+                    pending.extend((name, pool.submit(task, read)) for name, read in itertools.islice(todo, 1))
+                    try:
+                        if self.format == 'tiff':
+                            writer.write(future.result(), name)
+                        else:
+                            writer.write(pos, name, future.result())
+                        n += 1
+                    except (OSError, KeyError, ValueError) as e:
+                        print('skipping %s: %s' %(name, e))
+                    if progress is not None:
+                        progress(pos + 1, len(frames))
+        except _Cancelled:
+            writer.close()
+            # NPY stacks are only created with the first frame
+            if os.path.exists(fname):
+                os.remove(fname)
+            return None
+        finally:
+            writer.close()
+        return n
+
+    def _write_virtual(self, sources, fname):
+        # None if a source is not a nexus file or the frames differ in shape,
+        # type or gap value
+        parts = []
+        layout = None
+        for source in sources:
+            if hasattr(source, 'image') or source[0] == FileIndex.CBF:
+                return None
+            kind, path, start, stop = source
+            if kind == FileIndex.LAMBDA:
+                modules, slices, fill = [path], [np.s_[:, :]], 0
+                shape = FrameAggregator._layout(path)[0][1:]
+            else:
+                r = Lambda3MReader(path)
+                r.open()
+                r.close()
+                modules, slices, fill, shape = r._fnames, r.geometry.slices, r.geometry.fill, r.geometry.shape
+            dsets = [FrameAggregator._layout(m) for m in modules]
+            if layout is None:
+                layout = (shape, dsets[0][1], fill)
+            if (shape, dsets[0][1], fill) != layout or any(d[1] != layout[1] for d in dsets):
+                return None
+            parts.append((os.path.basename(path), modules, dsets, slices, start, stop))
+        if layout is None or (layout[1].kind != 'f' and not float(layout[2]).is_integer()):
+            return None
+        n = sum(stop - start for *_, start, stop in parts)
+        vds = h5py.VirtualLayout((n,) + layout[0], dtype=layout[1])
+        names = []
+        pos = 0
+        for name, modules, dsets, slices, start, stop in parts:
+            for module, (dshape, dtype), sl in zip(modules, dsets, slices):
+                # relative to the output file, so both can be moved together
+                try:
+                    module = os.path.relpath(module, os.path.dirname(os.path.abspath(fname)))
+                except ValueError:
+                    module = os.path.abspath(module)
+                source = h5py.VirtualSource(module, '/entry/instrument/detector/data', shape=dshape, dtype=dtype)
+                vds[(slice(pos, pos + stop - start),) + sl] = source[start:stop]
+            names.extend('%s_%05d' %(name, i+1) for i in range(start, stop))
+            pos += stop - start
+        with h5py.File(fname, 'w') as f:
+            f.create_virtual_dataset('data', vds, fillvalue=layout[2])
+            f.create_dataset('names', data=names, dtype=h5py.string_dtype())
+        return n
+
+
+class RegionOfInterest:
+    '''Rectangle or annulus drawn on the displayed pattern
+
+    The region is kept as a mask in frame coordinates (before the display
+    transform) and its bounding box ``window``, the only part of a frame
+    that has to be read.  ``weights`` is the mask inside the window.
+
+    :param mask: boolean image of the frame, True inside the region
+    :param kind: one of ``kinds``
+    '''
+    kinds = ('rectangle', 'annulus')
+
+    def __init__(self, mask, kind='rectangle'):
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if not len(rows):
+            raise ValueError('the region does not cover any pixel of the frame')
+        self.kind = kind
+        self.shape = mask.shape
+        self.window = np.s_[int(rows[0]):int(rows[-1])+1, int(cols[0]):int(cols[-1])+1]
+        self.weights = mask[self.window]
+
+    @classmethod
+    def rectangle(cls, shape, pos, size, transform='None'):
+        '''rectangle with the corner ``pos`` and ``size`` in display
+        (transformed) pixel coordinates'''
+        mask = np.zeros(shape, dtype=bool)
+        view = DisplayPipeline.apply_transform(mask, transform)
+        (x0, y0), (x1, y1) = [[max(int(round(v)), 0) for v in p] for p in (pos, np.add(pos, size))]
+        view[x0:x1, y0:y1] = True
+        return cls(mask, 'rectangle')
+
+    @classmethod
+    def annulus(cls, shape, center, inner, outer, transform='None'):
+        '''pixels with their center between the radii ``inner`` and
+        ``outer`` around ``center`` in display coordinates'''
+        mask = np.zeros(shape, dtype=bool)
+        view = DisplayPipeline.apply_transform(mask, transform)
+        # only the bounding box of the outer circle
+        box = tuple(slice(max(int(c - outer), 0), max(int(c + outer) + 2, 0)) for c in center)
+        x = np.arange(*box[0].indices(view.shape[0]))[:, np.newaxis] + 0.5 - center[0]
+        y = np.arange(*box[1].indices(view.shape[1]))[np.newaxis, :] + 0.5 - center[1]
+        r2 = x*x + y*y
+        view[box] = (r2 >= inner*inner) & (r2 < outer*outer)
+        return cls(mask, 'annulus')
+
+
+def _roi_sums(block, weights, hot=None):
+    # sum of the weighted pixels of each frame of a stack of windows,
+    # without pixels <0 or >=hot (detector conventions for bad pixels)
+    values = block.reshape(len(block), -1) if weights.all() else block[:, weights]
+    if hot is not None:
+        values = np.where((values >= 0) & (values < hot), values, 0)
+    return values.sum(axis=1, dtype=np.float64)
+
+
+def _roi_cbfs(fnames, shape, window, weights, hot):
+    # worker of RoiSeries, sums of the region in cbf files (nan if unreadable)
+    out = np.full(len(fnames), np.nan)
+    for i, fname in enumerate(fnames):
+        try:
+            try:
+                data = read_cbf(fname, window[0])
+            except ValueError:
+                data = np.asarray(fabio.open(fname).data)[window[0]]
+        except (OSError, ValueError) as e:
+            print('skipping %s: %s' %(fname, e))
+            continue
+        if data.shape[1] != shape[1] or len(data) != weights.shape[0]:
+            continue
+        out[i] = _roi_sums(data[np.newaxis, :, window[1]], weights, hot)[0]
+    return out
+
+
+class RoiSeries:
+    '''Integrated intensity of a ``RegionOfInterest`` in each frame of a
+    series, e.g. a kinetics scan
+
+    Only the window of the region is read: hyperslabs of NeXus datasets
+    (of the modules overlapping it for stitched detectors), and cbf files
+    are decoded down to the last row of the window only.  Datasets are
+    read in chunks of frames, cbf files in batches on a spawn process
+    pool.  Masked pixels (``DetectorMasks``) are left out.
+
+    :param roi: the region
+    :type roi: RegionOfInterest
+    :param geometry: stitched layout of the frames the region was drawn on
+    :type geometry: DetectorGeometry
+    :param chunk_bytes: size of the windows read from a dataset at once
+    :param batch: cbf files per task
+    :param workers: worker processes for cbf files
+    '''
+    def __init__(self, roi, geometry=None, masks=detector_masks, chunk_bytes=64 * 2**20, batch=32, workers=None):
+        self.roi = roi
+        self.geometry = geometry
+        self.chunk_bytes = chunk_bytes
+        self.batch = batch
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        static = masks.array(roi.shape, geometry)
+        self.weights = roi.weights if static is None else roi.weights & ~static[roi.window]
+        self.hot = masks.hot if masks.enabled and masks.conventions else None
+        self.pixels = int(self.weights.sum())
+
+    def run(self, sources, progress=None, cancelled=None, partial=None):
+        '''sums of the region in the frames of ``sources`` (kind, path,
+        start, stop), like ``FrameAggregator``
+
+        :param progress: called with (frames done, frames) after each chunk
+        :param cancelled: returns True to stop
+        :param partial: called with (first frame, sums) after each chunk
+        :returns: sums in the order of the frames, nan for frames that could
+                  not be read or are of another shape; None if cancelled
+        '''
+        total = FrameAggregator.count(sources)
+        out = np.full(total, np.nan)
+        self._done = 0
+        def step(pos, sums):
+            out[pos:pos+len(sums)] = sums
+            self._done += len(sums)
+            if partial is not None:
+                partial(pos, sums)
+            if progress is not None:
+                progress(self._done, total)
+            if cancelled is not None and cancelled():
+                raise _Cancelled()
+
+        cbfs = []
+        pos = 0
+        try:
+            for kind, path, start, stop in sources:
+                if kind == FileIndex.CBF:
+                    cbfs.append((pos, path))
+                    pos += 1
+                    continue
+                try:
+                    if kind == FileIndex.LAMBDA:
+                        self._read_dataset(path, pos, start, stop, step)
+                    else:
+                        self._read_modules(path, pos, start, stop, step)
+                except (OSError, KeyError, ValueError) as e:
+                    print('skipping %s: %s' %(path, e))
+                    step(pos, np.full(stop - start, np.nan))
+                pos += stop - start
+            self._read_cbfs(cbfs, step)
+        except _Cancelled:
+            return None
+        return out
+
+    def _chunk_frames(self, dtype):
+        return max(1, self.chunk_bytes // (dtype.itemsize * self.roi.weights.size))
+
+    def _read_dataset(self, fname, pos, start, stop, step):
+        shape, dtype = FrameAggregator._layout(fname)
+        if shape[1:] != self.roi.shape:
+            raise ValueError('frames of another shape')
+        rows, cols = self.roi.window
+        n = self._chunk_frames(dtype)
+        for i in range(start, stop, n):
+            block = FrameAggregator._read(fname, np.s_[i:min(i+n, stop), rows, cols])
+            step(pos + i - start, _roi_sums(block, self.weights, self.hot))
+
+    def _read_modules(self, prefix, pos, start, stop, step):
+        reader = Lambda3MReader(prefix)
+        reader.open()
+        reader.close()
+        g = reader.geometry
+        if g.shape != self.roi.shape:
+            raise ValueError('frames of another shape')
+        # the part of each module inside the window, in module and window coordinates
+        rows, cols = self.roi.window
+        parts = []
+        for fname, (y, x) in zip(reader._fnames, g.offsets):
+            r0, r1 = max(rows.start, y), min(rows.stop, y + g.tile[0])
+            c0, c1 = max(cols.start, x), min(cols.stop, x + g.tile[1])
+            if r0 < r1 and c0 < c1:
+                parts.append((fname, np.s_[r0-y:r1-y, c0-x:c1-x],
+                              np.s_[r0-rows.start:r1-rows.start, c0-cols.start:c1-cols.start]))
+        # each part is summed as read (module type), the weighted gap
+        # pixels add the fill value
+        gaps = self.pixels - sum(int(self.weights[dst].sum()) for _, _, dst in parts)
+        fill = _roi_sums(np.full((1, 1), g.fill), np.ones((1, 1), dtype=bool), self.hot)[0] * gaps if gaps else 0.
+        n = self._chunk_frames(FrameAggregator._layout(reader._fnames[0])[1])
+        for i in range(start, stop, n):
+            j = min(i+n, stop)
+            sums = np.full(j - i, fill)
+            for fname, src, dst in parts:
+                sums += _roi_sums(FrameAggregator._read(fname, (slice(i, j),) + src), self.weights[dst], self.hot)
+            step(pos + i - start, sums)
+
+    def _read_cbfs(self, cbfs, step):
+        args = (self.roi.shape, self.roi.window, self.weights, self.hot)
+        if len(cbfs) <= self.batch:
+            for pos, fname in cbfs:
+                step(pos, _roi_cbfs([fname], *args))
+            return
+        # runs of consecutive positions, so a batch is one slice of the result
+        batches = []
+        for pos, fname in cbfs:
+            if batches and batches[-1][0] + len(batches[-1][1]) == pos and len(batches[-1][1]) < self.batch:
+                batches[-1][1].append(fname)
+            else:
+                batches.append((pos, [fname]))
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            pending = {}
+            try:
+                while batches or pending:
+                    while batches and len(pending) < 2*self.workers:
+                        pos, fnames = batches.pop(0)
+                        pending[pool.submit(_roi_cbfs, fnames, *args)] = pos
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        step(pending.pop(future), future.result())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class FileIndex:
+    '''Sorted index of the pattern files of a scan
+
+    The entries are stored column-wise in numpy arrays instead of one
+    object per file, so folders with several 100k files stay cheap.  An
+    entry is a cbf file, a (single module) Lambda nexus file or a Lambda 3M
+    file, which is represented by its ``_m01.nxs`` module and named by the
+    common prefix of the module files.
+
+    ``order`` maps the sorted position to the entry number and ``rank``
+    is its inverse; entry numbers never change, new entries are appended.
+    '''
+    CBF, LAMBDA, LAMBDA3M = range(3)
+
+    _lambda3m_regex = re.compile(r'(.*)_(m\d\d).nxs')
+
+    _sort_regex = re.compile(r'(.*)([\d]{5})(r([\d]{1,3}))?(_(\d))?_([\d]{5}).*')
+    ## matches
+    # pvdf_5b04_yscan_full_t_00002_00001.cbf
+    # pvdf_5b04_yscan_full_t_00002r3_00001.cbf
+    # pvdf_5b_02_yscan_0_ii_00004_2_00011.cbf
+
+    def __init__(self):
+        self.dirs = []
+        self._dir_ids = {}
+        self.dir = np.zeros(0, dtype=np.int32)
+        self.name = np.zeros(0, dtype='S1')
+        self.kind = np.zeros(0, dtype=np.uint8)
+        # number of frames in nexus files, -1 until the file was opened
+        self.nframes = np.zeros(0, dtype=np.int32)
+        # sort key (prefix, scan, sub scan, frame), missing numbers are -1
+        self.prefix = np.zeros(0, dtype='S1')
+        self.scan = np.zeros(0, dtype=np.int64)
+        self.sub = np.zeros(0, dtype=np.int64)
+        self.frame = np.zeros(0, dtype=np.int64)
+        # size and mtime (ns) of the file, -1 if not known yet
+        self.size = np.zeros(0, dtype=np.int64)
+        self.mtime = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+        self.rank = np.zeros(0, dtype=np.int64)
+
+    # per entry arrays
+    columns = ('dir', 'name', 'kind', 'nframes', 'prefix', 'scan', 'sub', 'frame', 'size', 'mtime')
+
+    def __len__(self):
+        return len(self.order)
+
+    @classmethod
+    def sort_key(cls, fname):
+        m = cls._sort_regex.match(fname)
+        if m is None:
+            return (fname, -1, -1, -1)
+        if m.group(3) is not None:
+            return (m.group(1), int(m.group(2)), int(m.group(4)), int(m.group(7)))
+        elif m.group(5) is not None:
+            return (m.group(1), int(m.group(2)), int(m.group(6)), int(m.group(7)))
+        return (m.group(1), int(m.group(2)), -1, int(m.group(7)))
+
+    def display_name(self, entry):
+        return os.fsdecode(self.name[entry])
+
+    def path(self, entry):
+        '''file name of a cbf or lambda entry, module prefix of a Lambda 3M entry'''
+        return os.path.join(self.dirs[self.dir[entry]], os.fsdecode(self.name[entry]))
+
+    def file_name(self, entry):
+        '''file name of an entry, the first module for Lambda 3M entries'''
+        if self.kind[entry] == self.LAMBDA3M:
+            return self.path(entry) + '_m01.nxs'
+        return self.path(entry)
+
+    def take(self, keep):
+        '''new index with the entries where the boolean array ``keep`` is set, in the same order'''
+        files = FileIndex()
+        files.dirs, files._dir_ids = list(self.dirs), dict(self._dir_ids)
+        for c in self.columns:
+            setattr(files, c, getattr(self, c)[keep])
+        new_entry = np.cumsum(keep) - 1
+        files._set_order(new_entry[self.order[keep[self.order]]])
+        return files
+
+    def append(self, paths):
+        '''add pattern files, files of other types and the other modules of
+        Lambda 3M files are skipped
+
+        New entries are placed at the end until ``sort`` is called.
+
+        :returns: number of entries added
+        '''
+        dirs, names, kinds, keys = [], [], [], []
+        for path in paths:
+            dirname, fname = os.path.split(path)
+            if fname.endswith('.cbf'):
+                kind, name = self.CBF, fname
+            elif fname.endswith('.nxs'):
+                m = self._lambda3m_regex.match(fname)
+                if m is None:
+                    kind, name = self.LAMBDA, fname
+                elif m.group(2) == 'm01':
+                    kind, name = self.LAMBDA3M, m.group(1)
+                else:
+                    continue
+            else:
+                continue
+            d = self._dir_ids.get(dirname)
+            if d is None:
+                d = self._dir_ids[dirname] = len(self.dirs)
+                self.dirs.append(dirname)
+            dirs.append(d)
+            names.append(os.fsencode(name))
+            kinds.append(kind)
+            keys.append(self.sort_key(fname))
+        if not names:
+            return 0
+        n = len(self.name)
+        prefix, scan, sub, frame = zip(*keys)
+        self.dir = np.concatenate([self.dir, np.array(dirs, dtype=np.int32)])
+        self.name = np.concatenate([self.name, np.array(names)])
+        self.kind = np.concatenate([self.kind, np.array(kinds, dtype=np.uint8)])
+        self.nframes = np.concatenate([self.nframes, np.full(len(names), -1, dtype=np.int32)])
+        self.prefix = np.concatenate([self.prefix, np.array([os.fsencode(x) for x in prefix])])
+        self.scan = np.concatenate([self.scan, np.array(scan, dtype=np.int64)])
+        self.sub = np.concatenate([self.sub, np.array(sub, dtype=np.int64)])
+        self.frame = np.concatenate([self.frame, np.array(frame, dtype=np.int64)])
+        self.size = np.concatenate([self.size, np.full(len(names), -1, dtype=np.int64)])
+        self.mtime = np.concatenate([self.mtime, np.full(len(names), -1, dtype=np.int64)])
+        self._set_order(np.concatenate([self.order, np.arange(n, len(self.name))]))
+        return len(names)
+
+    @instrument.timed('sorting')
+    def sort(self):
+        self._set_order(np.lexsort((self.name, self.frame, self.sub, self.scan, self.prefix)))
+
+    def _set_order(self, order):
+        self.order = order
+        self.rank = np.empty_like(order)
+        self.rank[order] = np.arange(len(order))
+
+
+def entry_reader(files, entry):
+    '''reader of an entry of a ``FileIndex``, nexus files are not opened yet'''
+    kind = files.kind[entry]
+    if kind == FileIndex.CBF:
+        return CBFreader(files.path(entry))
+    elif kind == FileIndex.LAMBDA:
+        return LambdaReader(files.path(entry))
+    return Lambda3MReader(files.path(entry))
+
+
+def iter_pattern_files(name):
+    '''file names for the path entered in the viewer: a glob pattern or, if
+    no glob is used, all pattern files in the folder'''
+    if any([i in name for i in '[*?']):
+        yield from glob.iglob(name)
+    else:
+        # use all files in folder
+        with os.scandir(os.path.dirname(name) or os.curdir) as it:
+            for entry in it:
+                if entry.name.endswith(('.cbf', '.nxs')):
+                    yield entry.path
+
+
+def list_new_files(name, seen):
+    '''absolute paths for the path entered in the viewer (see
+    ``iter_pattern_files``) which are not in ``seen``, absolute like the
+    folder of a ``ScanIndex``'''
+    paths = (os.path.abspath(path) for path in iter_pattern_files(name))
+    return [path for path in paths if path not in seen]
+
+
+class ScanIndex:
+    '''Persistent ``FileIndex`` of a folder
+
+    The index is kept as a npz file per folder in the user cache directory
+    (beamtime folders are often read-only), together with the mtime of the
+    folder.  Reopening an unchanged folder loads the sorted index without
+    listing it.  Otherwise the folder is listed, removed files are dropped,
+    the frame counts of modified nexus files are reset and only the new
+    files need to be parsed.
+
+    :param dirname: folder name
+    :type dirname: string
+    '''
+    version = 1
+
+    def __init__(self, dirname, cache_dir=None):
+        self.dirname = os.path.abspath(dirname)
+        digest = hashlib.sha1(os.fsencode(self.dirname)).hexdigest()
+        self.fname = os.path.join(cache_dir or user_cache_dir(), 'index', digest + '.npz')
+        self.dirty = False
+        self._dir_mtime = -1
+        self._writer = None
+
+    def _read(self):
+        if self._writer is not None:
+            self._writer.join()
+        try:
+            with np.load(self.fname) as f:
+                if int(f['version']) != self.version:
+                    return None, -1
+                files = FileIndex()
+                files.dirs, files._dir_ids = [self.dirname], {self.dirname: 0}
+                for c in FileIndex.columns:
+                    setattr(files, c, f[c])
+                # entries under another name of the folder (e.g. added with
+                # a relative path) are not valid here, the folder is listed again
+                if (files.dir != 0).any():
+                    raise ValueError('entries outside of %s' %self.dirname)
+                files._set_order(f['order'])
+                return files, int(f['dir_mtime'])
+        except (OSError, KeyError, ValueError) as e:
+            if os.path.exists(self.fname):
+                print('ignoring scan index %s: %s' %(self.fname, e))
+            return None, -1
+
+    @instrument.timed('listing')
+    def load(self):
+        '''stored index of the folder and the paths of files that are not in it
+
+        :returns: (FileIndex, iterable of paths)
+        '''
+        files, dir_mtime = self._read()
+        st = os.stat(self.dirname)
+        # if the folder changes within the mtime granularity after listing
+        # it, an equal mtime would hide the change ("racily clean")
+        racy = time.time_ns() - st.st_mtime_ns < 2_000_000_000
+        self._dir_mtime = -1 if racy else st.st_mtime_ns
+        if files is None:
+            self.dirty = True
+            return FileIndex(), iter_pattern_files(os.path.join(self.dirname, ''))
+        if dir_mtime == st.st_mtime_ns:
+            self.dirty = False
+            return files, []
+        self.dirty = True
+
+        names = set()
+        with os.scandir(self.dirname) as it:
+            for entry in it:
+                if entry.name.endswith(('.cbf', '.nxs')):
+                    names.add(entry.name)
+        known = [os.path.basename(files.file_name(e)) for e in range(len(files.name))]
+        keep = np.array([n in names for n in known], dtype=bool)
+        if not keep.all():
+            files = files.take(keep)
+            known = [n for n, k in zip(known, keep) if k]
+        # nexus files may have grown, they are opened again anyway
+        for e in np.flatnonzero(files.kind != FileIndex.CBF):
+            try:
+                mtime = os.stat(files.file_name(e)).st_mtime_ns
+            except OSError:
+                mtime = -1
+            if mtime != files.mtime[e]:
+                files.nframes[e] = -1
+                files.size[e] = files.mtime[e] = -1
+        new = sorted(names.difference(known))
+        return files, [os.path.join(self.dirname, n) for n in new]
+
+    def save(self, files, wait=False):
+        '''write the index, stat calls for new entries and writing the file
+        happen in a background thread unless ``wait`` is set'''
+        arrays = {c: getattr(files, c).copy() for c in FileIndex.columns}
+        arrays['order'] = files.order.copy()
+        file_names = [files.file_name(e) for e in np.flatnonzero(files.mtime < 0)]
+        self.dirty = False
+        if self._writer is not None:
+            self._writer.join()
+        self._writer = threading.Thread(target=self._write, args=(arrays, file_names), daemon=not wait)
+        self._writer.start()
+        if wait:
+            self._writer.join()
+
+    def _write(self, arrays, file_names):
+        for e, fname in zip(np.flatnonzero(arrays['mtime'] < 0), file_names):
+            try:
+                st = os.stat(fname)
+                arrays['size'][e], arrays['mtime'][e] = st.st_size, st.st_mtime_ns
+            except OSError:
+                pass
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            tmp = self.fname + '.%d.tmp' %os.getpid()
+            with open(tmp, 'wb') as f:
+                np.savez(f, version=self.version, dir_mtime=self._dir_mtime, **arrays)
+            os.replace(tmp, self.fname)
+        except OSError as e:
+            print('could not write scan index %s: %s' %(self.fname, e))
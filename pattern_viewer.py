@@ -1,169 +1,652 @@
 import sys
-import glob
 import os
-import re
-import datetime
+import itertools
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-import pyqtgraph as pg
-
 import numpy as np
-import h5py
-import fabio
-from PIL import Image
+
+from pattern_io import *
+
+# imported with the first widget, so importing this module stays cheap
+pg = LazyModule('pyqtgraph')
+GradientEditorItem = LazyModule('pyqtgraph.graphicsItems.GradientEditorItem')
 
 __version__ = '0.9'
 
 ## build with
 # pyinstaller  pattern_viewer.spec
 
-from pyqtgraph.graphicsItems import GradientEditorItem
 
-GradientEditorItem.Gradients.update(
-    {'viridis': {'ticks': [(0.0, (68, 1, 84, 255)), (0.25, (58, 82, 139, 255)), (0.5, (32, 144, 140, 255)), (0.75, (94, 201, 97, 255)), (1.0, (253, 231, 36, 255))], 'mode': 'rgb'},
-    'inferno': {'ticks': [(0.0, (0, 0, 3, 255)), (0.25, (87, 15, 109, 255)), (0.5, (187, 55, 84, 255)), (0.75, (249, 142, 8, 255)), (1.0, (252, 254, 164, 255))], 'mode': 'rgb'},
-    'plasma':  {'ticks': [(0.0, (12, 7, 134, 255)), (0.25, (126, 3, 167, 255)), (0.5, (203, 71, 119, 255)), (0.75, (248, 149, 64, 255)), (1.0, (239, 248, 33, 255))], 'mode': 'rgb'},
-    'magma':   {'ticks': [(0.0, (0, 0, 3, 255)), (0.25, (80, 18, 123, 255)), (0.5, (182, 54, 121, 255)), (0.75, (251, 136, 97, 255)), (1.0, (251, 252, 191, 255))], 'mode': 'rgb'}})
+def add_gradients():
+    '''matplotlib colour maps for the gradient editor of pyqtgraph'''
+    GradientEditorItem.Gradients.update(
+        {'viridis': {'ticks': [(0.0, (68, 1, 84, 255)), (0.25, (58, 82, 139, 255)), (0.5, (32, 144, 140, 255)), (0.75, (94, 201, 97, 255)), (1.0, (253, 231, 36, 255))], 'mode': 'rgb'},
+        'inferno': {'ticks': [(0.0, (0, 0, 3, 255)), (0.25, (87, 15, 109, 255)), (0.5, (187, 55, 84, 255)), (0.75, (249, 142, 8, 255)), (1.0, (252, 254, 164, 255))], 'mode': 'rgb'},
+        'plasma':  {'ticks': [(0.0, (12, 7, 134, 255)), (0.25, (126, 3, 167, 255)), (0.5, (203, 71, 119, 255)), (0.75, (248, 149, 64, 255)), (1.0, (239, 248, 33, 255))], 'mode': 'rgb'},
+        'magma':   {'ticks': [(0.0, (0, 0, 3, 255)), (0.25, (80, 18, 123, 255)), (0.5, (182, 54, 121, 255)), (0.75, (251, 136, 97, 255)), (1.0, (251, 252, 191, 255))], 'mode': 'rgb'}})
+
 
+class PatternListModel(QAbstractItemModel):
+    '''Tree model of a ``FileIndex``
 
-class CBFreader:
-    '''Reader for CBF files
+    Top level rows are the sorted entries, the frames of multi frame nexus
+    files are virtual child rows.  The internal id of an index is 0 for top
+    level rows and entry+1 for child rows.
+
+    Virtual patterns (``AggregateFrame``) follow the file rows at the top
+    level.
+    '''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.files = FileIndex()
+        self.virtual = []
+        self._rows = 0
+
+    def entry(self, index):
+        '''entry number of the top level row of ``index``'''
+        if index.internalId():
+            return index.internalId() - 1
+        return int(self.files.order[index.row()])
+
+    def virtual_frame(self, index):
+        '''virtual pattern of ``index``, None for files and frames'''
+        if index.isValid() and not index.internalId() and index.row() >= self._rows:
+            return self.virtual[index.row() - self._rows]
+        return None
+
+    def add_virtual(self, frame):
+        '''append a virtual pattern, returns its index'''
+        row = self._rows + len(self.virtual)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.virtual.append(frame)
+        self.endInsertRows()
+        return self.index(row, 0)
+
+    def top_index(self, entry):
+        return self.createIndex(int(self.files.rank[entry]), 0, 0)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        return self.createIndex(row, column, self.entry(parent) + 1)
+
+    def parent(self, index):
+        if not index.isValid() or not index.internalId():
+            return QModelIndex()
+        return self.top_index(index.internalId() - 1)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self._rows + len(self.virtual)
+        if parent.internalId() or parent.row() >= self._rows:
+            return 0
+        n = self.files.nframes[self.files.order[parent.row()]]
+        return int(n) if n > 1 else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        if index.internalId():
+            return "%05d" %(index.row()+1)
+        if index.row() >= self._rows:
+            return self.virtual[index.row() - self._rows].name
+        return self.files.display_name(self.files.order[index.row()])
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def clear(self):
+        self.set_files(FileIndex())
+
+    def set_files(self, files):
+        self.beginResetModel()
+        self.files = files
+        self.virtual = []
+        self._rows = len(files)
+        self.endResetModel()
+
+    def add_files(self, paths):
+        '''add files and keep the rows sorted, the views keep their current item'''
+        added = self.files.append(paths)
+        if not added:
+            return 0
+        # appended entries are at the end of the order until sorted
+        self.beginInsertRows(QModelIndex(), self._rows, self._rows + added - 1)
+        self._rows += added
+        self.endInsertRows()
+
+        old_order = self.files.order
+        self.layoutAboutToBeChanged.emit()
+        self.files.sort()
+        for index in self.persistentIndexList():
+            if index.isValid() and not index.internalId() and index.row() < self._rows:
+                self.changePersistentIndex(index, self.top_index(old_order[index.row()]))
+        self.layoutChanged.emit()
+        return added
+
+    def set_frames(self, entry, n):
+        '''number of frames of a nexus entry is known, adds the child rows
+        (or removes them if the file has fewer frames now)
+
+        :returns: True if the number of frames changed
+        '''
+        if self.files.nframes[entry] == n:
+            return False
+        parent = self.top_index(entry)
+        old = self.rowCount(parent)
+        rows = n if n > 1 else 0
+        if rows > old:
+            self.beginInsertRows(parent, old, rows - 1)
+            self.files.nframes[entry] = n
+            self.endInsertRows()
+        elif rows < old:
+            self.beginRemoveRows(parent, rows, old - 1)
+            self.files.nframes[entry] = n
+            self.endRemoveRows()
+        else:
+            self.files.nframes[entry] = n
+        return True
 
-    :param fname: file name of cbf file
-    :type fname: string
 
-    .. autoinstanceattribute:: map
-       :annotation:
+class BackgroundJob(QThread):
+    '''Runs ``fn(progress, cancelled)`` in a thread
 
-        array of the image
+    ``fn`` reports with ``progress(done, total)`` and should return early
+    when ``cancelled()`` is True.  Its result is emitted with ``done``,
+    an exception with ``failed``.
     '''
-    def __init__(self, fname):
-        self.fname = fname
-        self.name = os.path.basename(self.fname)
-
-    def image(self):
-        print('opening file %s' %self.name)
-        self.file = fabio.open(self.fname)
-        return self.file.data
-    
-    def close(self):
-        print('closing file %s' %self.name)
-        self.file.close()
-
-
-class LambdaReader:
-    def __init__(self, fname):
-        self.fname = fname
-        self.name = os.path.basename(self.fname)
-        self.is_open = False
-        self.sub_item_map = {}
-
-    def open(self):
-        print('opening file %s' %self.name)
-        self.file = h5py.File(self.fname, 'r')
-        self.data = self.file['/entry/instrument/detector/data']
-        self.images = range(self.data.shape[0])
-        self.is_open = True
-
-    def close(self):
-        print('closing file %s' %self.name)
-        self.file.close()
-        self.sub_item_map = {}
-        self.is_open = False
-
-    def image(self, idx):
-        return self.data[idx]
-
-class LambdaItem:
-    def __init__(self, reader, item):
-        self.reader = reader
-        self.item = item
-        self.name = self.reader.name + '_%05d' %(item+1)
-
-    def image(self):
-        return self.reader.image(self.item)
-
-class Lambda3MReader:
-    def __init__(self, fname):
-        self.fname = fname
-        self.name = os.path.basename(self.fname)
-        self.is_open = False
-        self.sub_item_map = {}
-
-        self.tile_x=1556
-        self.tile_y=516
-
-    def open(self):
-        print('opening file %s' %self.name)
-        ## initial code from A.R.
-        # hdf5 convention is [z,y,x]
-        # for lambda, float32 is sufficient
-        ### would be better to init with NaNs
-        self.merged_im = np.zeros([1834,3147], dtype='float32')
-        #self.merged_im[:] = np.nan  # pyqtgraph gets confused?
-
-        self.f01 = h5py.File(self.fname+"_m01.nxs", "r")
-        self.f01_dset = self.f01['/entry/instrument/detector/data']
-        self.f02 = h5py.File(self.fname+"_m02.nxs", "r")
-        self.f02_dset = self.f02['/entry/instrument/detector/data']
-        self.f03 = h5py.File(self.fname+"_m03.nxs", "r")
-        self.f03_dset = self.f03['/entry/instrument/detector/data']
-        self.f04 = h5py.File(self.fname+"_m04.nxs", "r")
-        self.f04_dset = self.f04['/entry/instrument/detector/data']
-
-        self.images = range(self.f01_dset.shape[0])
-        self.is_open = True
-
-    def close(self):
-        print('closing file %s' %self.name)
-        self.f01.close()
-        self.f02.close()
-        self.f03.close()
-        self.f04.close()
-        self.sub_item_map = {}
-        self.is_open = False
-
-    def image(self, idx):
-        # the stitching code is from  Andre Rothkirch <andre.rothkirch@desy.de>
-        self.merged_im[:] = 0# np.nan
-        self.merged_im[1311:1311+self.tile_y,0:self.tile_x] = self.f01_dset[idx,:,:]
-        self.merged_im[0:self.tile_y,1587:1587+self.tile_x] = self.f02_dset[idx,:,:]
-        self.merged_im[658:658+self.tile_y,1591:1591+self.tile_x] = self.f03_dset[idx,:,:]
-        self.merged_im[1318:1318+self.tile_y,1584:1584+self.tile_x] = self.f04_dset[idx,:,:]
-        return self.merged_im
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, fn, parent=None):
+        super().__init__(parent)
+        self._fn = fn
+
+    def run(self):
+        try:
+            result = self._fn(self.progress.emit, self.isInterruptionRequested)
+        except Exception as e:
+            self.failed.emit('%s: %s' %(type(e).__name__, e))
+            return
+        self.done.emit(result)
+
+    def cancel(self):
+        self.requestInterruption()
+
+
+class IntegrationPanel(QWidget):
+    '''Radial profile of the current frame (``AzimuthalIntegrator``)
+
+    ``changed`` is emitted when a parameter was edited.
+    '''
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.integrator = AzimuthalIntegrator()
+
+        def spin_box(value, maximum, decimals, suffix=''):
+            box = QDoubleSpinBox(self)
+            box.setRange(0, maximum)
+            box.setDecimals(decimals)
+            box.setValue(value)
+            box.setSuffix(suffix)
+            box.setKeyboardTracking(False)
+            box.valueChanged.connect(self._set_parameters)
+            return box
+        self.center0_box = spin_box(0, 1e5, 1, ' px')
+        self.center1_box = spin_box(0, 1e5, 1, ' px')
+        self.distance_box = spin_box(self.integrator.distance, 1e5, 1, ' mm')
+        self.pixel_box = spin_box(self.integrator.pixel_size, 10, 4, ' mm')
+        self.wavelength_box = spin_box(self.integrator.wavelength, 100, 4, ' Å')
+        self.unit_box = QComboBox(self)
+        for unit, label in self.integrator.units.items():
+            self.unit_box.addItem(label, unit)
+        self.unit_box.currentIndexChanged.connect(self._set_parameters)
+        self.bins_box = QSpinBox(self)
+        self.bins_box.setRange(10, 100000)
+        self.bins_box.setValue(self.integrator.bins)
+        self.bins_box.setKeyboardTracking(False)
+        self.bins_box.valueChanged.connect(self._set_parameters)
+        self.split_box = QSpinBox(self)
+        self.split_box.setRange(1, 8)
+        self.split_box.setToolTip("split pixels into n x n sub-pixels (fast with scipy, reduced for large frames)")
+        self.split_box.valueChanged.connect(self._set_parameters)
+        self.log_checkbox = QCheckBox("log")
+        self.log_checkbox.toggled.connect(lambda on: self.plot.setLogMode(y=on))
+
+        self.plot = pg.PlotWidget()
+        self.curve = self.plot.plot()
+
+        form = QFormLayout()
+        form.addRow('center (x, y)', self._row(self.center0_box, self.center1_box))
+        form.addRow('distance', self.distance_box)
+        form.addRow('pixel size', self.pixel_box)
+        form.addRow('wavelength', self.wavelength_box)
+        form.addRow('unit', self._row(self.unit_box, self.log_checkbox))
+        form.addRow('bins, split', self._row(self.bins_box, self.split_box))
+        layout = QVBoxLayout()
+        layout.addLayout(form)
+        layout.addWidget(self.plot)
+        self.setLayout(layout)
+        self._set_parameters()
+
+    @staticmethod
+    def _row(*widgets):
+        layout = QHBoxLayout()
+        for w in widgets:
+            layout.addWidget(w)
+        return layout
+
+    def set_center(self, center):
+        for box, value in zip((self.center0_box, self.center1_box), center):
+            box.blockSignals(True)
+            box.setValue(value)
+            box.blockSignals(False)
+        self._set_parameters()
+
+    def _set_parameters(self):
+        ai = self.integrator
+        ai.center = (self.center0_box.value(), self.center1_box.value())
+        ai.distance = self.distance_box.value()
+        ai.pixel_size = self.pixel_box.value()
+        ai.wavelength = self.wavelength_box.value()
+        ai.unit = self.unit_box.currentData()
+        ai.bins = self.bins_box.value()
+        ai.split = self.split_box.value()
+        self.plot.setLabel('bottom', self.unit_box.currentText())
+        self.changed.emit()
+
+    def update_profile(self, frame, transform='None', mask=None, mask_key=None):
+        x, y = self.integrator.integrate(frame, transform, mask, mask_key)
+        self.curve.setData(x, y, connect='finite')
+
+
+class RoiPanel(QWidget):
+    '''Integrated intensity of a region of interest in each frame of the
+    timeline (``RoiSeries``)
+
+    The region is drawn on the pattern view, a rectangle or a circle whose
+    inner radius makes it an annulus.  The sums arrive in chunks from the
+    worker thread through ``partial`` (first frame, sums) and are added to
+    the plot as they come.  ``frame_clicked`` is emitted with the row of a
+    point clicked in the plot.
+    '''
+    partial = pyqtSignal(int, object)
+    frame_clicked = pyqtSignal(int)
+
+    def __init__(self, view, parent=None):
+        super().__init__(parent)
+        self.view = view
+        self.region = None
+        self._inner = None
+        self.values = None
+
+        self.kind_box = QComboBox(self)
+        self.kind_box.addItems(RegionOfInterest.kinds)
+        self.kind_box.currentIndexChanged.connect(self._new_region)
+        self.inner_box = QDoubleSpinBox(self)
+        self.inner_box.setRange(0, 1e5)
+        self.inner_box.setDecimals(1)
+        self.inner_box.setSuffix(' px')
+        self.inner_box.setToolTip("inner radius of the annulus")
+        self.inner_box.valueChanged.connect(self._update_inner)
+        self.run_button = QPushButton('integrate')
+        self.run_button.setToolTip("sum of the region in all frames of the timeline")
+        self.label = QLabel()
+
+        self.plot = pg.PlotWidget()
+        self.plot.setLabel('bottom', 'frame')
+        self.plot.setLabel('left', 'intensity')
+        self.curve = self.plot.plot()
+        self.plot.scene().sigMouseClicked.connect(self._clicked)
+        self.partial.connect(self._add_values)
+
+        layout = QVBoxLayout()
+        layout.addLayout(IntegrationPanel._row(self.kind_box, self.inner_box, self.run_button))
+        layout.addWidget(self.label)
+        layout.addWidget(self.plot)
+        self.setLayout(layout)
+        self._new_region()
+
+    def show_region(self, on, shape=None):
+        '''show or hide the region, it starts in the middle of a frame of
+        ``shape``'''
+        if on and shape is not None and self.region.scene() is None:
+            self._place(shape)
+            self.view.addItem(self.region)
+        elif not on and self.region.scene() is not None:
+            self.view.removeItem(self.region)
+
+    def _new_region(self):
+        shown = self.region is not None and self.region.scene() is not None
+        if shown:
+            self.view.removeItem(self.region)
+        annulus = self.kind_box.currentText() == 'annulus'
+        self.inner_box.setEnabled(annulus)
+        if annulus:
+            self.region = pg.CircleROI((0, 0), (100, 100), pen='y')
+            # the inner circle moves and scales with the outer one
+            self._inner = QGraphicsEllipseItem(self.region)
+            self._inner.setPen(pg.mkPen('y', style=Qt.DashLine))
+            self.region.sigRegionChanged.connect(self._update_inner)
+        else:
+            self.region = pg.RectROI((0, 0), (100, 100), pen='y')
+            self._inner = None
+        if shown:
+            self._place(self._shape)
+            self.view.addItem(self.region)
+
+    def _place(self, shape):
+        self._shape = shape
+        size = min(shape) / 4.
+        self.region.setPos((shape[0]/2. - size/2., shape[1]/2. - size/2.))
+        self.region.setSize((size, size))
+        self.inner_box.setValue(size / 4.)
+        self._update_inner()
+
+    def _update_inner(self):
+        if self._inner is None:
+            return
+        d = self.region.size()[0]
+        r = min(self.inner_box.value(), d/2.)
+        self._inner.setRect(d/2. - r, d/2. - r, 2*r, 2*r)
+
+    def region_of_interest(self, shape, transform='None'):
+        '''the drawn region for frames of ``shape`` shown with ``transform``'''
+        pos, size = self.region.pos(), self.region.size()
+        if self._inner is None:
+            return RegionOfInterest.rectangle(shape, (pos[0], pos[1]), (size[0], size[1]), transform)
+        outer = size[0] / 2.
+        return RegionOfInterest.annulus(shape, (pos[0] + outer, pos[1] + outer),
+                                        min(self.inner_box.value(), outer), outer, transform)
+
+    def start(self, n, text):
+        self.values = np.full(n, np.nan)
+        self._x = np.arange(1, n+1)
+        self.curve.setData([], [])
+        self.label.setText(text)
+
+    def _add_values(self, first, sums):
+        self.values[first:first+len(sums)] = sums
+        self.curve.setData(self._x, self.values, connect='finite')
+
+    def _clicked(self, event):
+        if self.values is None:
+            return
+        x = self.plot.getViewBox().mapSceneToView(event.scenePos()).x()
+        row = int(round(x)) - 1
+        if 0 <= row < len(self.values):
+            self.frame_clicked.emit(row)
+
+
+class ExportDialog(QDialog):
+    '''Frames, format and compression of an export (``StackExporter``)
+
+    The frame range is in rows of the timeline, i.e. the frames of the
+    nexus file or the files in the list.
+    '''
+    scopes = ('frame', 'selection', 'frame range', 'dataset')
+
+    def __init__(self, count, row, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Export')
+        self.scope_box = QComboBox(self)
+        self.scope_box.addItems(self.scopes)
+        self.scope_box.currentIndexChanged.connect(self._set_scope)
+        self.first_box = QSpinBox(self)
+        self.first_box.setRange(1, max(count, 1))
+        self.first_box.setValue(row + 1)
+        self.last_box = QSpinBox(self)
+        self.last_box.setRange(row + 1, max(count, 1))
+        self.last_box.setValue(max(count, 1))
+        # the range ends at or after its first frame
+        self.first_box.valueChanged.connect(self.last_box.setMinimum)
+        self.format_box = QComboBox(self)
+        self.format_box.addItems(list(StackExporter.formats))
+        self.format_box.setToolTip("multi page BigTIFF, HDF5 stack or NPY memory map")
+        self.format_box.currentIndexChanged.connect(self._set_format)
+        self.compression_box = QComboBox(self)
+        self.compression_box.currentIndexChanged.connect(self._set_compression)
+        self.level_box = QSpinBox(self)
+        self.level_box.setRange(1, 9)
+        self.level_box.setValue(4)
+        self.level_box.setToolTip("compression level, higher is smaller and slower")
+        self.virtual_checkbox = QCheckBox("virtual dataset")
+        self.virtual_checkbox.setToolTip("refer to the frames of the nexus files instead of copying them")
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        form = QFormLayout()
+        form.addRow('frames', self.scope_box)
+        form.addRow('range', IntegrationPanel._row(self.first_box, QLabel('to'), self.last_box))
+        form.addRow('format', self.format_box)
+        form.addRow('compression', IntegrationPanel._row(self.compression_box, self.level_box))
+        form.addRow('', self.virtual_checkbox)
+        layout = QVBoxLayout()
+        layout.addLayout(form)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+        self._set_scope()
+        self._set_format()
+
+    def _set_scope(self):
+        on = self.scope_box.currentText() == 'frame range'
+        self.first_box.setEnabled(on)
+        self.last_box.setEnabled(on)
+
+    def _set_format(self):
+        fmt = self.format_box.currentText()
+        self.compression_box.clear()
+        self.compression_box.addItems(StackExporter.compressions[fmt])
+        self.virtual_checkbox.setEnabled(fmt == 'hdf5')
+
+    def _set_compression(self):
+        self.level_box.setEnabled(self.compression_box.currentText() in ('deflate', 'gzip'))
+
+    def exporter(self):
+        return StackExporter(self.format_box.currentText(), self.compression_box.currentText(),
+                             self.level_box.value(), self.virtual_checkbox.isEnabled() and self.virtual_checkbox.isChecked())
+
+
+class PlaybackBar(QWidget):
+    '''Play/pause, timeline, frame rate and stride of the playback
+
+    The timeline runs over the siblings of the current list item, i.e. the
+    frames of a nexus file or the sorted files.  ``seek`` is emitted when
+    the timeline is moved by the user.
+    '''
+    seek = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.play_button = QPushButton('play')
+        self.play_button.setCheckable(True)
+        self.play_button.toggled.connect(lambda on: self.play_button.setText('pause' if on else 'play'))
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setMinimum(0)
+        self.slider.valueChanged.connect(self._moved)
+        self.frame_label = QLabel()
+        self.fps_box = QDoubleSpinBox(self)
+        self.fps_box.setRange(0.1, 100)
+        self.fps_box.setValue(10)
+        self.fps_box.setSuffix(' fps')
+        self.stride_box = QSpinBox(self)
+        self.stride_box.setRange(1, 10000)
+        self.stride_box.setPrefix('stride ')
+        self.stride_box.setToolTip("show every n-th frame")
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.play_button)
+        layout.addWidget(self.slider)
+        layout.addWidget(self.frame_label)
+        layout.addWidget(self.fps_box)
+        layout.addWidget(self.stride_box)
+        self.setLayout(layout)
+
+    def _moved(self, value):
+        if not self.slider.signalsBlocked():
+            self.seek.emit(value)
+
+    def set_position(self, row, count, fps=None):
+        self.slider.blockSignals(True)
+        self.slider.setMaximum(max(count-1, 0))
+        self.slider.setValue(row)
+        self.slider.blockSignals(False)
+        text = '%d/%d' %(row+1, count)
+        if fps is not None:
+            text += ' (%.1f fps)' %fps
+        self.frame_label.setText(text)
+
+
+class ComparisonBar(QWidget):
+    '''Mode and reference of the comparison
+
+    The reference is either a fixed frame (``reference_button`` takes the
+    current one) or the frame at an offset from the current one in the
+    list, e.g. -1 for the previous frame.  ``changed`` is emitted when a
+    setting was edited.
+    '''
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.mode_box = QComboBox(self)
+        self.mode_box.addItems(FrameComparison.modes)
+        self.reference_box = QComboBox(self)
+        self.reference_box.addItems(['fixed', 'offset'])
+        self.reference_button = QPushButton('set reference')
+        self.reference_button.setToolTip("compare with the current pattern")
+        self.offset_box = QSpinBox(self)
+        self.offset_box.setRange(-100000, 100000)
+        self.offset_box.setValue(-1)
+        self.offset_box.setToolTip("compare with the pattern this many rows away in the list")
+        self.offset_box.setEnabled(False)
+        self.reference_label = QLabel()
+
+        self.mode_box.currentIndexChanged.connect(self.changed)
+        self.reference_box.currentIndexChanged.connect(self._set_reference_mode)
+        self.offset_box.valueChanged.connect(self.changed)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.mode_box)
+        layout.addWidget(QLabel('reference'))
+        layout.addWidget(self.reference_box)
+        layout.addWidget(self.reference_button)
+        layout.addWidget(self.offset_box)
+        layout.addWidget(self.reference_label, 1)
+        self.setLayout(layout)
+
+    @property
+    def offset(self):
+        '''row offset of the reference, None for a fixed reference'''
+        return self.offset_box.value() if self.reference_box.currentText() == 'offset' else None
+
+    def _set_reference_mode(self):
+        fixed = self.offset is None
+        self.reference_button.setEnabled(fixed)
+        self.offset_box.setEnabled(not fixed)
+        self.changed.emit()
 
 
 class PatternViewerWidget(QWidget):
+    # last span durations, while instrumentation is enabled
+    timings_changed = pyqtSignal(str)
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        add_gradients()
         self._is_lambda = False
         self.new = True
         self.pattern = None
         self.pattern_name = ''
         self.curr_item = None
-        self.prev_item = None
         self._last_dir = ''
 
-        self._lambda3m_regex = re.compile(r'(.*)_(m\d\d).nxs')
-
-        self._sort_regex = re.compile(r'((.*)[\\/]+)?(.*)([\d]{5})(r([\d]{1,3}))?(_(\d))?_([\d]{5}).*')
-        ## matches
-        # pvdf_5b04_yscan_full_t_00002_00001.cbf
-        # pvdf_5b04_yscan_full_t_00002r3_00001.cbf
-        # pvdf_5b_02_yscan_0_ii_00004_2_00011.cbf
-
+        # readers are created on demand, keyed by FileIndex entry
         self._reader_map = dict()
+        self.prefetcher = FramePrefetcher(depth=4, workers=min(4, os.cpu_count() or 1))
+        self.pipeline = DisplayPipeline()
+        self._level = 0
+        self.levels_engine = LevelsEngine()
+        self._frame_key = None
+        self._exclude = None
+        self._jobs = set()
+
+        # playback: the timer advances through the siblings of the current
+        # item, a frame is only shown once it has been read ahead, so slow
+        # reads delay a frame instead of blocking the display
+        self.playback = PlaybackBar(self)
+        self._play_timer = QTimer(self)
+        self._play_timer.timeout.connect(self._play_next)
+        self._play_parent = QPersistentModelIndex()
+        self._play_row = 0
+        self._play_shown = deque(maxlen=32)
+
+        # comparison: the reference frame next to the pattern (linked
+        # views and levels) and their difference or ratio
+        self.frame_reader = None
+        self._frame_index = QPersistentModelIndex()
+        self.comparison = FrameComparison()
+        self.reference_pipeline = DisplayPipeline()
+        self._reference_frame = None
+        self._reference_source = None
+        self._reference = None
+        self._difference = None
 
         self.open_button = QPushButton('Open')
         self.path_edit = QLineEdit('enter path (you can use glob syntax; if no glob is used opens all files in folder)')
         self.path_edit.setToolTip('enter path (you can use glob syntax; if no glob is used opens all files in folder)')
-        self.pattern_list = QTreeWidget()
-        self.pattern_list.setHeaderLabel('pattern')
+        self.pattern_model = PatternListModel(self)
+        self.pattern_list = QTreeView()
+        self.pattern_list.setModel(self.pattern_model)
+        self.pattern_list.setUniformRowHeights(True)
         self.pattern_list.header().hide()
         self.pattern_list.setMinimumWidth(50)
+        self.pattern_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
+
+        # folders are listed in growing batches from a timer, so the first
+        # pattern shows up while a large folder is still being scanned
+        self._scan = None
+        self._scan_index = None
+        self._scan_batch = 256
+        self._scan_timer = QTimer(self)
+        self._scan_timer.setInterval(0)
+        self._scan_timer.timeout.connect(self._scan_more)
+
+        # live mode: new files are appended while the detector writes them,
+        # the folder is watched (inotify & co.) and its mtime polled as fallback
+        self.live_checkbox = QCheckBox("live")
+        self.live_checkbox.setToolTip("add new files and frames while they are written")
+        self.follow_checkbox = QCheckBox("show newest")
+        self.follow_checkbox.setToolTip("in live mode, show the newest frame")
+        self.follow_checkbox.setEnabled(False)
+        self._live_watcher = QFileSystemWatcher(self)
+        self._live_timer = QTimer(self)
+        self._live_timer.setInterval(1000)
+        self._live_timer.timeout.connect(self._live_update)
+        self._live_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='live')
+        self._live_listing = None
+        self._live_name = None
+        self._live_seen = set()
+        self._live_dir = None
+        self._live_dir_mtime = None
 
         self.image_label = QLabel()
         self.image_label.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred))
@@ -171,42 +654,91 @@ class PatternViewerWidget(QWidget):
         self.coord_label = QLabel()     
     
         self.transComboBox = QComboBox(self)
-        self.transComboBox.addItem("None")
-        self.transComboBox.addItem("rotate 90")
-        self.transComboBox.addItem("rotate 180")
-        self.transComboBox.addItem("rotate 270")
-        self.transComboBox.addItem("flip up/down")
-        self.transComboBox.addItem("flip left/right")
-        self.transComboBox.addItem("rotate 90 & flip up/down")
-        self.transComboBox.addItem("rotate 90 & flip left/right")
+        self.transComboBox.addItems(list(DisplayPipeline.transforms))
 
         self.scaleComboBox = QComboBox(self)
-        self.scaleComboBox.addItem("lin")
-        self.scaleComboBox.addItem("log10")
-        self.scaleComboBox.addItem("sqrt")
+        self.scaleComboBox.addItems(DisplayPipeline.scales)
+
+        self.aggComboBox = QComboBox(self)
+        self.aggComboBox.addItems(FrameAggregator.modes)
+        self.agg_button = QPushButton('aggregate')
+        self.agg_button.setToolTip("sum, mean or max of the selected files and frames")
 
         self.scale_checkbox = QCheckBox("keep scale")
         self.scale_checkbox.setChecked(True)
         self.scale_checkbox.setToolTip("remember the current scale for all images")
+
+        self.profile_checkbox = QCheckBox("I(q)")
+        self.profile_checkbox.setToolTip("show the radial profile of the pattern")
+        self.profile_panel = IntegrationPanel(self)
+        self.profile_panel.hide()
+        self._geometry = None
+
+        self.mask_checkbox = QCheckBox("mask")
+        self.mask_checkbox.setChecked(detector_masks.enabled)
+        self.mask_checkbox.setToolTip("hide gaps, negative (bad) and overflowing pixels and loaded masks")
         
         ## monkey patch export method to fix bug in pyqtgraph for now
         # pg.ImageView.export = lambda self, fileName: self.imageItem.save(fileName[0])
-        pg.ImageView.exportClicked = self.export_tiff
+        pg.ImageView.exportClicked = self.export_frames
         self.image_widget = pg.ImageView(view=pg.PlotItem())
 
+        self.roi_checkbox = QCheckBox("ROI")
+        self.roi_checkbox.setToolTip("integrated intensity of a region in all frames")
+        self.roi_panel = RoiPanel(self.image_widget.getView(), self)
+        self.roi_panel.hide()
+
+        self.compare_checkbox = QCheckBox("compare")
+        self.compare_checkbox.setToolTip("show a reference pattern and the difference or ratio")
+        self.comparison_bar = ComparisonBar(self)
+        self.comparison_bar.hide()
+        self.reference_view = pg.ImageView(view=pg.PlotItem())
+        # the reference uses the levels of the pattern
+        self.reference_view.ui.histogram.hide()
+        self.reference_view.ui.roiBtn.hide()
+        self.reference_view.ui.menuBtn.hide()
+        self.difference_view = pg.ImageView(view=pg.PlotItem())
+        self.difference_view.ui.histogram.gradient.loadPreset('bipolar')
+        # linked by _sync_range, setXLink/setYLink do not work for views
+        # with locked aspect ratios and different sizes; the pattern view
+        # leads, the others only on zooming or panning with the mouse
+        self._syncing = False
+        main_box = self.image_widget.getView().getViewBox()
+        for view in (self.reference_view, self.difference_view):
+            vb = view.getView().getViewBox()
+            vb.sigRangeChangedManually.connect(lambda mask, vb=vb: self._sync_range(vb))
+            vb.sigResized.connect(lambda vb: self._sync_range(main_box))
+            view.hide()
+
         self.layout = QVBoxLayout()
 
         open_layout = QHBoxLayout()
         open_layout.addWidget(self.path_edit)
         open_layout.addWidget(self.open_button)
+        open_layout.addWidget(self.live_checkbox)
+        open_layout.addWidget(self.follow_checkbox)
         
         label_layout = QHBoxLayout()
         label_layout.addWidget(self.image_label)
         label_layout.addWidget(self.scale_checkbox)
+        label_layout.addWidget(self.mask_checkbox)
+        label_layout.addWidget(self.profile_checkbox)
+        label_layout.addWidget(self.compare_checkbox)
+        label_layout.addWidget(self.roi_checkbox)
         
+        splitter_image = QSplitter(Qt.Horizontal)
+        splitter_image.addWidget(self.image_widget)
+        splitter_image.addWidget(self.reference_view)
+        splitter_image.addWidget(self.difference_view)
+        splitter_image.addWidget(self.profile_panel)
+        splitter_image.addWidget(self.roi_panel)
+        splitter_image.setCollapsible(0, False)
+
         image_layout = QVBoxLayout()
         image_layout.addLayout(label_layout)
-        image_layout.addWidget(self.image_widget)
+        image_layout.addWidget(self.comparison_bar)
+        image_layout.addWidget(splitter_image)
+        image_layout.addWidget(self.playback)
         image_layout.addWidget(self.coord_label)
         image_widget = QWidget(self)
         image_widget.setLayout(image_layout)
@@ -217,6 +749,10 @@ class PatternViewerWidget(QWidget):
         file_layout.addWidget(self.transComboBox)
         file_layout.addWidget(QLabel('scale'))
         file_layout.addWidget(self.scaleComboBox)       
+        agg_layout = QHBoxLayout()
+        agg_layout.addWidget(self.aggComboBox)
+        agg_layout.addWidget(self.agg_button)
+        file_layout.addLayout(agg_layout)
         file_layout.addWidget(self.pattern_list)
         file_widget = QFrame()
        # file_widget.setFrameShape(QFrame.StyledPanel)
@@ -240,10 +776,32 @@ class PatternViewerWidget(QWidget):
 
         self.path_edit.returnPressed.connect(self.retPressed)
         self.open_button.clicked.connect(self.getfile)
-        self.pattern_list.currentItemChanged.connect(self.show_pattern)
+        self.pattern_list.selectionModel().currentChanged.connect(self.show_pattern)
         self.scaleComboBox.currentIndexChanged.connect(self._set_pattern)
         self.transComboBox.currentIndexChanged.connect(self._set_pattern)
+        self.live_checkbox.toggled.connect(self.set_live)
+        self.agg_button.clicked.connect(self.aggregate)
+        self.mask_checkbox.toggled.connect(self.set_masked)
+        self.profile_checkbox.toggled.connect(self.show_profile)
+        self.profile_panel.changed.connect(self.update_profile)
+        self.playback.play_button.toggled.connect(self.set_playing)
+        self.playback.fps_box.valueChanged.connect(self._set_fps)
+        self.playback.seek.connect(self.seek)
+        self.compare_checkbox.toggled.connect(self.show_comparison)
+        self.comparison_bar.changed.connect(self._reference_changed)
+        self.roi_checkbox.toggled.connect(self.show_roi)
+        self.roi_panel.run_button.clicked.connect(self.roi_series)
+        self.roi_panel.frame_clicked.connect(self.seek)
+        self.comparison_bar.reference_button.clicked.connect(self.set_reference)
+        self.image_widget.ui.histogram.sigLevelsChanged.connect(self._sync_levels)
+        self._live_watcher.directoryChanged.connect(lambda path: QTimer.singleShot(200, self._live_update))
         
+        self.image_widget.getImageItem().getHistogram = self._histogram
+        view_box = self.image_widget.getView().getViewBox()
+        view_box.sigRangeChanged.connect(self._refine_level)
+        view_box.sigResized.connect(self._refine_level)
+        view_box.sigRangeChanged.connect(self._sync_range)
+
         self.proxy = pg.SignalProxy(self.image_widget.scene.sigMouseMoved, rateLimit=60, slot=self.mouseMoved)
         # self.image_widget.scene.sigMouseMoved.connect(self.mouseMoved)
 
@@ -255,11 +813,11 @@ class PatternViewerWidget(QWidget):
             return
 
         pos = event[0]
-        data = self.image_widget.image
-        nRows, nCols = data.shape 
+        nRows, nCols = self.pattern.shape
 
-        scenePos = self.image_widget.getImageItem().mapFromScene(pos)
-        row, col = int(scenePos.x()), int(scenePos.y())
+        # view coordinates are full resolution pixels for all mipmap levels
+        viewPos = self.image_widget.getView().getViewBox().mapSceneToView(pos)
+        row, col = int(viewPos.x()), int(viewPos.y())
 
         if (0 <= row < nRows) and (0 <= col < nCols):
             value = self.pattern[row, col]  #data[row, col]
@@ -277,204 +835,740 @@ class PatternViewerWidget(QWidget):
             self.path_edit.setText( dlg.selectedFiles()[0] )
         self.find_files()
 
-    def _sort_keys(self, name):
-        m = self._sort_regex.match(name)
-        print(name)
-        print(m)
-        if m.group(5) is not None:
-            print(m.group(3), int(m.group(4)), int(m.group(6)), int(m.group(9)))
-            return (m.group(3), int(m.group(4)), int(m.group(6)), int(m.group(9)))
-        elif m.group(7) is not None:
-            print(m.group(3), int(m.group(4)), int(m.group(8)), int(m.group(9)))
-            return (m.group(3), int(m.group(4)), int(m.group(8)), int(m.group(9)))
-        else:
-            print(m.group(3), int(m.group(4)), int(m.group(9)))
-            return (m.group(3), int(m.group(4)), int(m.group(9)))
-
     def find_files(self):
-        self.prev_item = None
-        self.pattern_list.clear()
-        name = self.path_edit.text()
+        self.playback.play_button.setChecked(False)
+        self.prefetcher.schedule([])
+        # the folder may be opened again right away, finish writing its index
+        self.save_scan_index(wait=True)
+        for r in self._reader_map.values():
+            r.close()
+        self._reader_map = dict()
+        self.pattern_model.clear()
         self.new = True
 
+        name = self.path_edit.text()
+        # live mode follows the opened path, not later edits of the field
+        self._live_name = name
+        self._scan_index = None
         if any([i in name for i in '[*?']):
-            self.flist = glob.glob(name)
-            if not self.flist:
-                self.image_label.setText('no files found')
-                return
+            self._scan = iter_pattern_files(name)
         else:
-            # use all files in folder
-            dirname = os.path.dirname(name)
-            self.flist = [os.path.join(dirname, i) for i in os.listdir(os.path.dirname(name))]
-            self.flist = list(filter(lambda x: x.endswith('.cbf') or x.endswith('.nxs'), self.flist))
-
-        self.flist = sorted(self.flist, key=self._sort_keys)
-
-        #print(self.flist)
-        with pg.BusyCursor():
-            for f in self.flist:
-                if f.endswith('.cbf'):
-                    self._add_cbf(f)
-                elif f.endswith('.nxs'):
-                    m = self._lambda3m_regex.match(f)
-                    if m:
-                        self._add_lambda3m(f)
-                    else:
-                        self._add_lambda(f)
+            # whole folders are indexed on disk, only new files are parsed
+            self._scan_index = ScanIndex(os.path.dirname(name) or os.curdir)
+            try:
+                files, paths = self._scan_index.load()
+            except OSError as e:
+                print('listing failed: %s' %e)
+                files, paths = FileIndex(), []
+            self.pattern_model.set_files(files)
+            self._scan = iter(paths)
+        self._scan_batch = 256
+        self._scan_timer.start()
+        self._scan_more()
+        if self.live_checkbox.isChecked():
+            self.set_live(True)
+
+    def save_scan_index(self, wait=False):
+        if self._scan is None and self._scan_index is not None and self._scan_index.dirty:
+            self._scan_index.save(self.pattern_model.files, wait=wait)
+
+    def _scan_more(self):
+        if self._scan is None:
+            return
         try:
-            self.pattern_list.setCurrentItem(self.pattern_list.topLevelItem(0), 0, QItemSelectionModel.Select)
-        except: pass
-
-    def _add_cbf(self, name):
-        alias = os.path.basename(name)
-        reader = CBFreader(name)
-        item = QTreeWidgetItem(self.pattern_list)
-        item.setText(0, alias)
-        item.setFlags(item.flags() | Qt.ItemIsSelectable)
-        self._reader_map[alias] = reader
-
-    def _add_lambda(self, name):
-        reader = LambdaReader(name)
-        alias = reader.name
-        item = QTreeWidgetItem(self.pattern_list)
-        reader.item = item
-        item.setText(0, alias)
-        item.setFlags(item.flags() | Qt.ItemIsSelectable)
-        self._reader_map[alias] = reader
-
-    def _add_lambda3m(self, name):
-        m = self._lambda3m_regex.match(name)
-        if not m.group(2) == 'm01':
-            return
-        reader = Lambda3MReader(m.group(1))
-        alias = reader.name
-        item = QTreeWidgetItem(self.pattern_list)
-        reader.item = item
-        item.setText(0, alias)
-        item.setFlags(item.flags() | Qt.ItemIsSelectable)
-        self._reader_map[alias] = reader
+            with instrument.span('listing'):
+                batch = list(itertools.islice(self._scan, self._scan_batch))
+        except OSError as e:
+            batch = []
+            print('listing failed: %s' %e)
+        self.pattern_model.add_files(batch)
+        if len(batch) < self._scan_batch:
+            self._scan_timer.stop()
+            self._scan = None
+            self.save_scan_index()
+            if not self.pattern_model.rowCount():
+                self.image_label.setText('no files found')
+        self._scan_batch = min(2*self._scan_batch, 65536)
+        if not self.pattern_list.currentIndex().isValid() and self.pattern_model.rowCount():
+            self.pattern_list.setCurrentIndex(self.pattern_model.index(0, 0))
+
+    def set_live(self, on):
+        self.follow_checkbox.setEnabled(on)
+        self._live_timer.stop()
+        if self._live_watcher.directories():
+            self._live_watcher.removePaths(self._live_watcher.directories())
+        if not on or self._live_name is None:
+            return
+        name = self._live_name
+        files = self.pattern_model.files
+        # the scan index has absolute paths, typed paths may be relative
+        self._live_seen = set(os.path.abspath(files.file_name(e)) for e in range(len(files.name)))
+        self._live_dir = os.path.dirname(name) or os.curdir
+        self._live_dir_mtime = None
+        if any([i in self._live_dir for i in '[*?']) or not self._live_watcher.addPath(self._live_dir):
+            print('cannot watch %s, polling' %self._live_dir)
+        self._live_timer.start()
+
+    def _live_update(self):
+        if not self.live_checkbox.isChecked() or self._scan is not None:
+            return
+        # new files, listed in the background when the folder changed
+        if self._live_listing is not None and self._live_listing.done():
+            try:
+                paths = self._live_listing.result()
+            except OSError as e:
+                print('listing failed: %s' %e)
+                paths = []
+            self._live_listing = None
+            self._live_seen.update(paths)
+            files = self.pattern_model.files
+            n = len(files.name)
+            if self.pattern_model.add_files(paths):
+                if self._scan_index is not None:
+                    self._scan_index.dirty = True
+                if self.follow_checkbox.isChecked():
+                    # the most recently written of the new files
+                    def mtime(entry):
+                        try:
+                            return os.stat(files.file_name(entry)).st_mtime_ns
+                        except OSError:
+                            return -1
+                    newest = max(range(n, len(files.name)), key=mtime)
+                    self._show_newest(self.pattern_model.top_index(newest))
+        if self._live_listing is None:
+            try:
+                mtime = os.stat(self._live_dir).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime is None or mtime != self._live_dir_mtime:
+                self._live_dir_mtime = mtime
+                self._live_listing = self._live_pool.submit(list_new_files, self._live_name, self._live_seen)
+
+        # growing nexus files
+        for entry, r in list(self._reader_map.items()):
+            if isinstance(r, CBFreader) or not r.is_open:
+                continue
+            try:
+                if not r.refresh():
+                    continue
+            except (OSError, ValueError) as e:
+                print('cannot refresh %s: %s' %(r.name, e))
+                continue
+            if self.pattern_model.set_frames(entry, len(r.images)):
+                if self._scan_index is not None:
+                    self._scan_index.dirty = True
+                if self.follow_checkbox.isChecked() and entry == self.curr_item:
+                    self._show_newest(self.pattern_model.top_index(entry))
+
+    def _show_newest(self, index):
+        n = self.pattern_model.rowCount(index)
+        self.pattern_list.setCurrentIndex(self.pattern_model.index(n-1, 0, index) if n else index)
+
+    def _reader(self, entry):
+        r = self._reader_map.get(entry)
+        if r is None:
+            r = self._reader_map[entry] = entry_reader(self.pattern_model.files, entry)
+        return r
 
     def _set_pattern(self):
         if self.pattern is None:
             return
-        trans_text = self.transComboBox.currentText()
-        if trans_text == "None":
-            self.pattern = self.pattern_o
-        elif trans_text == "rotate 90":
-            self.pattern = np.rot90(self.pattern_o, k=1, axes=(1,0))
-        elif trans_text == "rotate 180":
-            self.pattern = np.fliplr(np.flipud(self.pattern_o))
-        elif trans_text == "rotate 270":
-            self.pattern = np.rot90(self.pattern_o)
-        elif trans_text == "flip up/down":
-            self.pattern = np.fliplr(self.pattern_o)
-        elif trans_text == "flip left/right":
-            self.pattern = np.flipud(self.pattern_o)
-        elif trans_text == "rotate 90 & flip up/down":
-            self.pattern = np.fliplr(np.rot90(self.pattern_o, k=1, axes=(1,0)))
-        elif trans_text == "rotate 90 & flip left/right":
-            self.pattern = np.flipud(np.rot90(self.pattern_o, k=1, axes=(1,0)))
-
-        scaled_pattern = self.pattern[:]
-        scale_text = self.scaleComboBox.currentText()
-        if scale_text == "lin":
-            pass
-        elif scale_text == 'log10':
-            scaled_pattern[self.pattern<0] = 0
-            scaled_pattern = np.log10(scaled_pattern+1)
-        elif scale_text == 'sqrt':
-            scaled_pattern[self.pattern<0] = 0
-            scaled_pattern = np.sqrt(scaled_pattern)
-    
+        self.pipeline.transform = self.transComboBox.currentText()
+        self.pipeline.scale = self.scaleComboBox.currentText()
+        self.pattern = self.pipeline.pattern
+        self._level = self._mipmap_level()
+        scaled_pattern = self.pipeline.mipmap(self._level)
+        # a reduced level is stretched over the full resolution frame
+        scale = (self.pattern.shape[0]/scaled_pattern.shape[0], self.pattern.shape[1]/scaled_pattern.shape[1])
+
+        t = time.perf_counter()
         if self.pattern is None:
-            self.image_widget.setImage(scaled_pattern, levels=(0, 100), autoRange=True, autoHistogramRange=False)
+            self.image_widget.setImage(scaled_pattern, levels=(0, 100), autoRange=True, autoHistogramRange=False, scale=scale)
         elif self.scale_checkbox.isChecked():
-            self.image_widget.setImage(scaled_pattern, autoLevels=False, autoRange=True if self.new else False, autoHistogramRange=False)
+            self.image_widget.setImage(scaled_pattern, autoLevels=False, autoRange=True if self.new else False, autoHistogramRange=False, scale=scale)
+        else:
+            levels = self.levels_engine.levels(self.pipeline.frame, self.pipeline.scale, self._frame_key, self._exclude)
+            self.image_widget.setImage(scaled_pattern, autoLevels=levels is None, levels=levels, autoRange=True if self.new else False, autoHistogramRange=False, scale=scale)
+        self.pipeline.timings['render'] = time.perf_counter() - t
+        instrument.record('render', self.pipeline.timings['render'], t)
+        self._update_comparison()
+        self.update_profile()
+        self._report_timings()
+        self.image_label.setToolTip(', '.join('%s %.1f ms' %(k, v*1000) for k, v in self.pipeline.timings.items()))
+
+    def show_profile(self, on):
+        self.profile_panel.setVisible(on)
+        if on and self.pattern is not None and self.profile_panel.integrator.center == (0, 0):
+            # start with the center of the pattern
+            self.profile_panel.set_center([n/2. for n in self.pattern.shape])
+        self.update_profile()
+
+    def update_profile(self):
+        if not self.profile_panel.isVisible() or self.pipeline.frame is None:
+            return
+        t = time.perf_counter()
+        frame = self.pipeline.frame
+        mask_key = (detector_masks.version, self._geometry.name if self._geometry is not None else None)
+        self.profile_panel.update_profile(frame, self.pipeline.transform,
+                                          lambda: detector_masks.array(frame.shape, self._geometry), mask_key)
+        self.pipeline.timings['integrate'] = time.perf_counter() - t
+        instrument.record('integrate', self.pipeline.timings['integrate'], t)
+        self._report_timings()
+
+    def show_roi(self, on):
+        self.roi_panel.setVisible(on)
+        self.roi_panel.show_region(on, self.pattern.shape if self.pattern is not None else (100, 100))
+
+    def roi_series(self):
+        '''integrate the region in all frames of the timeline in the
+        background, the plot fills while the frames are read'''
+        index = self.pattern_list.currentIndex()
+        if self.pattern is None or not index.isValid():
+            QMessageBox.information(self, "ROI", "Select a frame of the sequence to be integrated.")
+            return
+        try:
+            roi = self.roi_panel.region_of_interest(self.pipeline.frame.shape, self.pipeline.transform)
+            sources = self._timeline_sources(index.parent())
+        except (OSError, KeyError, ValueError) as e:
+            QMessageBox.warning(self, "ROI", str(e))
+            return
+        series = RoiSeries(roi, self._geometry)
+        n = FrameAggregator.count(sources)
+        self.roi_panel.start(n, '%s of %d pixels' %(roi.kind, series.pixels))
+        def done(values):
+            if values is not None:
+                print('%s of %d pixels in %d frames' %(roi.kind, series.pixels, len(values)))
+        self.run_job('ROI of %d frames' %n,
+                     lambda progress, cancelled: series.run(sources, progress, cancelled, self.roi_panel.partial.emit),
+                     done)
+
+    def _timeline_sources(self, parent):
+        '''(kind, path, start, stop) of the timeline rows below ``parent``,
+        one per file for the top level (its first frame, like playback)'''
+        model, files = self.pattern_model, self.pattern_model.files
+        if parent.isValid():
+            entry = model.entry(parent)
+            return [(int(files.kind[entry]), files.path(entry), 0, model.rowCount(parent))]
+        # aggregated frames are listed after the files and left out
+        return [(int(files.kind[entry]), files.path(entry), 0, 1) for entry in files.order]
+
+    def _report_timings(self):
+        if instrument.enabled:
+            self.timings_changed.emit(instrument.status())
+
+    def _histogram(self, *args, **kwargs):
+        # replaces getHistogram of the image item: the cached histogram of
+        # the whole frame instead of one of the shown (mipmap) image
+        if self.pipeline.frame is None:
+            return None, None
+        return self.levels_engine.histogram(self.pipeline.frame, self.pipeline.scale, self._frame_key, self._exclude)
+
+    def _mipmap_level(self):
+        '''coarsest mipmap level that still has a pixel per screen pixel'''
+        vb = self.image_widget.getView().getViewBox()
+        if self.new:
+            # the view is fitted to the whole frame
+            w, h = self.pattern.shape
+            ratio = max(w/max(vb.width(), 1), h/max(vb.height(), 1))
         else:
-            self.image_widget.setImage(scaled_pattern, autoLevels=True, autoRange=True if self.new else False, autoHistogramRange=False)
+            ratio = min(vb.viewPixelSize())
+        if ratio < 2:
+            return 0
+        return min(int(np.log2(ratio)), self.pipeline.mipmap_levels()-1)
+
+    def _refine_level(self):
+        # zooming in switches to a finer level, zooming out to a coarser one
+        if self.pattern is None or self._mipmap_level() == self._level:
+            return
+        self._level = self._mipmap_level()
+        img = self.pipeline.mipmap(self._level)
+        self.image_widget.setImage(img, autoLevels=False, autoRange=False, autoHistogramRange=False,
+                                   scale=(self.pattern.shape[0]/img.shape[0], self.pattern.shape[1]/img.shape[1]))
+        if self.compare_checkbox.isChecked() and self._reference is not None:
+            self._show_reference()
+            self._show_difference()
+
+    def show_comparison(self, on):
+        self.comparison_bar.setVisible(on)
+        self.reference_view.setVisible(on)
+        self.difference_view.setVisible(on)
+        self._reference_changed()
+        self._sync_range(self.image_widget.getView().getViewBox())
+
+    def set_reference(self):
+        '''use the current pattern as the fixed reference'''
+        self._reference_frame = self.frame_reader
+        self._reference_changed()
+
+    def _reference_for(self, index):
+        # frame to compare with the one at index, None if there is none
+        if not self.compare_checkbox.isChecked():
+            return None
+        offset = self.comparison_bar.offset
+        if offset is None:
+            return self._reference_frame
+        if index is None or not index.isValid():
+            return None
+        row, parent = index.row() + offset, index.parent()
+        if not 0 <= row < self.pattern_model.rowCount(parent):
+            return None
+        try:
+            return self._sequence_frame(self.pattern_model.index(row, 0, parent))
+        except (OSError, KeyError, ValueError) as e:
+            print('cannot read reference: %s' %e)
+            return None
 
+    def _reference_changed(self):
+        if self.frame_reader is None:
+            return
+        reference = self._reference_for(QModelIndex(self._frame_index))
+        self._reference = self.prefetcher.get(reference) if reference is not None else None
+        self._reference_source = reference
+        self._update_comparison()
+
+    def _update_comparison(self):
+        if not self.compare_checkbox.isChecked() or self.pattern is None:
+            return
+        bar = self.comparison_bar
+        if self._reference is None:
+            bar.reference_label.setText('no reference' if bar.offset is None else 'no pattern at offset %d' %bar.offset)
+            self.reference_view.clear()
+            self.difference_view.clear()
+            return
+        t = time.perf_counter()
+        bar.reference_label.setText('reference: %s' %self._reference_source.name)
+        self.reference_pipeline.transform = self.pipeline.transform
+        self.reference_pipeline.scale = self.pipeline.scale
+        self.reference_pipeline.frame = self._reference
+        self._show_reference()
+        self.comparison.mode = bar.mode_box.currentText()
+        try:
+            result = self.comparison.compare(self.pipeline.frame, self._reference)
+        except ValueError as e:
+            bar.reference_label.setText(str(e))
+            self.difference_view.clear()
+            return
+        levels = self.comparison.levels(result)
+        self._difference = DisplayPipeline.apply_transform(result, self.pipeline.transform)
+        self._show_difference(levels)
+        self.pipeline.timings['compare'] = time.perf_counter() - t
+        instrument.record('compare', self.pipeline.timings['compare'], t)
+
+    def _show_reference(self):
+        # at the mipmap level of the pattern, with its levels
+        pipeline = self.reference_pipeline
+        img = pipeline.mipmap(min(self._level, pipeline.mipmap_levels()-1))
+        shape = pipeline.pattern.shape
+        self.reference_view.setImage(img, autoLevels=False, levels=self.image_widget.ui.histogram.getLevels(),
+                                     autoRange=False, autoHistogramRange=False,
+                                     scale=(shape[0]/img.shape[0], shape[1]/img.shape[1]))
+
+    def _show_difference(self, levels=None):
+        # mean of blocks, the max would hide negative differences
+        img = self._difference
+        for i in range(self._level):
+            img = downsample(img, 'mean')
+        shape = self._difference.shape
+        self.difference_view.setImage(img, autoLevels=False, levels=levels, autoRange=False, autoHistogramRange=False,
+                                      scale=(shape[0]/img.shape[0], shape[1]/img.shape[1]))
+        if levels is not None:
+            self.difference_view.ui.histogram.setHistogramRange(*levels)
+
+    def _sync_range(self, view_box, *args):
+        # the views of the comparison have the same center and zoom, the
+        # same range would be widened by each view to its aspect ratio
+        if self._syncing or not self.compare_checkbox.isChecked():
+            return
+        self._syncing = True
+        center = view_box.viewRect().center()
+        dx, dy = view_box.viewPixelSize()
+        for view in (self.image_widget, self.reference_view, self.difference_view):
+            vb = view.getView().getViewBox()
+            if vb is not view_box:
+                w, h = vb.width()*dx/2, vb.height()*dy/2
+                vb.setRange(xRange=(center.x()-w, center.x()+w), yRange=(center.y()-h, center.y()+h), padding=0)
+        self._syncing = False
+
+    def _sync_levels(self):
+        if self.reference_view.isVisible() and self.reference_view.image is not None:
+            self.reference_view.setLevels(*self.image_widget.ui.histogram.getLevels())
 
     def show_pattern(self):
-        self.curr_item = self.pattern_list.currentItem()
-        if not self.curr_item: return
-        if self.curr_item.childCount() > 0:
-            # if we have children, select first child (does not highlight it?)
-            self.pattern_list.setCurrentItem(self.curr_item.child(0), 0, QItemSelectionModel.Select)
-            return
-        if self.curr_item.parent() is not None:
-            print('has parent')
-            parent_selected = False
-            self.curr_item = self.curr_item.parent()
-
-        item = self.curr_item.text(0)
-
-        ## Hack: if we empty the pattern list when opening a new file show_pattern is called
-        # in this case item is None and I just return
-        if item is None: return
-        r = self._reader_map[item]
-
-        if isinstance(r, (LambdaReader, Lambda3MReader)):
-            print('is lambda')
-            if r.is_open:
-                pattern_reader = r.sub_item_map[self.pattern_list.currentItem().text(0)]   
+        index = self.pattern_list.currentIndex()
+        if not index.isValid(): return
+        model = self.pattern_model
+        if model.rowCount(index) > 0:
+            # if we have children, select first child, but keep a multi
+            # row selection (e.g. for aggregating)
+            selection = self.pattern_list.selectionModel()
+            multiple = len(selection.selectedRows()) > 1
+            selection.setCurrentIndex(model.index(0, 0, index),
+                                      QItemSelectionModel.NoUpdate if multiple else QItemSelectionModel.ClearAndSelect)
+            return
+        pattern_reader = model.virtual_frame(index)
+        r = None
+        if pattern_reader is None:
+            self.curr_item = model.entry(index)
+            r = self._reader(self.curr_item)
+            if isinstance(r, (LambdaReader, Lambda3MReader)):
+                if not r.is_open:
+                    trace('opening nxs')
+                    r.open()
+                    # if we have multiple pattern in the nexus file the model adds children
+                    if model.set_frames(self.curr_item, len(r.images)) and self._scan_index is not None:
+                        self._scan_index.dirty = True
+                # the top level item shows the first frame
+                pattern_reader = LambdaItem(r, index.row() if index.internalId() else 0)
             else:
-                print('opening nxs')
-                r.open()
-                # if we have multiple pattern in the nexus file we add children to the current item
-                if len(r.images) > 1 and not self.curr_item.childCount():
-                    for x in r.images:
-                        alias = "%05d" %(x+1)
-                        child = QTreeWidgetItem(self.curr_item)
-                        child.setFlags(child.flags() | Qt.ItemIsSelectable)
-                        child.setText(0, alias)
-                        r.sub_item_map["%05d" %(x+1)] = LambdaItem(r, x)
-                else:
-                    # children have been previously created, if we reopen the
-                    #  file we only need to recreate the map of the names to 
-                    # the pattern in the file
-                    for x in r.images:
-                        alias = "%05d" %(x+1)
-                        r.sub_item_map["%05d" %(x+1)] = LambdaItem(r, x)
-                if self.pattern_list.currentItem().text(0) == r.name:
-                    if len(r.images) == 1:
-                        pattern_reader = LambdaItem(r, 0)
-                    else:
-                        pattern_reader = r.sub_item_map['00001']  # not nice, should not be hardcoded
-                else:
-                    pattern_reader = r.sub_item_map[self.pattern_list.currentItem().text(0)]
-                    
+                pattern_reader = r
+        if self._play_timer.isActive():
+            # clicking in the list continues the playback from there
+            self._play_parent = QPersistentModelIndex(index.parent())
+            self._play_row = index.row()
+        self._show_frame(pattern_reader, index)
+        self.playback.set_position(index.row(), model.rowCount(index.parent()))
+        self._prefetch_neighbours()
+
+    def _show_frame(self, pattern_reader, index=None):
+        self.frame_reader = pattern_reader
+        self._frame_index = QPersistentModelIndex(index) if index is not None else QPersistentModelIndex()
+        reference = self._reference_for(index)
+        if reference is not None:
+            # e.g. a new frame and its neighbour, both read at once
+            self.pattern_o, self._reference = self.prefetcher.get_all([pattern_reader, reference])
         else:
-            pattern_reader = r
-        self.pattern_o = np.asarray(pattern_reader.image(), dtype=np.float32)   
+            self.pattern_o, self._reference = self.prefetcher.get(pattern_reader), None
+        self._reference_source = reference
         self.pattern = self.pattern_o    
+        self.pipeline.frame = self.pattern_o
+        self._frame_key = frame_key(pattern_reader) + (detector_masks.version,)
+        self._geometry = getattr(pattern_reader, 'geometry', None)
+        self._exclude = self._geometry.gap_mask() if isinstance(getattr(pattern_reader, 'reader', None), Lambda3MReader) else None
         
         self._set_pattern()
         self.pattern_name = pattern_reader.name
         self.image_label.setText("pattern: %s" %pattern_reader.name)
 
-        # if we need to open a new file close the previous file
-        if self.prev_item is not None and self.prev_item is not self.curr_item: self._reader_map[self.prev_item.text(0)].close()
-        self.prev_item = self.curr_item
         self.new = False
 
-    def export_tiff(self):
-        if self.pattern is None:
-            msg = QMessageBox()
-            msg.setIcon(QMessageBox.Information)
-            msg.setText("You need to select a patter to be exported.")
-            msg.setWindowTitle("No Pattern to export")
-            msg.setStandardButtons(QMessageBox.Ok)
-            msg.exec_()
-            return
-        fn = QFileDialog().getSaveFileName(self, 
-                          'Export TIFF: 32bit signed int, lzw compressed',
-                           os.path.join(self._last_dir, '%s.tiff' %self.pattern_name),
-                           "TIFF (*.tiff)")
-        if fn[0]:
-            #print(fn)
-            img = Image.fromarray(self.pattern.T, 'I')
-            self._last_dir = os.path.dirname(fn[0])
-            img.save(fn[0], compression='tiff_lzw')
+    def _frame_reader(self, index):
+        '''reader of a single frame for a list index, None if that would need opening a file'''
+        model = self.pattern_model
+        if model.rowCount(index) > 0:
+            return None
+        if model.virtual_frame(index) is not None:
+            return model.virtual_frame(index)
+        r = self._reader(model.entry(index))
+        if isinstance(r, CBFreader):
+            return r
+        if not r.is_open:
+            return None
+        if not index.internalId():
+            return LambdaItem(r, 0) if len(r.images) == 1 else None
+        return LambdaItem(r, index.row())
+
+    def _prefetch_neighbours(self, index=None):
+        # neighbours are the siblings of the current item, i.e. the frames of
+        # the same nexus file or the neighbouring files in the list, during
+        # playback the next frames to be shown
+        if index is None:
+            index = self.pattern_list.currentIndex()
+        parent = index.parent()
+        count = self.pattern_model.rowCount(parent)
+        frames = []
+        if self._play_timer.isActive():
+            stride = self.playback.stride_box.value()
+            for k in range(1, 2*self.prefetcher.depth+1):
+                try:
+                    frames.append(self._sequence_frame(self.pattern_model.index((index.row()+k*stride) % count, 0, parent)))
+                except (OSError, KeyError, ValueError):
+                    pass
+        else:
+            for k in range(1, self.prefetcher.depth+1):
+                for i in (index.row()+k, index.row()-k):
+                    if 0 <= i < count:
+                        f = self._frame_reader(self.pattern_model.index(i, 0, parent))
+                        if f is not None:
+                            frames.append(f)
+        self.prefetcher.schedule(frames)
+
+    def _sequence_frame(self, index):
+        '''frame of a timeline row, opens nexus files and uses the first
+        frame of files with several'''
+        model = self.pattern_model
+        if model.virtual_frame(index) is not None:
+            return model.virtual_frame(index)
+        entry = model.entry(index)
+        r = self._reader(entry)
+        if isinstance(r, CBFreader):
+            return r
+        if not r.is_open:
+            r.open()
+            if model.set_frames(entry, len(r.images)) and self._scan_index is not None:
+                self._scan_index.dirty = True
+        return LambdaItem(r, index.row() if index.internalId() else 0)
+
+    def set_playing(self, on):
+        if not on:
+            self._play_timer.stop()
+            # the list follows the shown frame once paused
+            index = self.pattern_model.index(self._play_row, 0, QModelIndex(self._play_parent))
+            if index.isValid() and index != self.pattern_list.currentIndex():
+                self.pattern_list.setCurrentIndex(index)
+            return
+        index = self.pattern_list.currentIndex()
+        if not index.isValid():
+            self.playback.play_button.setChecked(False)
+            return
+        self._play_parent = QPersistentModelIndex(index.parent())
+        self._play_row = index.row()
+        self._play_shown.clear()
+        self._set_fps(self.playback.fps_box.value())
+        self._play_timer.start()
+        self._prefetch_neighbours(index)
+
+    def _set_fps(self, fps):
+        self._play_timer.setInterval(int(round(1000./fps)))
+
+    def _play_next(self):
+        parent = QModelIndex(self._play_parent)
+        count = self.pattern_model.rowCount(parent)
+        if not count:
+            self.playback.play_button.setChecked(False)
+            return
+        row = (self._play_row + self.playback.stride_box.value()) % count
+        index = self.pattern_model.index(row, 0, parent)
+        try:
+            frame = self._sequence_frame(index)
+        except (OSError, KeyError, ValueError) as e:
+            print('skipping %s: %s' %(self.pattern_model.data(index), e))
+            self._play_row = row
+            return
+        if not self.prefetcher.ready(frame):
+            # keep the current frame until the next one has been read
+            self._prefetch_neighbours(self.pattern_model.index(self._play_row, 0, parent))
+            return
+        self._play_frame(index, frame)
+
+    def _play_frame(self, index, frame):
+        self._play_row = index.row()
+        self._show_frame(frame, index)
+        self._play_shown.append(time.perf_counter())
+        shown = self._play_shown
+        fps = (len(shown)-1) / (shown[-1]-shown[0]) if len(shown) > 1 and shown[-1] > shown[0] else None
+        self.playback.set_position(index.row(), self.pattern_model.rowCount(index.parent()), fps)
+        self._prefetch_neighbours(index)
+
+    def seek(self, row):
+        if not self._play_timer.isActive():
+            parent = self.pattern_list.currentIndex().parent()
+            self.pattern_list.setCurrentIndex(self.pattern_model.index(row, 0, parent))
+            return
+        index = self.pattern_model.index(row, 0, QModelIndex(self._play_parent))
+        try:
+            frame = self._sequence_frame(index)
+        except (OSError, KeyError, ValueError) as e:
+            print('skipping %s: %s' %(self.pattern_model.data(index), e))
+            return
+        self._play_shown.clear()
+        self._play_frame(index, frame)
+
+    def export_sequence(self):
+        '''export the timeline (every stride-th frame) as a movie with the
+        current transform, scale, levels and colours'''
+        index = self.pattern_list.currentIndex()
+        if self.pattern is None or not index.isValid():
+            QMessageBox.information(self, "Export Movie", "Select a frame of the sequence to be exported.")
+            return
+        filters = {'.tiff': 'Animated TIFF (*.tiff)', '.mp4': 'MP4 (*.mp4)'}
+        extensions = MovieWriter.available()
+        fn = QFileDialog.getSaveFileName(self, 'Export Movie', os.path.join(self._last_dir, '%s.tiff' %self.pattern_name),
+                                         ';;'.join(filters[e] for e in extensions))
+        if not fn[0]:
+            return
+        fname = fn[0]
+        if not fname.lower().endswith(extensions):
+            fname += '.mp4' if fn[1] == filters['.mp4'] else '.tiff'
+        self._last_dir = os.path.dirname(fname)
+        parent = index.parent()
+        try:
+            frames = [self._sequence_frame(self.pattern_model.index(row, 0, parent))
+                      for row in range(0, self.pattern_model.rowCount(parent), self.playback.stride_box.value())]
+        except (OSError, KeyError, ValueError) as e:
+            QMessageBox.warning(self, "Export Movie", str(e))
+            return
+        histogram = self.image_widget.ui.histogram
+        levels = histogram.getLevels()
+        lut = histogram.gradient.getLookupTable(256, alpha=False)
+        transform, scale, fps = self.pipeline.transform, self.pipeline.scale, self.playback.fps_box.value()
+        def done(n):
+            if n is not None:
+                print('%d frames written to %s' %(n, fname))
+        self.run_job('Export movie of %d frames' %len(frames),
+                     lambda progress, cancelled: export_movie(frames, fname, transform, scale, levels, lut, fps,
+                                                              progress, cancelled), done)
+
+    def run_job(self, title, fn, done):
+        '''run ``fn(progress, cancelled)`` as ``BackgroundJob`` with a
+        progress dialog, ``done`` is called with the result'''
+        dialog = QProgressDialog(title, 'Cancel', 0, 0, self)
+        dialog.setWindowTitle(title)
+        dialog.setWindowModality(Qt.WindowModal)
+        dialog.setMinimumDuration(500)
+        job = BackgroundJob(fn, self)
+        def progress(i, n):
+            dialog.setMaximum(n)
+            dialog.setValue(i)
+        job.progress.connect(progress)
+        job.done.connect(done)
+        job.failed.connect(lambda msg: QMessageBox.warning(self, title, msg))
+        dialog.canceled.connect(job.cancel)
+        job.finished.connect(dialog.reset)
+        job.finished.connect(lambda: self._jobs.discard(job))
+        self._jobs.add(job)
+        job.start()
+        return job
+
+    def cancel_jobs(self):
+        for job in list(self._jobs):
+            job.cancel()
+            job.wait()
+
+    def _selected_sources(self):
+        '''(kind, path, start, stop) of the selected files and runs of
+        selected frames, in list order'''
+        model, files = self.pattern_model, self.pattern_model.files
+        whole, rows = set(), {}
+        for index in self.pattern_list.selectionModel().selectedRows():
+            if model.virtual_frame(index) is not None:
+                continue
+            if index.internalId():
+                rows.setdefault(model.entry(index), []).append(index.row())
+            else:
+                whole.add(model.entry(index))
+        sources = []
+        for entry in sorted(whole.union(rows), key=lambda e: files.rank[e]):
+            kind, path = int(files.kind[entry]), files.path(entry)
+            if kind == FileIndex.CBF:
+                sources.append((kind, path, 0, 1))
+                continue
+            r = self._reader(entry)
+            if not r.is_open:
+                r.open()
+                model.set_frames(entry, len(r.images))
+            if entry in whole:
+                sources.append((kind, path, 0, len(r.images)))
+                continue
+            selected = np.unique(rows[entry])
+            for run in np.split(selected, np.flatnonzero(np.diff(selected) > 1) + 1):
+                sources.append((kind, path, int(run[0]), int(run[-1]) + 1))
+        return sources
+
+    def aggregate(self):
+        try:
+            sources = self._selected_sources()
+        except (OSError, KeyError, ValueError) as e:
+            QMessageBox.warning(self, "Aggregate", str(e))
+            return
+        if not sources:
+            QMessageBox.information(self, "Aggregate", "Select the files or frames to be aggregated.")
+            return
+        mode = self.aggComboBox.currentText()
+        aggregator = FrameAggregator(mode)
+        name = os.path.basename(sources[0][1])
+        def done(result):
+            data, n = result
+            if data is None:
+                # cancelled
+                return
+            frame = AggregateFrame('%s of %d frames from %s' %(mode, n, name), data, aggregator.geometry)
+            self.pattern_list.setCurrentIndex(self.pattern_model.add_virtual(frame))
+        self.run_job('%s of %d frames' %(mode, aggregator.count(sources)),
+                     lambda progress, cancelled: aggregator.run(sources, progress, cancelled), done)
+
+    def set_masked(self, on):
+        detector_masks.set_enabled(on)
+        self._masks_changed()
+
+    def load_mask(self):
+        fn = QFileDialog.getOpenFileName(self, 'Load mask (nonzero pixels are masked)', self._last_dir,
+                                         "Masks (*.npy *.tif *.tiff *.edf *.cbf *.msk);;All files (*)")
+        if not fn[0]:
+            return
+        try:
+            shape = detector_masks.load(fn[0])
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Load mask", "Could not load mask %s: %s" %(fn[0], e))
+            return
+        print('mask %s for frames of shape %s' %(fn[0], shape))
+        self._last_dir = os.path.dirname(fn[0])
+        self._masks_changed()
+
+    def clear_masks(self):
+        detector_masks.clear()
+        self._masks_changed()
+
+    def _masks_changed(self):
+        # reads in flight were masked with the old masks
+        self.prefetcher.schedule([])
+        if self.pattern is not None:
+            self.show_pattern()
+
+    def export_frames(self):
+        '''export the current frame, the selection, a range of frames or
+        the dataset of the current frame in their own type (``StackExporter``)'''
+        index = self.pattern_list.currentIndex()
+        if self.pattern is None or not index.isValid():
+            QMessageBox.information(self, "Export", "You need to select a pattern to be exported.")
+            return
+        parent = index.parent()
+        dialog = ExportDialog(self.pattern_model.rowCount(parent), index.row(), self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        exporter = dialog.exporter()
+        ext = StackExporter.formats[exporter.format]
+        fn = QFileDialog.getSaveFileName(self, 'Export', os.path.join(self._last_dir, self.pattern_name + ext),
+                                         '%s (*%s)' %(exporter.format.upper(), ext))
+        if not fn[0]:
+            return
+        fname = fn[0] if fn[0].lower().endswith(ext) else fn[0] + ext
+        self._last_dir = os.path.dirname(fname)
+        try:
+            sources = self._export_sources(dialog.scope_box.currentText(), index,
+                                           dialog.first_box.value() - 1, dialog.last_box.value())
+        except (OSError, KeyError, ValueError) as e:
+            QMessageBox.warning(self, "Export", str(e))
+            return
+        if not sources:
+            QMessageBox.information(self, "Export", "Select the files or frames to be exported.")
+            return
+        def done(n):
+            if n is not None:
+                print('%d frames written to %s' %(n, fname))
+        self.run_job('Export to %s' %os.path.basename(fname),
+                     lambda progress, cancelled: exporter.run(sources, fname, progress, cancelled), done)
+
+    def _export_sources(self, scope, index, first, last):
+        '''sources of ``StackExporter`` for a scope of ``ExportDialog``,
+        ``first`` and ``last`` are the rows of a frame range'''
+        model, files = self.pattern_model, self.pattern_model.files
+        if scope == 'selection':
+            return self._selected_sources()
+        if scope == 'frame':
+            if model.virtual_frame(index) is not None:
+                return [model.virtual_frame(index)]
+            entry = model.entry(index)
+            row = index.row() if index.internalId() else 0
+            return [(int(files.kind[entry]), files.path(entry), row, row + 1)]
+        sources = self._timeline_sources(index.parent())
+        if scope == 'frame range':
+            if first >= last:
+                raise ValueError('the frame range %d to %d is empty' %(first + 1, last))
+            if index.parent().isValid():
+                kind, path, start, stop = sources[0]
+                return [(kind, path, first, min(last, stop))]
+            return sources[first:last]
+        return sources
 
 
 
@@ -491,22 +1585,75 @@ class PatternViewer(QMainWindow):
         exitAct.setStatusTip('Exit application')
         exitAct.triggered.connect(self.close)
 
-        exportTIFF = QAction('Export TIFF', self)
-        exportTIFF.setShortcut('Ctrl+E')
-        exportTIFF.setStatusTip('Export TIFF')
-        exportTIFF.triggered.connect(self.pattern_viewer_widget.export_tiff)
+        exportFrames = QAction('Export Frames...', self)
+        exportFrames.setShortcut('Ctrl+E')
+        exportFrames.setStatusTip('Export frames as BigTIFF, HDF5 or NPY in their own type')
+        exportFrames.triggered.connect(self.pattern_viewer_widget.export_frames)
+
+        exportMovie = QAction('Export Movie...', self)
+        exportMovie.setStatusTip('Export the frames of the timeline as animated TIFF or MP4')
+        exportMovie.triggered.connect(self.pattern_viewer_widget.export_sequence)
+
+        loadMask = QAction('Load Mask...', self)
+        loadMask.setStatusTip('Load a mask, nonzero pixels are masked')
+        loadMask.triggered.connect(self.pattern_viewer_widget.load_mask)
+
+        clearMasks = QAction('Clear Masks', self)
+        clearMasks.triggered.connect(self.pattern_viewer_widget.clear_masks)
 
         menubar = self.menuBar()
         fileMenu = menubar.addMenu('File')
-        fileMenu.addAction(exportTIFF) 
+        fileMenu.addAction(exportFrames)
+        fileMenu.addAction(exportMovie)
+        fileMenu.addAction(loadMask)
+        fileMenu.addAction(clearMasks)
         fileMenu.addAction(exitAct)
 
 
+        timingsAct = QAction('Show Timings', self)
+        timingsAct.setCheckable(True)
+        timingsAct.setStatusTip('Time reading and display of the patterns')
+        timingsAct.toggled.connect(self.show_timings)
+
+        saveTimingsAct = QAction('Save Timings...', self)
+        saveTimingsAct.triggered.connect(self.save_timings)
+
+        viewMenu = menubar.addMenu('View')
+        viewMenu.addAction(timingsAct)
+        viewMenu.addAction(saveTimingsAct)
+
+        self.pattern_viewer_widget.timings_changed.connect(self.statusBar().showMessage)
+
         aboutAct = QAction('About', self)
         aboutAct.triggered.connect(self.helpAbout)
         helpMenu = menubar.addMenu('Help')
         helpMenu.addAction(aboutAct)
 
+    def closeEvent(self, event):
+        self.pattern_viewer_widget.live_checkbox.setChecked(False)
+        self.pattern_viewer_widget.playback.play_button.setChecked(False)
+        self.pattern_viewer_widget.cancel_jobs()
+        self.pattern_viewer_widget.prefetcher.shutdown()
+        self.pattern_viewer_widget.save_scan_index(wait=True)
+        h5_pool.close()
+        super().closeEvent(event)
+
+    def show_timings(self, on):
+        instrument.enabled = on
+        if on:
+            instrument.reset()
+            self.statusBar().showMessage('timings are shown for the next pattern')
+        else:
+            self.statusBar().clearMessage()
+
+    def save_timings(self):
+        fn = QFileDialog.getSaveFileName(self, 'Save Timings', 'timings.json', "JSON (*.json)")
+        if fn[0]:
+            try:
+                instrument.dump(fn[0])
+            except OSError as e:
+                QMessageBox.warning(self, "Save Timings", str(e))
+
     def helpAbout(self):
         QMessageBox.about(self, "About pattern viewer",
           """<b>Pattern Viewer v%s (2020)</b>
@@ -530,6 +1677,8 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 def main():
+    # aggregation uses a spawn process pool, also in frozen builds
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     form = PatternViewer()
     app.setApplicationName("Pattern Viewer")
@@ -538,7 +1687,10 @@ def main():
     elif sys.platform == 'darwin':
         app.setWindowIcon(QIcon(resource_path('images/pattern_viewer.icns')))
     form.show()
+    # import the format backends while the user picks a folder
+    QTimer.singleShot(100, lambda: warm_up((h5py, fabio, Image)))
     app.exec_()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,9 @@ a = Analysis(['pattern_viewer.py'],
              binaries=[],
              datas=[('images/pattern_viewer.ico', 'images/'),
                     ('images/pattern_viewer.icns', 'images/'),],
-             hiddenimports=['h5py.defs', 'h5py.utils', 'h5py.h5ac', 'h5py._proxy', 
+             # pyqtgraph, h5py, fabio and PIL are imported lazily (LazyModule), hidden from the analysis
+             hiddenimports=['pyqtgraph', 'h5py', 'fabio', 'fabio.ext.byte_offset', 'PIL.Image',
+                            'h5py.defs', 'h5py.utils', 'h5py.h5ac', 'h5py._proxy', 
                             'fabio.edfimage', 'fabio.dtrekimage', 'fabio.tifimage', 'fabio.marccdimage',
                             'fabio.mar345image', 'fabio.fit2dmaskimage', 'fabio.brukerimage',
                             'fabio.bruker100image', 'fabio.pnmimage', 'fabio.GEimage', 'fabio.OXDimage',
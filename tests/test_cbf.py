@@ -0,0 +1,77 @@
+'''CBF byte offset decoding and reading, run with ``python -m pytest tests``'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pattern_io as pio
+
+
+def encode_byte_offset(values):
+    '''byte offset stream of int32 values with the shortest escape for each delta'''
+    out = bytearray()
+    last = 0
+    for v in values.tolist():
+        delta = v - last
+        last = v
+        if -127 <= delta <= 127:
+            out += np.int8(delta).tobytes()
+            continue
+        out += b'\x80'
+        if -32767 <= delta <= 32767:
+            out += np.int16(delta).tobytes()
+            continue
+        out += b'\x00\x80'
+        if -2**31 + 1 <= delta <= 2**31 - 1:
+            out += np.int32(delta).tobytes()
+            continue
+        out += b'\x00\x00\x00\x80' + np.int64(delta).tobytes()
+    return np.frombuffer(bytes(out), dtype=np.int8)
+
+
+def frame(rng, shape=(40, 60)):
+    data = rng.poisson(20, shape).astype(np.int32)
+    # 16, 32 and 64 bit deltas, and escape bytes inside the payload
+    # of earlier escapes (deltas of 128 and 0x8080)
+    data.flat[rng.integers(0, data.size, 50)] = rng.integers(200, 30000, 50)
+    data.flat[rng.integers(0, data.size, 50)] = rng.integers(10**5, 10**9, 50)
+    data.flat[5:8] = [128, 128 + 0x8080, -2**31]
+    data.flat[8] = 2**31 - 1
+    data[10:12] = -1
+    return data
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decode_byte_offset(seed):
+    data = frame(np.random.default_rng(seed)).ravel()
+    raw = encode_byte_offset(data)
+    assert np.array_equal(pio.decode_byte_offset(raw, len(data)), data)
+    # only the first values of a longer stream
+    assert np.array_equal(pio.decode_byte_offset(raw, 100), data[:100])
+
+
+def test_decode_short_stream():
+    raw = encode_byte_offset(np.arange(10, dtype=np.int32))
+    with pytest.raises(ValueError):
+        pio.decode_byte_offset(raw, 11)
+
+
+@pytest.fixture(params=['compiled', 'numpy'])
+def decoder(request, monkeypatch):
+    if request.param == 'numpy':
+        monkeypatch.setattr(pio, '_dec_cbf32', lambda: None)
+    elif pio._dec_cbf32() is None:
+        pytest.skip('fabio without the compiled decoder')
+    return request.param
+
+
+def test_read_cbf(tmp_path, decoder):
+    CbfImage = pytest.importorskip('fabio.cbfimage').CbfImage
+    data = frame(np.random.default_rng(1))
+    fname = str(tmp_path / 'frame.cbf')
+    CbfImage(data=data).write(fname)
+    assert np.array_equal(pio.read_cbf(fname), data)
+    assert np.array_equal(pio.read_cbf(fname, np.s_[7:23]), data[7:23])
+    assert pio.read_cbf(fname, np.s_[0:0]).shape == (0, data.shape[1])
@@ -0,0 +1,30 @@
+'''Cold start budget of the viewer (see benchmarks/bench_startup.py), run
+with ``python -m pytest tests``'''
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('PyQt5.QtWidgets')
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+import bench_startup
+
+
+def test_lazy_imports():
+    '''the plotting and format modules are not imported with the viewer'''
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pattern_viewer'], cwd=root,
+                            env=bench_startup.environment(), stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True).stderr
+    imported = set(line.rsplit('|', 1)[-1].strip() for line in stderr.splitlines() if line.startswith('import time:'))
+    assert 'pattern_viewer' in imported
+    for module in ('pyqtgraph', 'h5py', 'fabio', 'PIL'):
+        assert module not in imported
+
+
+def test_startup_budget():
+    '''time to the first window and no format backend imported by then'''
+    runs, median = bench_startup.measure(3)
+    assert not [m for r in runs for m in r['backends']]
+    assert median < bench_startup.budget